@@ -0,0 +1,243 @@
+import json
+import argparse
+
+import numpy as np
+
+from compact import build_compact
+from data import NUMERIC_COLS, load_data
+from lookup import build_lookup
+from neighbors import attach_neighbor_table
+from spatial import build_spatial_index
+from timeseries import load_snapshot, store_from_args
+from utils import add_compact_arg, add_data_args, add_store_args, check_state, resolve_query
+
+# The COVID-19 statistics that are summed
+STATISTICS = NUMERIC_COLS[1:]
+
+def per_100k(values, population):
+    """Rates per 100,000 people, NaN where the population is unknown (0)
+
+    Args:
+    =====
+        values (np.ndarray): Counts, e.g. the cases
+        population (np.ndarray): The populations, broadcasting against values
+
+    Returns:
+    ========
+        (np.ndarray): The rates
+    """
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        return np.where(population > 0, values * 1e5 / population, np.nan)
+
+class Rollups:
+    """Per-county and per-state totals of a dataframe from load_data(), for aggregate queries
+
+    Built once per dataset load with build_rollups(). The NY Times numbers are cumulative,
+    so each county contributes its row of the latest date in the dataframe. Counties are
+    keyed on their FIPS, like the time-series store, so two FIPS joined to the same geocodes
+    county (e.g. a county and an independent city of the same name) are both counted, and
+    the counties without a FIPS are keyed on their names. The population of such a geocodes
+    county is only counted once in the totals. The county totals are kept as one numpy
+    matrix, so an aggregate over any set of counties is a single fancy-indexed sum, and a
+    radius query goes through a spatial index over the county centroids.
+
+    Attributes:
+    ===========
+        counties (pd.DataFrame): One row per county with its fips, population, totals and per-100k rates
+        states (pd.DataFrame): One row per state with its population, totals and per-100k rates
+    """
+
+    def __init__(self, df):
+        self.version = df.attrs.get("version")
+
+        # The row of each county on its latest date (its first one if there are several),
+        # found on the facts of a CompactData without expanding them. A county is its FIPS,
+        # or its names (as a negative id) for the rows without a FIPS
+        facts = getattr(df, "facts", df)
+        fips = facts["fips"].to_numpy().astype(np.int64)
+        name_ids = facts.groupby(["county", "state"], sort = False, observed = True).ngroup().to_numpy()
+        county_ids = np.where(fips > 0, fips, -1 - name_ids)
+        order = np.lexsort((-np.arange(len(county_ids)), facts["date"].to_numpy(), county_ids))
+        last = np.append(county_ids[order][1:] != county_ids[order][:-1], True)
+        latest = order[last]
+
+        counties = df.take(latest)[["county", "state", "fips", "latitude", "longitude",
+                                    "estimated_population"] + STATISTICS].reset_index(drop = True)
+        counties = counties.rename(columns = {"estimated_population": "population"})
+
+        self.values = counties[STATISTICS].to_numpy(dtype = np.int64)
+        self.population = counties["population"].to_numpy(dtype = np.int64)
+        self.latitude = counties["latitude"].to_numpy(dtype = np.float64)
+        self.longitude = counties["longitude"].to_numpy(dtype = np.float64)
+        # The geocodes county of each county, whose population the FIPS joined to it share
+        self.geocode_ids = counties.groupby(["county", "state"], sort = False, observed = True).ngroup().to_numpy()
+
+        rates = per_100k(self.values, self.population[:, np.newaxis])
+        for i, col in enumerate(STATISTICS):
+            counties[col + "_per_100k"] = rates[:, i]
+        self.counties = counties
+
+        states = counties.groupby("state", observed = True)[STATISTICS].sum()
+        geocode_counties = counties.drop_duplicates(["county", "state"])
+        states.insert(0, "population", geocode_counties.groupby("state", observed = True)["population"].sum())
+        states.insert(0, "counties", counties.groupby("state", observed = True).size())
+        rates = per_100k(states[STATISTICS].to_numpy(), states[["population"]].to_numpy())
+        for i, col in enumerate(STATISTICS):
+            states[col + "_per_100k"] = rates[:, i]
+        self.states = states
+
+        self.lookup = build_lookup(counties)
+        self.index = attach_neighbor_table(build_spatial_index(counties))
+
+        # FIPS sorted for the searchsorted lookups of fips()
+        self.fips_order = np.argsort(counties["fips"].to_numpy(), kind = "stable")
+        self.sorted_fips = counties["fips"].to_numpy()[self.fips_order]
+
+    def __summary(self, num_counties, population, totals):
+        """Result of an aggregate query, with the per-100k rates of the totals
+        """
+        rates = per_100k(totals, population)
+
+        summary = {"counties": int(num_counties), "population": int(population)}
+        summary.update({col: int(total) for col, total in zip(STATISTICS, totals)})
+        summary.update({col + "_per_100k": None if np.isnan(rate) else round(float(rate), 2)
+                        for col, rate in zip(STATISTICS, rates)})
+        return summary
+
+    def __summary_of(self, positions):
+        # The population of a geocodes county is counted once, even if several FIPS share it
+        first = np.unique(self.geocode_ids[positions], return_index = True)[1]
+        population = self.population[positions][first].sum()
+        return self.__summary(len(positions), population, self.values[positions].sum(axis = 0))
+
+    def radius(self, county = "Barnstable County, MA", num_miles = 0):
+        """Totals of the counties within num_miles of a county, like the area drawn by make_figure()
+
+        Args:
+        =====
+            county (str): A US county, e.g. 'Barnstable County, MA'
+            num_miles (int): The number of miles between 0 and 1000, 0 is the county alone
+
+        Raises:
+        =======
+            Exception: Error message will show if the county does not exist or the radius is out of range
+
+        Returns:
+        ========
+            summary (dict): The number of counties, their population, the totals of every
+                            statistic and their rates per 100,000 people
+        """
+        county, state = resolve_query(self.lookup, county, num_miles)
+
+        origin = self.lookup.county_rows(county, state)
+        if num_miles == 0:
+            positions = origin
+        else:
+            # The rows of the counties frame, several of them when FIPS share a centroid
+            positions = self.index.query(self.latitude[origin[0]], self.longitude[origin[0]], num_miles)
+
+        return self.__summary_of(positions)
+
+    def state(self, state):
+        """Totals of a state, its name or its abbreviation, see radius() for the result
+        """
+        state = check_state(self.lookup, state)
+        row = self.states.loc[state]
+
+        return self.__summary(row["counties"], row["population"], row[STATISTICS].to_numpy(dtype = np.int64))
+
+    def fips(self, fips):
+        """Totals of a set of counties given by their FIPS, see radius() for the result
+
+        FIPS that are not in the data are ignored, the number of counties found is in the result.
+        """
+        fips = np.unique(np.asarray(fips, dtype = np.int64))
+        positions = np.searchsorted(self.sorted_fips, fips)
+        positions = np.minimum(positions, len(self.sorted_fips) - 1)
+        found = self.sorted_fips[positions] == fips
+
+        return self.__summary_of(self.fips_order[positions[found]])
+
+def build_rollups(df):
+    """Build the per-county and per-state rollups of a dataframe from load_data()
+
+    Args:
+    =====
+        df (pd.DataFrame): A pandas DataFrame from load_data() or load_snapshot(), or a CompactData
+
+    Returns:
+    ========
+        rollups (Rollups): The rollups, answering radius(), state() and fips() queries
+    """
+    return Rollups(df)
+
+def load_aggregate_args():
+    """Utility function to load the command line arguments of the aggregates
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--county",
+                        type = str,
+                        default = None,
+                        help = "Totals around this county, e.g. 'Barnstable County, MA'")
+
+    parser.add_argument("--num_miles",
+                        type = int,
+                        default = 0,
+                        help = "With --county, a number between 0 and 1000")
+
+    parser.add_argument("--state",
+                        type = str,
+                        default = None,
+                        help = "Totals of this state, e.g. 'MA' or 'Massachusetts'")
+
+    parser.add_argument("--fips",
+                        type = int,
+                        nargs = "+",
+                        default = None,
+                        help = "Totals of these counties, e.g. 25001 25017")
+
+    parser.add_argument("--date",
+                        type = str,
+                        default = None,
+                        help = "Use the totals on this date from the time-series store instead of the live data")
+
+    parser.add_argument("--end_date",
+                        type = str,
+                        default = None,
+                        help = "With --date, use the increase from --date to this date")
+
+    add_compact_arg(parser)
+    add_data_args(parser)
+    add_store_args(parser)
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+    args = load_aggregate_args()
+    if args.date is None:
+        merged_df = load_data(args.nytimes_url, args.data_gov_url,
+                              refresh = args.refresh, offline = args.offline,
+                              chunksize = args.chunksize, compact = args.compact)
+    else:
+        merged_df = load_snapshot(args.date, args.end_date, store_from_args(args))
+        if args.compact:
+            merged_df = build_compact(merged_df)
+
+    rollups = build_rollups(merged_df)
+
+    if args.county is not None:
+        summary = rollups.radius(args.county, args.num_miles)
+    elif args.state is not None:
+        summary = rollups.state(args.state)
+    elif args.fips is not None:
+        summary = rollups.fips(args.fips)
+    else:
+        raise Exception("Please specify a --county, a --state or --fips")
+
+    print(json.dumps(summary, indent = 2))
+
+if __name__ == "__main__":
+    main()
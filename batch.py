@@ -0,0 +1,217 @@
+import os
+import re
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from data import load_data
+from export import IMAGE_FORMATS, start_renderer, save_figure
+from lookup import build_lookup
+from neighbors import attach_neighbor_table
+from plot import make_figure
+from spatial import build_spatial_index
+from utils import add_compact_arg, add_data_args
+
+# Data shared by every query in a worker process, set once by __init_worker()
+__worker = {}
+
+def load_queries(path):
+    """Load the queries of a batch from a CSV or JSON Lines file
+
+    Each query has a "county" (e.g. 'Barnstable County, MA'), a "statistic" and a "num_miles",
+    and optionally an "output" path for its figure. A query whose num_miles is not an integer
+    gets an "error" instead, and fails on its own when the batch runs.
+
+    Args:
+    =====
+        path (str): Path of a .csv or .jsonl file
+
+    Raises:
+    =======
+        Exception: Error message will show if a required column is missing
+
+    Returns:
+    ========
+        queries (list): A list of dictionaries, one per query
+    """
+    if path.endswith((".jsonl", ".json")):
+        queries_df = pd.read_json(path, lines = True, dtype = False)
+    else:
+        queries_df = pd.read_csv(path, dtype = str)
+
+    missing = {"county", "statistic", "num_miles"} - set(queries_df.columns)
+    if missing:
+        raise Exception("The queries file is missing the columns: {}".format(", ".join(sorted(missing))))
+
+    if "output" in queries_df.columns:
+        queries_df["output"] = queries_df["output"].where(queries_df["output"].notna(), None)
+
+    # Parsed row by row, so a bad num_miles only fails its own query
+    num_miles = pd.to_numeric(queries_df["num_miles"], errors = "coerce")
+    valid = num_miles.notna() & (num_miles % 1 == 0)
+
+    queries = queries_df.to_dict("records")
+    for query, miles, is_valid in zip(queries, num_miles, valid):
+        if is_valid:
+            query["num_miles"] = int(miles)
+        elif pd.isna(query["num_miles"]):
+            query["error"] = "ValueError: num_miles is missing"
+        else:
+            query["error"] = "ValueError: num_miles must be an integer, not {!r}".format(query["num_miles"])
+    return queries
+
+def output_path(query, output_dir, fmt):
+    """Default output path of a query's figure, e.g. results/middlesex_county_ma_100_miles_cases.png
+
+    Args:
+    =====
+        query (dict): A query from load_queries()
+        output_dir (str): The directory of the figures
+        fmt (str): The file format, e.g. "png", "svg" or "html"
+
+    Returns:
+    ========
+        path (str): The output path
+    """
+    if query.get("output"):
+        return query["output"]
+
+    name = "{}_{}_miles_{}".format(query["county"], query["num_miles"], query["statistic"])
+    name = re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+
+    return os.path.join(output_dir, "{}.{}".format(name, fmt))
+
+def __init_worker(df, fmt):
+    """Keep the dataframe and its indexes in the worker for all of its queries
+    """
+    __worker["df"] = df
+    __worker["index"] = attach_neighbor_table(build_spatial_index(df))
+    __worker["lookup"] = build_lookup(df)
+    # HTML figures need no image renderer, which may not even be installed
+    if fmt in IMAGE_FORMATS:
+        start_renderer()
+
+def __render(query, path):
+    """Render one query to disk, errors are returned instead of raised so the batch keeps going
+    """
+    if query.get("error"):
+        return {"path": path, "build_seconds": 0.0, "write_seconds": 0.0, "error": query["error"]}
+
+    start = time.perf_counter()
+    try:
+        fig = make_figure(__worker["df"], query["county"], query["statistic"], query["num_miles"],
+                          __worker["index"], __worker["lookup"])
+        built = time.perf_counter()
+        save_figure(fig, path)
+        error = None
+    except Exception as e:
+        built = time.perf_counter()
+        error = "{}: {}".format(type(e).__name__, e)
+    end = time.perf_counter()
+
+    return {"path": path, "build_seconds": built - start, "write_seconds": end - built, "error": error}
+
+def run_batch(df, queries, output_dir = "results", fmt = "png", workers = None):
+    """Render every query of a batch to files, fanning the rendering out over a process pool
+
+    Progress and per-query timings are printed as each query finishes.
+
+    Args:
+    =====
+        df (pd.DataFrame): A pandas DataFrame from load_data(), or a CompactData
+        queries (list): Queries from load_queries()
+        output_dir (str): The directory of the figures
+        fmt (str): The file format, e.g. "png", "svg" or "html"
+        workers (int): Number of worker processes
+                       Default is None, which uses one per CPU core
+
+    Returns:
+    ========
+        results (list): One dictionary per query with its output path, timings and error (if any)
+    """
+    workers = workers or os.cpu_count()
+    paths = [output_path(query, output_dir, fmt) for query in queries]
+    results = [None] * len(queries)
+
+    def report(i, result):
+        results[i] = dict(queries[i], **result)
+        status = "ERROR {}".format(result["error"]) if result["error"] else result["path"]
+        print("[{}/{}] {}, {}, {} miles: {} (build {:.2f} s, write {:.2f} s)".format(
+              sum(r is not None for r in results), len(queries),
+              queries[i]["county"], queries[i]["statistic"], queries[i]["num_miles"],
+              status, result["build_seconds"], result["write_seconds"]), flush = True)
+
+    if workers == 1:
+        __init_worker(df, fmt)
+        for i, (query, path) in enumerate(zip(queries, paths)):
+            report(i, __render(query, path))
+        return results
+
+    with ProcessPoolExecutor(max_workers = workers, initializer = __init_worker, initargs = (df, fmt)) as pool:
+        futures = {pool.submit(__render, query, path): i for i, (query, path) in enumerate(zip(queries, paths))}
+        for future in as_completed(futures):
+            report(futures[future], future.result())
+
+    return results
+
+def load_batch_args():
+    """Utility function to load the command line arguments of the batch mode
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--queries",
+                        type = str,
+                        required = True,
+                        help = """
+                        A .csv or .jsonl file of queries with the columns
+                        'county', 'statistic', 'num_miles' and optionally 'output'
+                        """)
+
+    parser.add_argument("--output_dir",
+                        type = str,
+                        default = "results",
+                        help = "The directory of the figures")
+
+    parser.add_argument("--format",
+                        type = str,
+                        default = "png",
+                        help = "The file format of the figures, e.g. 'png', 'svg' or 'html'")
+
+    parser.add_argument("--workers",
+                        type = int,
+                        default = None,
+                        help = "Number of worker processes, defaults to the number of CPU cores")
+
+    add_compact_arg(parser)
+    add_data_args(parser)
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+    args = load_batch_args()
+
+    start = time.perf_counter()
+    merged_df = load_data(args.nytimes_url, args.data_gov_url,
+                          refresh = args.refresh, offline = args.offline,
+                          chunksize = args.chunksize, compact = args.compact)
+    queries = load_queries(args.queries)
+    print("Loaded {:,} rows and {:,} queries in {:.2f} s".format(len(merged_df), len(queries), time.perf_counter() - start))
+
+    start = time.perf_counter()
+    results = run_batch(merged_df, queries, args.output_dir, args.format, args.workers)
+    elapsed = time.perf_counter() - start
+
+    failed = sum(result["error"] is not None for result in results)
+    print("Rendered {:,} figures in {:.2f} s ({:.1f} per second), {:,} failed".format(
+          len(results) - failed, elapsed, len(results) / elapsed, failed))
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
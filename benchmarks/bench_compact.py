@@ -0,0 +1,131 @@
+"""Check and benchmark of the compact layout (load_data(compact = True)) against the merged dataframe
+
+On a synthetic dataset (see benchmarks/synthetic.py), builds the lookup and spatial index
+of both layouts and checks that they answer the same: the rows of every county, the rows
+of radius queries and their expansion with take(), the rollups of aggregate.py and the
+figures of make_figure() on the latest date (when the geometry cache has been built).
+Then compares their memory and the time of a radius query with the rows it selects.
+Exits with status 1 when the layouts disagree.
+
+    python benchmarks/bench_compact.py --rows 1000000 --queries 200 --num_miles 100
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aggregate import build_rollups
+from compact import build_compact, memory_report
+from data import NUMERIC_COLS, load_data
+from geometry import GEOMETRY_DIR, load_state_fips
+from lookup import build_lookup
+from plot import make_figure
+from spatial import build_spatial_index
+
+from synthetic import make_dataset
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def same_rows(expected, actual):
+    """Whether the rows of the compact layout hold the values of the merged rows
+    """
+    if list(expected.columns) != list(actual.columns) or len(expected) != len(actual):
+        return False
+    for col in expected.columns:
+        if col in NUMERIC_COLS:
+            if not np.array_equal(expected[col].to_numpy(dtype = np.int64), actual[col].to_numpy(dtype = np.int64)):
+                return False
+        elif not np.array_equal(np.asarray(expected[col]), np.asarray(actual[col])):
+            return False
+    return True
+
+def time_queries(df, index, origins, num_miles):
+    """Seconds per radius query, selecting its rows with df.take()
+    """
+    start = time.perf_counter()
+    for lat, lon in origins:
+        df.take(index.query(lat, lon, num_miles))
+    return (time.perf_counter() - start) / len(origins)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type = int, default = 1000000, help = "Number of rows of the synthetic counties file")
+    parser.add_argument("--queries", type = int, default = 200, help = "Number of random radius queries")
+    parser.add_argument("--num_miles", type = int, default = 100, help = "Radius of the queries")
+    parser.add_argument("--data_dir", type = str, default = os.path.join(ROOT, "data", "synthetic"),
+                        help = "Where the synthetic files are generated and kept")
+    parser.add_argument("--seed", type = int, default = 0, help = "Random seed")
+    args = parser.parse_args()
+
+    counties_path, geocodes_path = make_dataset(args.data_dir, args.rows, args.seed)
+    failures = []
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        df = load_data(counties_path, geocodes_path, cache_dir = cache_dir)
+        # From the cache written by the first call, like a second run of plot.py --compact
+        data = load_data(counties_path, geocodes_path, cache_dir = cache_dir, compact = True)
+
+    report = memory_report(df, data)
+    print("{:,} rows, {:,} counties, {:.1f} MB merged, {:.1f} MB compact ({:.0%} less)\n".format(
+          report["rows"], report["counties"], report["current_mb"], report["compact_mb"], report["reduction"]))
+
+    lookup, compact_lookup = build_lookup(df), build_lookup(data)
+    index, compact_index = build_spatial_index(df), build_spatial_index(data)
+
+    if lookup.counties != compact_lookup.counties or \
+       any(not np.array_equal(rows, compact_lookup.rows[key]) for key, rows in lookup.rows.items()):
+        failures.append("lookup")
+
+    rng = np.random.default_rng(args.seed)
+    picks = sorted(lookup.counties.values())
+    picks = [picks[i] for i in rng.integers(0, len(picks), args.queries)]
+    origins = [(df["latitude"].iat[lookup.county_rows(county, state)[0]],
+                df["longitude"].iat[lookup.county_rows(county, state)[0]]) for county, state in picks]
+
+    for lat, lon in origins:
+        rows = index.query(lat, lon, args.num_miles)
+        if not np.array_equal(rows, compact_index.query(lat, lon, args.num_miles)):
+            failures.append("radius query")
+            break
+    if not same_rows(df.iloc[rows].reset_index(drop = True), data.take(rows)):
+        failures.append("take")
+
+    rollups, compact_rollups = build_rollups(df), build_rollups(data)
+    for county, state in picks[:20]:
+        name = "{} County, {}".format(county, state)
+        if rollups.radius(name, args.num_miles) != compact_rollups.radius(name, args.num_miles) or \
+           rollups.state(state) != compact_rollups.state(state):
+            failures.append("rollups")
+            break
+
+    if os.path.isdir(GEOMETRY_DIR) and load_state_fips(GEOMETRY_DIR):
+        # One date, like the live data, the history has too many levels of values for a figure
+        latest = df[df["date"] == df["date"].max()].reset_index(drop = True)
+        compact_latest = build_compact(latest)
+        county, state = latest.loc[0, ["county", "state"]]
+        for num_miles in [0, args.num_miles]:
+            name = "{} County, {}".format(county, state)
+            if make_figure(latest, name, "cases", num_miles).to_json() != \
+               make_figure(compact_latest, name, "cases", num_miles).to_json():
+                failures.append("make_figure ({} miles)".format(num_miles))
+    else:
+        print("No geometry cache, skipping make_figure (python geometry.py builds it)")
+
+    merged_seconds = time_queries(df, index, origins, args.num_miles)
+    compact_seconds = time_queries(data, compact_index, origins, args.num_miles)
+    print("{:<10}{:>18}".format("", "query + rows (ms)"))
+    print("{:<10}{:>18.3f}".format("merged", merged_seconds * 1000))
+    print("{:<10}{:>18.3f}".format("compact", compact_seconds * 1000))
+
+    if failures:
+        print("\nThe compact layout disagrees with the merged dataframe: {}".format(", ".join(failures)))
+        sys.exit(1)
+    print("\nThe compact layout answers like the merged dataframe")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Benchmark and accuracy check of the vectorized distances in distance.py
+
+Compares per-row geopy calls with the vectorized numpy functions on ~3,200 county
+centroids, checks their accuracy against geopy's geodesic(), and times the chunked
+all-pairs distance matrix.
+
+    python benchmarks/bench_distance.py --counties 3200
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import geopy.distance
+from geopy.point import Point
+from geopy.units import kilometers
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from distance import haversine_miles, ellipsoid_miles, destination, distance_matrix
+
+def legacy_surrounding_coords(lat, lon, num_miles):
+    """The original geopy implementation of utils.calculate_surrounding_coords()
+    """
+    start = Point(lat, lon)
+    d = geopy.distance.geodesic()
+    points = [d.destination(start, distance = kilometers(miles = num_miles), bearing = b) for b in (0, 90, 180, 270)]
+    return [p.latitude for p in points], [p.longitude for p in points]
+
+def time_it(func, repeat = 1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counties", type = int, default = 3200, help = "Number of synthetic county centroids")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    lats = rng.uniform(18, 65, args.counties)
+    lons = rng.uniform(-165, -66, args.counties)
+    origin = (42.48, -71.39)
+
+    print("One origin to {:,} counties".format(args.counties))
+    print("{:<28}{:>14}{:>14}{:>10}{:>22}".format("", "geopy (ms)", "numpy (ms)", "speedup", "max error vs geodesic"))
+
+    geodesic_time, geodesic = time_it(lambda: np.array([geopy.distance.geodesic(origin, (a, b)).miles for a, b in zip(lats, lons)]))
+
+    great_circle_time, _ = time_it(lambda: np.array([geopy.distance.great_circle(origin, (a, b)).miles for a, b in zip(lats, lons)]))
+    haversine_time, haversine = time_it(lambda: haversine_miles(origin[0], origin[1], lats, lons), 20)
+    print("{:<28}{:>14.1f}{:>14.3f}{:>9.0f}x{:>16.2f} miles".format("haversine (great_circle)", great_circle_time * 1000, haversine_time * 1000,
+                                                                  great_circle_time / haversine_time, np.abs(haversine - geodesic).max()))
+
+    ellipsoid_time, ellipsoid = time_it(lambda: ellipsoid_miles(origin[0], origin[1], lats, lons), 20)
+    print("{:<28}{:>14.1f}{:>14.3f}{:>9.0f}x{:>16.4f} miles".format("ellipsoid (geodesic)", geodesic_time * 1000, ellipsoid_time * 1000,
+                                                                  geodesic_time / ellipsoid_time, np.abs(ellipsoid - geodesic).max()))
+
+    # Destinations from every county, 4 bearings each, like calculate_surrounding_coords()
+    miles = rng.uniform(1, 1000, args.counties)
+    legacy_time, legacy = time_it(lambda: [legacy_surrounding_coords(a, b, m) for a, b, m in zip(lats, lons, miles)])
+    bearings = np.array([0, 90, 180, 270])
+    vector_time, (lat2, lon2) = time_it(lambda: destination(lats[:, None], lons[:, None], miles[:, None], bearings), 5)
+    legacy_lat = np.array([l[0] for l in legacy])
+    legacy_lon = np.array([l[1] for l in legacy])
+    error = ellipsoid_miles(legacy_lat, legacy_lon, lat2, lon2).max() * 1609.344
+    print("{:<28}{:>14.1f}{:>14.3f}{:>9.0f}x{:>17.4f} meters".format("destination x4 bearings", legacy_time * 1000, vector_time * 1000,
+                                                                    legacy_time / vector_time, error))
+
+    print("\nAll pairs, {0:,} x {0:,} matrix".format(args.counties))
+    for method in ["haversine", "ellipsoid"]:
+        matrix_time, matrix = time_it(lambda: distance_matrix(lats, lons, lats, lons, method = method))
+        print("{:<28}{:>14.1f} ms, {:.0f} MB".format(method, matrix_time * 1000, matrix.nbytes / 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Check and benchmark of fetch.py against a local HTTP stand-in of the data sources
+
+The stand-in serves files from a temporary directory like raw.githubusercontent.com and
+data.healthcare.gov would: with ETags, gzip, Range requests and keep-alive connections,
+plus a configurable latency, bandwidth and injected failures (503s, dropped connections).
+No network access is needed.
+
+    python benchmarks/bench_fetch.py --size_mb 20
+"""
+import os
+import sys
+import gzip
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fetch import ConnectionPool, download, download_path, fetch_sources
+
+class StandIn:
+    """Local HTTP server standing in for the data sources
+
+    Attributes:
+    ===========
+        latency (float): Seconds before every response
+        bandwidth (float): Bytes per second of the response bodies, None is unlimited
+        fail_next (int): Number of upcoming requests answered with a 503
+        drop_next (int): Number of upcoming responses whose connection drops halfway
+        requests (list): (path, status, body bytes sent) of every request
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.latency = 0.0
+        self.bandwidth = None
+        self.fail_next = 0
+        self.drop_next = 0
+        self.requests = []
+        self.lock = threading.Lock()
+
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                standin.handle(self)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __send(self, handler, status, headers, body):
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+
+        with self.lock:
+            drop = self.drop_next > 0 and len(body) > 0
+            self.drop_next -= drop
+        sent = body[:len(body) // 2] if drop else body
+        step = 1 << 16
+        for start in range(0, len(sent), step):
+            handler.wfile.write(sent[start:start + step])
+            if self.bandwidth:
+                time.sleep(step / self.bandwidth)
+        if drop:
+            handler.close_connection = True
+        self.requests.append((handler.path, status, len(sent)))
+
+    def handle(self, handler):
+        time.sleep(self.latency)
+        with self.lock:
+            fail = self.fail_next > 0
+            self.fail_next -= fail
+        if fail:
+            return self.__send(handler, 503, {}, b"")
+
+        path = os.path.join(self.directory, handler.path.lstrip("/"))
+        if not os.path.isfile(path):
+            return self.__send(handler, 404, {}, b"")
+        with open(path, "rb") as f:
+            body = f.read()
+        etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:16])
+
+        headers = {"ETag": etag}
+        if "gzip" in handler.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel = 1)
+            headers["Content-Encoding"] = "gzip"
+            headers["ETag"] = etag = etag[:-1] + '-gzip"'
+
+        if handler.headers.get("If-None-Match") == etag:
+            return self.__send(handler, 304, {"ETag": etag}, b"")
+
+        range_header = handler.headers.get("Range")
+        if range_header and handler.headers.get("If-Range", etag) == etag:
+            start = int(range_header.split("=")[1].split("-")[0])
+            if start >= len(body):
+                return self.__send(handler, 416, {}, b"")
+            headers["Content-Range"] = "bytes {}-{}/{}".format(start, len(body) - 1, len(body))
+            return self.__send(handler, 206, headers, body[start:])
+
+        return self.__send(handler, 200, headers, body)
+
+def make_csv(path, size_mb, seed = 0):
+    """Write a CSV of about size_mb MB shaped like the NY Times counties data
+    """
+    rng = np.random.default_rng(seed)
+    rows = int(size_mb * 1e6 / 50)
+    counties = rng.integers(0, 3200, rows)
+    with open(path, "w") as f:
+        f.write("date,county,state,fips,cases,deaths\n")
+        for county, cases in zip(counties, rng.integers(0, 100000, rows)):
+            f.write("2020-09-01,County {0},State {1},{2},{3},{4}\n".format(county, county % 55, 1000 + county, cases, cases // 50))
+
+def same_file(a, b):
+    with open(a, "rb") as f, open(b, "rb") as g:
+        return f.read() == g.read()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size_mb", type = float, default = 20, help = "Size of each synthetic source file in MB")
+    parser.add_argument("--latency", type = float, default = 0.2, help = "Seconds of latency of the stand-in server")
+    parser.add_argument("--bandwidth_mb", type = float, default = 20, help = "Bandwidth of the stand-in server in MB/s")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        served = os.path.join(tmp, "served")
+        downloads = os.path.join(tmp, "downloads")
+        os.makedirs(served)
+        for name in ["us-counties.csv", "geocodes.csv"]:
+            make_csv(os.path.join(served, name), args.size_mb)
+
+        standin = StandIn(served)
+        urls = [standin.url + "/us-counties.csv", standin.url + "/geocodes.csv"]
+        total_mb = sum(os.path.getsize(os.path.join(served, name)) for name in os.listdir(served)) / 1e6
+        print("Stand-in at {} serving {:.0f} MB, latency {} s, bandwidth {} MB/s".format(
+              standin.url, total_mb, args.latency, args.bandwidth_mb))
+
+        standin.latency = args.latency
+        standin.bandwidth = args.bandwidth_mb * 1e6
+
+        # One after the other, uncompressed, like pd.read_csv/read_json on the URLs
+        start = time.perf_counter()
+        for url in urls:
+            with open(os.path.join(tmp, "sequential"), "wb") as f:
+                connection = ConnectionPool().get("http", url.split("/")[2])
+                connection.request("GET", "/" + url.rsplit("/", 1)[1])
+                f.write(connection.getresponse().read())
+                connection.close()
+        sequential = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = fetch_sources(urls, downloads)
+        parallel = time.perf_counter() - start
+        sent = sum(size for _, _, size in standin.requests[-2:]) / 1e6
+        print("{:<44}{:>8.2f} s".format("Sequential, uncompressed", sequential))
+        print("{:<44}{:>8.2f} s ({:.1f} MB over the wire)".format("fetch_sources(), parallel and gzip", parallel, sent))
+        assert all(same_file(result["path"], os.path.join(served, url.rsplit("/", 1)[1])) for url, result in results.items())
+
+        start = time.perf_counter()
+        results = fetch_sources(urls, downloads)
+        print("{:<44}{:>8.2f} s ({})".format("Again, unchanged", time.perf_counter() - start,
+                                            ", ".join(sorted({r["status"] for r in results.values()}))))
+
+        standin.latency = 0
+        standin.bandwidth = None
+
+        # Two 503s, then success
+        url = urls[0]
+        path = download_path(url, os.path.join(tmp, "retry"))
+        standin.fail_next = 2
+        result = download(url, path, backoff = 0.05)
+        statuses = [status for _, status, _ in standin.requests[-3:]]
+        print("{:<44}{:>10} {}".format("Retries after 503s", result["status"], statuses))
+        assert result["status"] == "downloaded" and same_file(path, os.path.join(served, "us-counties.csv"))
+
+        # The connection drops halfway, the retry resumes with a Range request
+        path = download_path(url, os.path.join(tmp, "resume"))
+        standin.drop_next = 1
+        result = download(url, path, backoff = 0.05)
+        (_, first, first_bytes), (_, second, second_bytes) = standin.requests[-2:]
+        print("{:<44}{:>10} [{} {:,} bytes, {} {:,} bytes]".format("Resume after a dropped connection", result["status"],
+                                                                   first, first_bytes, second, second_bytes))
+        assert second == 206 and same_file(path, os.path.join(served, "us-counties.csv"))
+
+        # The server is gone, the last good copy is used
+        standin.stop()
+        result = download(url, path, retries = 1, backoff = 0.05)
+        print("{:<44}{:>10} ({})".format("Server down", result["status"], result["error"]))
+        assert result["status"] == "fallback"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Benchmark of the peak memory of load_data(), reading the whole file vs streaming it in chunks
+
+Generates a synthetic NY Times style counties file and a matching geocodes file, then runs
+load_data() in a fresh process for each mode and reports its wall time and peak RSS.
+
+    python benchmarks/bench_ingest.py --rows 5000000 --chunksizes 100000 500000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data import NUMERIC_COLS, load_data
+from utils import load_state_abbrevs
+
+def make_files(counties_path, geocodes_path, rows, num_counties = 3200, seed = 0):
+    """Write a synthetic NY Times style counties CSV and a geocodes JSON covering its counties
+
+    Args:
+    =====
+        counties_path (str): Where to write the counties CSV
+        geocodes_path (str): Where to write the geocodes JSON
+        rows (int): Number of rows of the counties CSV
+        num_counties (int): Number of distinct counties
+        seed (int): Random seed
+    """
+    rng = np.random.default_rng(seed)
+    abbrevs = list(load_state_abbrevs().items())
+    county_ids = np.arange(num_counties)
+    state_ids = county_ids % len(abbrevs)
+
+    geocodes = [{"county": "County {}".format(i), "state": abbrevs[s][0],
+                 "latitude": float(rng.uniform(25, 49)), "longitude": float(rng.uniform(-124, -67)),
+                 "estimated_population": int(rng.integers(1000, 100000))}
+                for i, s in zip(county_ids, state_ids)]
+    with open(geocodes_path, "w") as f:
+        json.dump(geocodes, f)
+
+    ids = rng.integers(0, num_counties, rows)
+    dates = pd.date_range("2020-01-21", periods = max(rows // num_counties, 1)).strftime("%Y-%m-%d")
+    df = pd.DataFrame({"date": np.sort(np.asarray(dates)[rng.integers(0, len(dates), rows)]),
+                       "county": pd.Categorical.from_codes(ids, ["County {}".format(i) for i in county_ids]),
+                       "state": pd.Categorical.from_codes(state_ids[ids], [name for _, name in abbrevs]),
+                       "fips": 1000 + ids})
+    for col in NUMERIC_COLS[1:]:
+        values = rng.integers(0, 100000, rows).astype("float64")
+        values[rng.random(rows) < 0.3] = np.nan
+        df[col] = values
+    df.to_csv(counties_path, index = False)
+
+def measure(counties_path, geocodes_path, chunksize, cache_dir):
+    """Run load_data() in a fresh process, so its peak RSS only covers one load
+
+    Returns:
+    ========
+        elapsed (float): Wall time of load_data() in seconds
+        rows (int): Number of rows loaded
+        peak (float): Peak RSS of the process in MB
+    """
+    single = json.dumps([counties_path, geocodes_path, chunksize, cache_dir])
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--single", single],
+                            check = True, capture_output = True, text = True).stdout
+    return json.loads(output)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type = int, default = 5000000, help = "Number of synthetic rows")
+    parser.add_argument("--chunksizes", type = int, nargs = "+", default = [100000, 500000], help = "Chunk sizes to compare")
+    parser.add_argument("--single", type = str, default = None, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        counties_path, geocodes_path, chunksize, cache_dir = json.loads(args.single)
+        start = time.perf_counter()
+        df = load_data(counties_path, geocodes_path, cache_dir = cache_dir, chunksize = chunksize)
+        elapsed = time.perf_counter() - start
+        print(json.dumps([elapsed, len(df), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024]))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        counties_path = os.path.join(tmp, "us-counties.csv")
+        geocodes_path = os.path.join(tmp, "geocodes.json")
+        make_files(counties_path, geocodes_path, args.rows)
+        print("Counties file: {:,} rows, {:.0f} MB".format(args.rows, os.path.getsize(counties_path) / 1e6))
+
+        print("{:<24}{:>12}{:>14}{:>16}".format("", "rows", "time (s)", "peak RSS (MB)"))
+        for chunksize in [None] + args.chunksizes:
+            cache_dir = os.path.join(tmp, "cache_{}".format(chunksize))
+            elapsed, rows, peak = measure(counties_path, geocodes_path, chunksize, cache_dir)
+            label = "whole file" if chunksize is None else "chunks of {:,}".format(chunksize)
+            print("{:<24}{:>12,}{:>14.2f}{:>16.0f}".format(label, rows, elapsed, peak))
+
+if __name__ == "__main__":
+    main()
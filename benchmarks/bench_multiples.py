@@ -0,0 +1,92 @@
+"""Benchmark of rendering many maps of the same counties: one figure per map vs a shared base map
+
+Times building and serializing N maps of the counties around a county, with one
+create_choropleth() figure per map (what plot() does) and with multiples.BaseMap, which
+builds the shapes and layout once and only recolors the counties, as small multiples and
+as the frames of an animation. Values are random and change for a fraction of the
+counties from one frame to the next. Needs the geometry cache (python geometry.py).
+
+    python benchmarks/bench_multiples.py --frames 300 --num_miles 200
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+import plotly.io as pio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geometry import create_choropleth, simplify_level
+from multiples import BaseMap
+from plot import RADIUS_CHOROPLETH_STYLE
+from spatial import build_spatial_index
+
+from synthetic import load_counties
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type = int, default = 300, help = "Number of maps, e.g. days of an animation")
+    parser.add_argument("--panels", type = int, default = 10, help = "Number of small multiples")
+    parser.add_argument("--num_miles", type = int, default = 200, help = "Radius around Middlesex County, MA")
+    parser.add_argument("--changed", type = float, default = 0.1,
+                        help = "Fraction of the counties whose value changes from one frame to the next")
+    parser.add_argument("--seed", type = int, default = 0, help = "Random seed")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    counties = load_counties()
+    origin = counties.index[(counties["county"] == "Middlesex") & (counties["state"] == "Massachusetts")][0]
+    index = build_spatial_index(counties)
+    fips = counties["fips"].to_numpy()[index.query_counties(counties["latitude"][origin], counties["longitude"][origin],
+                                                            args.num_miles)]
+    scope = counties.loc[counties["fips"].isin(fips), "state"].unique().tolist()
+    level = simplify_level(args.num_miles)
+
+    # Values in 30 levels at most, create_choropleth() needs a color per distinct value
+    values = [rng.integers(0, 30, len(fips))]
+    for _ in range(args.frames - 1):
+        frame = values[-1].copy()
+        changed = rng.random(len(fips)) < args.changed
+        frame[changed] = rng.integers(0, 30, changed.sum())
+        values.append(frame)
+    print("{} counties within {} miles, {} frames, {:.0%} of the values change per frame\n".format(
+          len(fips), args.num_miles, args.frames, args.changed))
+
+    start = time.perf_counter()
+    size = 0
+    for frame in values[:args.panels]:
+        fig = create_choropleth(fips = fips.tolist(), values = frame.tolist(), scope = scope, level = level,
+                                **RADIUS_CHOROPLETH_STYLE)
+        size += len(fig.to_json())
+    per_figure = (time.perf_counter() - start) / args.panels
+    print("{:<48}{:>10.3f} s per map ({:.1f} MB per map)".format("create_choropleth() + to_json()", per_figure,
+                                                                  size / args.panels / 1e6))
+
+    start = time.perf_counter()
+    base = BaseMap(fips, scope, level)
+    base.set_bins(np.concatenate(values))
+    base_seconds = time.perf_counter() - start
+    print("{:<48}{:>10.3f} s once".format("BaseMap()", base_seconds))
+
+    start = time.perf_counter()
+    fig = base.small_multiples([(str(i), base.align(fips, frame)) for i, frame in enumerate(values[:args.panels])])
+    body = pio.to_json(fig, validate = False)
+    seconds = time.perf_counter() - start
+    print("{:<48}{:>10.3f} s per map, {:.1f}x".format("small_multiples() of {} panels + to_json()".format(args.panels),
+                                                     seconds / args.panels, per_figure * args.panels / seconds))
+
+    start = time.perf_counter()
+    fig = base.animation([(str(i), base.align(fips, frame)) for i, frame in enumerate(values)])
+    body = pio.to_json(fig, validate = False)
+    seconds = time.perf_counter() - start
+    frame_bytes = len(json.dumps(json.loads(body)["frames"][1])) if args.frames > 1 else 0
+    print("{:<48}{:>10.3f} s per map, {:.1f}x ({:.3f} MB per frame)".format(
+          "animation() of {} frames + to_json()".format(args.frames), seconds / args.frames,
+          per_figure * args.frames / seconds, frame_bytes / 1e6))
+
+if __name__ == "__main__":
+    main()
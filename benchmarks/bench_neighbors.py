@@ -0,0 +1,69 @@
+"""Benchmark of radius queries from the precomputed neighbor table against the grid index
+
+Builds the neighbor table of the counties of benchmarks/synthetic.py (the real centroids
+when the geometry cache is built) with each number of workers, then times the counties
+within each radius of random counties with CountyGridIndex and with NeighborIndex, and
+checks that both return the same counties.
+
+    python benchmarks/bench_neighbors.py --workers 1 4 --radii 10 100 500 1000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from neighbors import ARRAYS, build_neighbor_table, open_neighbor_table, NeighborIndex
+from spatial import build_spatial_index
+
+from synthetic import load_counties
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type = int, nargs = "+", default = [1, os.cpu_count()],
+                        help = "Numbers of worker processes of the build")
+    parser.add_argument("--radii", type = int, nargs = "+", default = [10, 50, 100, 500, 1000], help = "Radii in miles")
+    parser.add_argument("--queries", type = int, default = 1000, help = "Queries per radius")
+    parser.add_argument("--seed", type = int, default = 0, help = "Random seed")
+    args = parser.parse_args()
+
+    counties = load_counties()
+    index = build_spatial_index(counties)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        neighbors_dir = os.path.join(tmp, "neighbors")
+        for workers in dict.fromkeys(args.workers):
+            start = time.perf_counter()
+            header = build_neighbor_table(counties, neighbors_dir, workers = workers)
+            print("build with {} worker(s){:>24.2f} s".format(workers, time.perf_counter() - start))
+        size = sum(os.path.getsize(os.path.join(neighbors_dir, name + ".npy")) for name in ARRAYS)
+        print("{:,} counties, {:,} pairs within {} miles, {:.1f} MB\n".format(len(counties), header["pairs"],
+                                                                            header["max_miles"], size / 1e6))
+
+        start = time.perf_counter()
+        neighbor_index = NeighborIndex(open_neighbor_table(neighbors_dir), index)
+        print("open and match the table{:>27.2f} ms\n".format((time.perf_counter() - start) * 1e3))
+
+        rng = np.random.default_rng(args.seed)
+        print("{:<10}{:>14}{:>14}{:>10}{:>12}{:>10}".format("miles", "grid ms", "table ms", "speedup", "counties", "same"))
+        for num_miles in args.radii:
+            origins = rng.integers(0, len(index), args.queries)
+            timings = []
+            results = []
+            for spatial_index in (index, neighbor_index):
+                start = time.perf_counter()
+                found = [spatial_index.query_counties(index.latitude[origin], index.longitude[origin], num_miles)
+                         for origin in origins]
+                timings.append((time.perf_counter() - start) / args.queries)
+                results.append(found)
+            same = all(np.array_equal(np.sort(a), np.sort(b)) for a, b in zip(*results))
+            print("{:<10}{:>14.4f}{:>14.4f}{:>9.1f}x{:>12.0f}{:>10}".format(
+                  num_miles, timings[0] * 1e3, timings[1] * 1e3, timings[0] / timings[1],
+                  np.mean([len(found) for found in results[1]]), "yes" if same else "NO"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Benchmark of the NY Times counties and geocodes preprocessing
+
+Generates a synthetic NY Times style counties file and compares the original cell by cell
+preprocessing (applymap) against the column-vectorized preprocessing in data.py. Then does
+the same for a synthetic geocodes file, comparing the original geocodes preprocessing
+(a fillna over every column and a mean over every zip code row) against the one in data.py.
+
+    python benchmarks/bench_preprocess.py --rows 5000000 --geocode_rows 1000000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data
+from utils import load_state_abbrevs
+
+def legacy_preprocess_counties_data(counties_df):
+    """The original cell by cell preprocessing, kept here as the baseline
+    """
+    counties_df.loc[:, "date"] = pd.to_datetime(counties_df.loc[:, 'date'], format = '%Y-%m-%d')
+    counties_df.fillna(0, inplace = True)
+    counties_df.loc[:, data.NUMERIC_COLS] = counties_df.loc[:, data.NUMERIC_COLS].applymap(np.int64)
+    counties_df.loc[:, data.STRING_COLS] = counties_df.loc[:, data.STRING_COLS].applymap(str)
+    return counties_df
+
+def legacy_preprocess_geocodes_data(geocode_df):
+    """The original geocodes preprocessing, kept here as the baseline
+
+    The columns of the groupby are selected with a list, a tuple is no longer accepted by pandas
+    """
+    geocode_df = geocode_df[geocode_df.loc[:, "state"] != "AE"]
+    geocode_df.fillna(0, inplace = True)
+    geocode_df.loc[:, "state"] = geocode_df.loc[:, "state"].map(load_state_abbrevs())
+    geocode_df.loc[:, "state"].dropna(inplace = True)
+    geocode_df = geocode_df[geocode_df.loc[:, "county"] != 0]
+    small_geocode = geocode_df.groupby(["county", "state"], as_index = False)[["latitude", "longitude", "estimated_population"]].mean()
+    small_geocode.loc[:, "county"] = small_geocode.loc[:, "county"].replace({"BayamÃƒÂ³n": "Bayamon"})
+    small_geocode.loc[:, "county"] = small_geocode.loc[:, "county"].replace({"CataÃƒÂ±o": "Catano"})
+    small_geocode.loc[:, "county"] = small_geocode.loc[:, "county"].replace({"CanÃƒÂ³vanas": "Canovanas"})
+    small_geocode.loc[:, "estimated_population"] = small_geocode.loc[:, "estimated_population"].round(0).astype(int)
+    return small_geocode
+
+def make_counties_file(path, rows, num_counties = 3200, seed = 0):
+    """Write a synthetic NY Times style counties CSV
+
+    Args:
+    =====
+        path (str): Where to write the CSV
+        rows (int): Number of rows
+        num_counties (int): Number of distinct counties
+        seed (int): Random seed
+    """
+    rng = np.random.default_rng(seed)
+    county_ids = rng.integers(0, num_counties, rows)
+    dates = pd.date_range("2020-01-21", periods = max(rows // num_counties, 1)).strftime("%Y-%m-%d")
+
+    df = pd.DataFrame({"date": np.asarray(dates)[rng.integers(0, len(dates), rows)],
+                       "county": pd.Categorical.from_codes(county_ids, ["County {}".format(i) for i in range(num_counties)]),
+                       "state": pd.Categorical.from_codes(county_ids % 55, ["State {}".format(i) for i in range(55)]),
+                       "fips": 1000 + county_ids})
+    for col in data.NUMERIC_COLS[1:]:
+        values = rng.integers(0, 100000, rows).astype("float64")
+        # The NY Times data has many missing confirmed/probable values
+        values[rng.random(rows) < 0.3] = np.nan
+        df[col] = values
+    df.loc[rng.random(rows) < 0.01, "fips"] = np.nan
+    df.to_csv(path, index = False)
+
+def make_geocodes_file(path, rows, num_counties = 3200, seed = 0):
+    """Write a synthetic geocodes JSON like the data.healthcare.gov one, one row per zip code
+
+    Args:
+    =====
+        path (str): Where to write the JSON
+        rows (int): Number of zip code rows
+        num_counties (int): Number of distinct counties
+        seed (int): Random seed
+    """
+    rng = np.random.default_rng(seed)
+    abbrevs = list(load_state_abbrevs())
+    county_ids = rng.integers(0, num_counties, rows)
+    names = ["County {}".format(i) for i in range(num_counties)]
+    # A few mangled Puerto Rico names, as in the real data
+    names[:3] = ["BayamÃƒÂ³n", "CataÃƒÂ±o", "CanÃƒÂ³vanas"]
+
+    df = pd.DataFrame({"zip": np.arange(rows).astype(str),
+                       "county": np.asarray(names, dtype = object)[county_ids],
+                       "state": np.asarray(abbrevs, dtype = object)[county_ids % len(abbrevs)],
+                       "latitude": rng.uniform(25, 49, rows),
+                       "longitude": rng.uniform(-124, -67, rows),
+                       "estimated_population": rng.integers(0, 50000, rows).astype("float64")})
+    # Military bases, rows without a county or a population, and unknown states
+    df.loc[rng.random(rows) < 0.01, "state"] = "AE"
+    df.loc[rng.random(rows) < 0.01, "county"] = None
+    df.loc[rng.random(rows) < 0.05, "estimated_population"] = np.nan
+    df.loc[rng.random(rows) < 0.01, "state"] = "XX"
+    df.to_json(path, orient = "records")
+
+def time_it(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type = int, default = 5000000, help = "Number of synthetic rows")
+    parser.add_argument("--geocode_rows", type = int, default = 1000000, help = "Number of synthetic geocodes rows")
+    parser.add_argument("--skip_legacy", action = "store_true", help = "Only time the vectorized path")
+    args = parser.parse_args()
+
+    preprocess = getattr(data, "__preprocess_counties_data")
+    preprocess_geocodes = getattr(data, "__preprocess_geocodes_data")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "us-counties.csv")
+        make_counties_file(path, args.rows)
+
+        results = {}
+
+        if not args.skip_legacy:
+            read_time, df = time_it(lambda: pd.read_csv(path))
+            prep_time, _ = time_it(lambda: legacy_preprocess_counties_data(df))
+            results["before"] = (read_time, prep_time)
+
+        read_time, df = time_it(lambda: pd.read_csv(path, dtype = data.COUNTIES_DTYPES, parse_dates = ["date"]))
+        prep_time, _ = time_it(lambda: preprocess(df))
+        results["after"] = (read_time, prep_time)
+
+        geocodes_path = os.path.join(tmp, "geocodes.json")
+        make_geocodes_file(geocodes_path, args.geocode_rows)
+
+        geocode_results = {}
+
+        if not args.skip_legacy:
+            read_time, df = time_it(lambda: pd.read_json(geocodes_path))
+            prep_time, legacy = time_it(lambda: legacy_preprocess_geocodes_data(df))
+            geocode_results["before"] = (read_time, prep_time)
+
+        read_time, df = time_it(lambda: pd.read_json(geocodes_path, dtype = data.GEOCODES_DTYPES))
+        prep_time, geocode_df = time_it(lambda: preprocess_geocodes(df))
+        geocode_results["after"] = (read_time, prep_time)
+
+    for title, rows, timings in [("counties", args.rows, results), ("geocodes", args.geocode_rows, geocode_results)]:
+        print("{:<10}{:>12}{:>16}{:>21}{:>25}".format(title, "read (s)", "preprocess (s)", "preprocess rows/s",
+                                                      "read+preprocess rows/s"))
+        for name, (read_time, prep_time) in timings.items():
+            print("{:<10}{:>12.2f}{:>16.2f}{:>21,.0f}{:>25,.0f}".format(name, read_time, prep_time,
+                                                                       rows / prep_time,
+                                                                       rows / (read_time + prep_time)))
+        print()
+
+    if not args.skip_legacy:
+        print("{:,} geocodes counties before, {:,} after".format(len(legacy), len(geocode_df)))
+
+if __name__ == "__main__":
+    main()
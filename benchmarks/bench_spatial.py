@@ -0,0 +1,94 @@
+"""Benchmark of radius queries
+
+Compares the original bounding-box scan over the whole merged dataframe (four comparisons
+against the N/E/S/W points from utils.calculate_surrounding_coords) with the grid index in
+spatial.py, for radii from 1 to 1000 miles.
+
+    python benchmarks/bench_spatial.py --counties 3200 --days 1
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from spatial import build_spatial_index, haversine_miles
+from utils import calculate_surrounding_coords
+
+RADII = [1, 10, 50, 100, 250, 500, 1000]
+
+def make_merged_frame(num_counties, days, seed = 0):
+    """Synthetic merged dataframe with counties scattered over the contiguous US
+
+    Args:
+    =====
+        num_counties (int): Number of distinct counties
+        days (int): Number of rows per county
+        seed (int): Random seed
+
+    Returns:
+    ========
+        df (pd.DataFrame): A dataframe shaped like the output of load_data()
+    """
+    rng = np.random.default_rng(seed)
+    latitude = rng.uniform(25, 49, num_counties)
+    longitude = rng.uniform(-125, -67, num_counties)
+
+    county_ids = np.tile(np.arange(num_counties), days)
+    return pd.DataFrame({"county": pd.Categorical(["County {}".format(i) for i in county_ids]),
+                         "state": pd.Categorical(["State {}".format(i % 50) for i in county_ids]),
+                         "fips": 1000 + county_ids,
+                         "cases": rng.integers(0, 100000, len(county_ids)),
+                         "latitude": latitude[county_ids],
+                         "longitude": longitude[county_ids]})
+
+def bounding_box(df, sample, num_miles):
+    lat, lon = calculate_surrounding_coords(sample, num_miles)
+    return df[(df.latitude < lat[0]) & (df.latitude > lat[2]) & (df.longitude > lon[3]) & (df.longitude < lon[1])]
+
+def time_per_query(func, origins, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for origin in origins:
+            result = func(origin)
+    return (time.perf_counter() - start) / (repeat * len(origins)), result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counties", type = int, default = 3200, help = "Number of synthetic counties")
+    parser.add_argument("--days", type = int, default = 1, help = "Number of rows per county")
+    parser.add_argument("--queries", type = int, default = 50, help = "Number of random origins per radius")
+    args = parser.parse_args()
+
+    df = make_merged_frame(args.counties, args.days)
+
+    start = time.perf_counter()
+    index = build_spatial_index(df)
+    print("{:,} rows, {:,} counties, index built in {:.1f} ms\n".format(len(df), len(index), (time.perf_counter() - start) * 1000))
+
+    rng = np.random.default_rng(1)
+    origins = [df.iloc[[i]] for i in rng.integers(0, args.counties, args.queries)]
+
+    print("{:>8}{:>14}{:>14}{:>10}{:>12}{:>12}".format("miles", "bbox (ms)", "index (ms)", "speedup", "bbox rows", "index rows"))
+    for num_miles in RADII:
+        box_time, box = time_per_query(lambda sample: bounding_box(df, sample, num_miles), origins, 1)
+        index_time, rows = time_per_query(lambda sample: df.iloc[index.query(sample["latitude"].values[0],
+                                                                             sample["longitude"].values[0],
+                                                                             num_miles)],
+                                          origins, 3)
+
+        # The index has to agree with a brute-force great-circle filter
+        sample = origins[-1]
+        distances = haversine_miles(sample["latitude"].values[0], sample["longitude"].values[0],
+                                    df["latitude"].to_numpy(), df["longitude"].to_numpy())
+        assert len(rows) == int((distances <= num_miles).sum())
+
+        print("{:>8}{:>14.3f}{:>14.3f}{:>9.1f}x{:>12,}{:>12,}".format(num_miles, box_time * 1000, index_time * 1000,
+                                                                    box_time / index_time, len(box), len(rows)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Startup time of plot.py against its budget
+
+Runs plot.py in fresh processes, the way it is used from the command line, on a synthetic
+dataset (see benchmarks/synthetic.py) and a prebuilt snapshot of it:
+
+    help              python plot.py --help
+    bad_statistic     an unknown --statistic, rejected by the argument parser
+    bad_county        a misspelled --county, rejected with suggestions from the prebuilt lookup
+    cached_query      a PNG answered from the figure cache, with --prebuilt
+    prebuilt_query    an HTML figure built from the prebuilt snapshot (not budgeted)
+    cold_query        an HTML figure built from the source files (not budgeted)
+
+Exits with status 1 when the median of a budgeted scenario is over its budget.
+
+    python benchmarks/bench_startup.py --repeat 5
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+from synthetic import make_dataset
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds, median of the runs
+BUDGETS = {"help": 0.2,
+           "bad_statistic": 0.2,
+           "bad_county": 0.4,
+           "cached_query": 0.4}
+
+def run(args, importtime = False):
+    """Run plot.py, returning its wall time and the slowest imports if importtime is set
+    """
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + [os.path.join(ROOT, "plot.py")] + args
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd = ROOT, capture_output = True, text = True)
+    seconds = time.perf_counter() - start
+
+    imports = []
+    if importtime:
+        for line in result.stderr.splitlines():
+            if line.startswith("import time:") and "|" in line and "cumulative" not in line:
+                _, cumulative, name = line.split("|")
+                # Top-level imports only, the nested ones are included in their time
+                if not name[1:].startswith(" "):
+                    imports.append((int(cumulative) / 1e6, name.strip()))
+    return seconds, result.returncode, sorted(imports, reverse = True)[:5]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type = int, default = 3000,
+                        help = "Number of rows of the synthetic counties file, the live file has one row per county")
+    parser.add_argument("--repeat", type = int, default = 5, help = "Runs of every scenario, the median is kept")
+    parser.add_argument("--slack", type = float, default = 1.0, help = "Multiplier of the budgets, for slower machines")
+    parser.add_argument("--importtime", action = "store_true", help = "Show the slowest imports of every scenario")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        counties_path, geocodes_path = make_dataset(tmp, args.rows)
+        data_args = ["--nytimes_url", counties_path, "--data_gov_url", geocodes_path]
+        prebuilt_args = data_args + ["--prebuilt", os.path.join(tmp, "prebuilt.bin")]
+        cache_args = ["--figure_cache", os.path.join(tmp, "figures")]
+
+        # A county of the last date, so the query has a figure
+        with open(counties_path, "rb") as f:
+            f.seek(-2000, os.SEEK_END)
+            _, county, state = f.read().decode().splitlines()[-1].split(",")[:3]
+        query = ["--county", "{} County, {}".format(county, state), "--statistic", "cases", "--num_miles", "50"]
+
+        # Builds the prebuilt snapshot and renders the figure into the cache
+        seconds, code, _ = run(query + prebuilt_args + cache_args + ["--output", os.path.join(tmp, "first.png")])
+        if code != 0:
+            raise Exception("plot.py failed to build the prebuilt snapshot and the cached figure")
+        print("{:,} rows, snapshot and cached figure built in {:.1f} s\n".format(args.rows, seconds))
+
+        scenarios = {"help": ["--help"],
+                     "bad_statistic": query[:2] + ["--statistic", "cassse", "--num_miles", "0"],
+                     "bad_county": ["--county", county[:-1] + " County, " + state] + query[2:] + prebuilt_args,
+                     "cached_query": query + prebuilt_args + cache_args + ["--output", os.path.join(tmp, "cached.png")],
+                     "prebuilt_query": query + prebuilt_args + ["--output", os.path.join(tmp, "prebuilt.html")],
+                     "cold_query": query + data_args + ["--output", os.path.join(tmp, "cold.html")]}
+
+        over = 0
+        print("{:<18}{:>10}{:>10}{:>10}".format("", "median s", "budget", "exit"))
+        for name, scenario in scenarios.items():
+            runs = [run(scenario) for _ in range(args.repeat)]
+            median = float(np.median([seconds for seconds, _, _ in runs]))
+            budget = BUDGETS.get(name)
+            budget = None if budget is None else budget * args.slack
+            over += budget is not None and median > budget
+            print("{:<18}{:>10.3f}{:>10}{:>10}{}".format(name, median, "" if budget is None else "{:.2f}".format(budget),
+                                                        runs[0][1], "  OVER BUDGET" if budget and median > budget else ""))
+            if args.importtime:
+                for seconds, module in run(scenario, importtime = True)[2]:
+                    print("{:<6}{:<30}{:>10.3f}".format("", module, seconds))
+
+    if over:
+        print("\n{} scenario(s) over budget".format(over))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""Benchmark suite of the data and plot pipelines on synthetic data, with a history of the runs
+
+For each scale, generates (once) a synthetic NY Times counties file and geocodes file with
+benchmarks/synthetic.py, then times:
+
+    load_data > ...           load_data() on the local files, without the cache, and each of
+                              its stages (read_csv, preprocess_counties, read_json,
+                              preprocess_geocodes, merge) as marked with profiling.stage()
+    build_lookup              the county and state lookup index
+    build_spatial_index       the spatial index
+    validate                  check_state() and check_county() of existing counties
+    suggest                   check_county() of misspelled counties, which builds the suggestions
+    radius_filter             the rows within --num_miles of random counties
+    make_figure               the whole figure of a county and its radius on the latest date,
+                              when the geometry cache has been built
+
+Every result is appended to a JSON lines history (--history) with the commit, machine and
+library versions, and compared with the previous runs of the same benchmark, scale and
+machine. A result slower than the median of those runs by more than --threshold is flagged
+as a regression.
+
+    python benchmarks/suite.py --scales 1000 100000 1000000 10000000
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import platform
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data import load_data
+from geometry import GEOMETRY_DIR, load_state_fips
+from lookup import build_lookup
+from plot import make_figure
+from profiling import Profiler
+from spatial import build_spatial_index
+from utils import check_county, check_state
+
+from synthetic import make_dataset
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd = ROOT, capture_output = True,
+                              text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def time_calls(function, calls):
+    """Seconds per call of function over calls calls
+    """
+    start = time.perf_counter()
+    for i in range(calls):
+        function(i)
+    return (time.perf_counter() - start) / calls
+
+def run_once(counties_path, geocodes_path, queries, num_miles, with_figure, seed):
+    """One run of every benchmark at one scale
+
+    Returns:
+    ========
+        timings (dict): Benchmark -> (seconds, rows)
+    """
+    timings = {}
+    profiler = Profiler(trace_memory = False)
+    with profiler:
+        with profiler.stage("load_data") as record:
+            df = load_data(counties_path, geocodes_path, cache_dir = None)
+            record["rows"] = len(df)
+    for stage in profiler.summary():
+        timings[stage["stage"]] = (stage["wall_seconds"], stage["rows"])
+
+    start = time.perf_counter()
+    lookup = build_lookup(df)
+    timings["build_lookup"] = (time.perf_counter() - start, len(df))
+
+    start = time.perf_counter()
+    index = build_spatial_index(df)
+    timings["build_spatial_index"] = (time.perf_counter() - start, len(df))
+
+    rng = np.random.default_rng(seed)
+    counties = df[["county", "state"]].drop_duplicates().to_numpy()
+    picks = counties[rng.integers(0, len(counties), queries)]
+
+    timings["validate"] = (time_calls(lambda i: check_county(lookup, picks[i][0], check_state(lookup, picks[i][1])),
+                                      queries), 1)
+
+    def suggest(i):
+        try:
+            check_county(lookup, picks[i][0][:-1] + "x", picks[i][1])
+        except Exception:
+            pass
+    timings["suggest"] = (time_calls(suggest, queries), 1)
+
+    origins = [lookup.county_rows(county, state)[0] for county, state in picks]
+    latitude = df["latitude"].to_numpy()
+    longitude = df["longitude"].to_numpy()
+    rows = []
+    timings["radius_filter"] = (time_calls(lambda i: rows.append(len(index.query(latitude[origins[i]], longitude[origins[i]],
+                                                                                 num_miles))), queries),
+                                int(np.mean(rows)))
+
+    if with_figure:
+        # The figure shows one date, like the live data, the history has too many levels of values
+        latest = df[df["date"] == df["date"].max()].reset_index(drop = True)
+        latest_lookup = build_lookup(latest)
+        latest_index = build_spatial_index(latest)
+        # The last date may only have some of the counties
+        county, state = latest.loc[rng.integers(0, len(latest)), ["county", "state"]]
+        start = time.perf_counter()
+        make_figure(latest, "{} County, {}".format(county, state), "cases", num_miles,
+                    index = latest_index, lookup = latest_lookup)
+        timings["make_figure"] = (time.perf_counter() - start, len(latest))
+
+    return timings
+
+def read_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def compare(result, history, baseline_runs, threshold):
+    """Compare a result with the previous runs of the same benchmark, scale and machine
+
+    Returns:
+    ========
+        baseline (float): The median of the medians of the last baseline_runs runs, None without any
+        regression (bool): Whether the result is slower than the baseline by more than threshold
+    """
+    previous = [record["median_seconds"] for record in history
+                if (record["benchmark"], record["scale"], record["machine"]) ==
+                   (result["benchmark"], result["scale"], result["machine"])]
+    if not previous:
+        return None, False
+    baseline = float(np.median(previous[-baseline_runs:]))
+    return baseline, result["median_seconds"] > baseline * (1 + threshold)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", type = int, nargs = "+", default = [1000, 100000, 1000000],
+                        help = "Numbers of rows of the synthetic counties files, e.g. 1000 to 10000000")
+    parser.add_argument("--repeat", type = int, default = 3, help = "Runs of every benchmark, the median is kept")
+    parser.add_argument("--queries", type = int, default = 200, help = "Queries of the validation and radius benchmarks")
+    parser.add_argument("--num_miles", type = int, default = 50, help = "Radius of the radius and figure benchmarks")
+    parser.add_argument("--data_dir", type = str, default = os.path.join(ROOT, "data", "synthetic"),
+                        help = "Where the synthetic files are generated and kept")
+    parser.add_argument("--history", type = str, default = os.path.join(ROOT, "benchmarks", "results", "history.jsonl"),
+                        help = "JSON lines file the results are appended to")
+    parser.add_argument("--baseline_runs", type = int, default = 5, help = "Number of previous runs to compare with")
+    parser.add_argument("--threshold", type = float, default = 0.2,
+                        help = "Slowdown over the baseline flagged as a regression, 0.2 is 20%%")
+    parser.add_argument("--fail_on_regression", action = "store_true", help = "Exit with status 1 on a regression")
+    parser.add_argument("--seed", type = int, default = 0, help = "Random seed")
+    args = parser.parse_args()
+
+    with_figure = bool(load_state_fips(GEOMETRY_DIR)) if os.path.isdir(GEOMETRY_DIR) else False
+    if not with_figure:
+        print("No geometry cache, skipping make_figure (python geometry.py builds it)")
+
+    history = read_history(args.history)
+    environment = {"run_id": uuid.uuid4().hex[:12],
+                   "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "commit": git_commit(),
+                   "machine": platform.node(),
+                   "platform": platform.platform(),
+                   "python": platform.python_version(),
+                   "versions": {"numpy": np.__version__, "pandas": pd.__version__}}
+
+    results = []
+    regressions = 0
+    for scale in args.scales:
+        counties_path, geocodes_path = make_dataset(args.data_dir, scale, args.seed)
+        runs = [run_once(counties_path, geocodes_path, args.queries, args.num_miles, with_figure, args.seed)
+                for _ in range(args.repeat)]
+
+        print("\n{:,} rows".format(scale))
+        print("{:<36}{:>12}{:>12}{:>14}{:>12}".format("", "median s", "min s", "rows/s", "vs base"))
+        for benchmark in runs[0]:
+            seconds = [run[benchmark][0] for run in runs]
+            rows = runs[0][benchmark][1]
+            median = float(np.median(seconds))
+            result = dict(environment, scale = scale, benchmark = benchmark, repeat = args.repeat, rows = rows,
+                          median_seconds = median, min_seconds = float(np.min(seconds)),
+                          rows_per_second = rows / median if rows and median > 0 else None)
+
+            baseline, regression = compare(result, history, args.baseline_runs, args.threshold)
+            result["baseline_seconds"] = baseline
+            result["regression"] = regression
+            regressions += regression
+            results.append(result)
+
+            change = "" if baseline is None else "{:+.0%}".format(median / baseline - 1)
+            print("{:<36}{:>12.4f}{:>12.4f}{:>14}{:>12}{}".format(
+                  benchmark, median, result["min_seconds"],
+                  "" if result["rows_per_second"] is None else "{:,.0f}".format(result["rows_per_second"]),
+                  change, "  REGRESSION" if regression else ""))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok = True)
+    with open(args.history, "a") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    print("\n{} results appended to {}, {} regression(s)".format(len(results), args.history, regressions))
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
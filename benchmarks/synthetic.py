@@ -0,0 +1,151 @@
+"""Synthetic NY Times counties files and geocodes files for the benchmarks, generated offline
+
+The counties are the real US counties of the geometry cache (names, FIPS and centroids),
+so the merged data can be validated, filtered and plotted like the real data. Without a
+geometry cache, made-up counties are spread over the continental US instead.
+
+    python benchmarks/synthetic.py --rows 1000000 --output_dir data/synthetic
+"""
+import os
+import sys
+import glob
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data import NUMERIC_COLS
+from geometry import GEOMETRY_DIR
+from utils import load_state_abbrevs
+
+def load_counties(geometry_dir = GEOMETRY_DIR, num_counties = 3200, seed = 0):
+    """The counties of the synthetic data
+
+    Args:
+    =====
+        geometry_dir (str): The directory of the geometry cache
+        num_counties (int): Number of made-up counties when there is no geometry cache
+        seed (int): Random seed of the made-up counties
+
+    Returns:
+    ========
+        counties (pd.DataFrame): One row per county with its county, state, fips, latitude and longitude
+    """
+    paths = sorted(glob.glob(os.path.join(geometry_dir, "simplify_*", "*.npz")))
+    if paths:
+        level_dir = os.path.dirname(paths[-1])
+        frames = []
+        for path in sorted(glob.glob(os.path.join(level_dir, "*.npz"))):
+            with np.load(path) as npz:
+                first_centroids = npz["centroid_offsets"][:-1]
+                frames.append(pd.DataFrame({"county": npz["county_names"],
+                                            "state": str(npz["state_name"]),
+                                            "fips": npz["fips"],
+                                            "latitude": npz["centroid_y"][first_centroids].astype(np.float64),
+                                            "longitude": npz["centroid_x"][first_centroids].astype(np.float64)}))
+        return pd.concat(frames, ignore_index = True)
+
+    rng = np.random.default_rng(seed)
+    states = list(load_state_abbrevs().values())
+    ids = np.arange(num_counties)
+    return pd.DataFrame({"county": ["County {}".format(i) for i in ids],
+                         "state": [states[i % len(states)] for i in ids],
+                         "fips": 1000 + ids,
+                         "latitude": rng.uniform(25, 49, num_counties),
+                         "longitude": rng.uniform(-124, -67, num_counties)})
+
+def make_geocodes(path, counties, zips_per_county = 3, seed = 0):
+    """Write a geocodes JSON like the data.healthcare.gov one, with one row per zip code
+
+    Args:
+    =====
+        path (str): Where to write the JSON
+        counties (pd.DataFrame): The counties from load_counties()
+        zips_per_county (int): Number of zip code rows of each county
+        seed (int): Random seed
+    """
+    rng = np.random.default_rng(seed)
+    state_abbrevs = {name: abbrev for abbrev, name in load_state_abbrevs().items()}
+
+    geocodes = counties.loc[counties.index.repeat(zips_per_county)].reset_index(drop = True)
+    geocodes["state"] = geocodes["state"].map(state_abbrevs).fillna("XX")
+    geocodes["latitude"] += rng.normal(0, 0.05, len(geocodes))
+    geocodes["longitude"] += rng.normal(0, 0.05, len(geocodes))
+    geocodes["estimated_population"] = rng.integers(1000, 50000, len(geocodes))
+    geocodes["zip"] = np.arange(len(geocodes)).astype(str)
+
+    geocodes[["zip", "county", "state", "latitude", "longitude", "estimated_population"]].to_json(path, orient = "records")
+
+def make_counties_file(path, counties, rows, seed = 0):
+    """Write a NY Times style counties CSV, one row per county and date sorted by date
+
+    Args:
+    =====
+        path (str): Where to write the CSV
+        counties (pd.DataFrame): The counties from load_counties()
+        rows (int): Number of rows
+        seed (int): Random seed
+    """
+    rng = np.random.default_rng(seed)
+    num_dates = -(-rows // len(counties))
+    ids = np.tile(np.arange(len(counties)), num_dates)[:rows]
+    dates = pd.date_range("2020-01-21", periods = num_dates).strftime("%Y-%m-%d")
+
+    df = pd.DataFrame({"date": pd.Categorical.from_codes(np.arange(rows) // len(counties), dates),
+                       "county": counties["county"].to_numpy()[ids],
+                       "state": counties["state"].to_numpy()[ids],
+                       "fips": counties["fips"].to_numpy(dtype = np.float64)[ids]})
+    # Cumulative numbers that grow with the date
+    growth = (np.arange(rows) // len(counties) + 1).astype(np.float64)
+    for col in NUMERIC_COLS[1:]:
+        values = np.floor(growth * rng.integers(0, 100, rows))
+        # The NY Times data has many missing confirmed/probable values
+        if col.startswith(("confirmed", "probable")):
+            values[rng.random(rows) < 0.3] = np.nan
+        df[col] = values
+    df.loc[rng.random(rows) < 0.001, "fips"] = np.nan
+    df.to_csv(path, index = False, float_format = "%.0f")
+
+def make_dataset(output_dir, rows, seed = 0):
+    """Write a counties CSV and a geocodes JSON, reusing them if they already exist
+
+    Args:
+    =====
+        output_dir (str): The directory of the files
+        rows (int): Number of rows of the counties CSV
+        seed (int): Random seed
+
+    Returns:
+    ========
+        counties_path (str): Path of the counties CSV
+        geocodes_path (str): Path of the geocodes JSON
+    """
+    os.makedirs(output_dir, exist_ok = True)
+    counties_path = os.path.join(output_dir, "us-counties_{}_{}.csv".format(rows, seed))
+    # v2: California, the District of Columbia and the territories have their abbreviations
+    geocodes_path = os.path.join(output_dir, "geocodes_v2_{}.json".format(seed))
+
+    counties = load_counties(seed = seed)
+    if not os.path.exists(geocodes_path):
+        make_geocodes(geocodes_path + ".tmp", counties, seed = seed)
+        os.replace(geocodes_path + ".tmp", geocodes_path)
+    if not os.path.exists(counties_path):
+        make_counties_file(counties_path + ".tmp", counties, rows, seed = seed)
+        os.replace(counties_path + ".tmp", counties_path)
+
+    return counties_path, geocodes_path
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type = int, default = 1000000, help = "Number of rows of the counties CSV")
+    parser.add_argument("--output_dir", type = str, default = "data/synthetic", help = "The directory of the files")
+    parser.add_argument("--seed", type = int, default = 0, help = "Random seed")
+    args = parser.parse_args()
+
+    print(json.dumps(make_dataset(args.output_dir, args.rows, args.seed)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+import os
+import json
+import hashlib
+
+# urllib, pandas and pyarrow are imported by the functions using them, so the modules
+# only needing CACHE_DIR (e.g. the CLI on a figure cache hit) start without them
+
+# Default location of the on-disk cache, next to the scripts
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+MANIFEST_NAME = "manifest.json"
+
+# Bump whenever the preprocessing changes the merged dataframe, so the on-disk cache is rebuilt.
+# It is part of the versions of source_versions(), which the prebuilt snapshot checks
+# without importing the data pipeline
+PREPROCESSING_VERSION = "3"
+
+def is_url(source):
+    """Check whether a data source is a remote URL or a local file path
+
+    Args:
+    =====
+        source (str): A URL link or a path to a local file
+
+    Returns:
+    ========
+        (bool): True if the source is an http(s) URL
+    """
+    return source.startswith(("http://", "https://"))
+
+def source_version(source, timeout = 10):
+    """Get a version string for a data source without downloading it
+
+    Local files are identified by the SHA-256 hash of their content. Remote files
+    are identified by the ETag (or Last-Modified) header returned by a HEAD request.
+
+    Args:
+    =====
+        source (str): A URL link or a path to a local file
+        timeout (int): Number of seconds to wait for the HEAD request
+
+    Returns:
+    ========
+        version (str): The version of the source, or None if the server cannot be reached
+                       or does not provide an ETag or Last-Modified header
+    """
+    if not is_url(source):
+        sha = hashlib.sha256()
+        with open(source, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        return "sha256:" + sha.hexdigest()
+
+    import urllib.error
+    import urllib.request
+
+    # Servers that reject HEAD requests or are unreachable simply have no known version,
+    # in which case the source is refetched
+    request = urllib.request.Request(source, method = "HEAD")
+    try:
+        with urllib.request.urlopen(request, timeout = timeout) as response:
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+    except (urllib.error.URLError, OSError):
+        return None
+
+    if etag is not None:
+        return "etag:" + etag
+    if last_modified is not None:
+        return "last-modified:" + last_modified
+    return None
+
+def source_versions(sources, cache_dir = CACHE_DIR, offline = False):
+    """The local copy and the version of each data source, the versions load_data() keys its cache on
+
+    URL sources are downloaded into cache_dir/downloads (only when they changed, see
+    fetch.fetch_sources()). Offline, they are not contacted and their version is the one
+    of their last download, from the manifest.
+
+    Args:
+    =====
+        sources (list): URL links or paths to local files
+        cache_dir (str): The directory of the on-disk cache
+        offline (bool): Never contact the network
+
+    Returns:
+    ========
+        paths (dict): The local copy of each source
+        versions (dict): The version of each source and of the preprocessing, None for a URL
+                         that was never downloaded when offline
+    """
+    from fetch import fetch_sources
+    from profiling import stage
+
+    cached_sources = read_manifest(cache_dir).get("sources", {})
+
+    # Local copies of the sources, URLs are only downloaded when online
+    paths = {source: source for source in sources}
+    urls = [source for source in paths if is_url(source)]
+    if urls and not offline:
+        with stage("fetch"):
+            fetched = fetch_sources(urls, os.path.join(cache_dir, "downloads"))
+        for url, result in fetched.items():
+            paths[url] = result["path"]
+            if result["status"] == "fallback":
+                print("Could not download {} ({}), using the last downloaded copy".format(url, result["error"]))
+
+    versions = {}
+    with stage("hash_sources"):
+        for source, path in paths.items():
+            if offline and is_url(source):
+                versions[source] = cached_sources.get(source)
+            else:
+                versions[source] = source_version(path)
+
+    # Cached frames from an older preprocessing step are never reused
+    versions["preprocessing"] = PREPROCESSING_VERSION
+
+    return paths, versions
+
+def dataset_version(versions):
+    """Combine the versions of each data source into a single dataset version
+
+    Args:
+    =====
+        versions (dict): A dictionary mapping each source to its version
+
+    Returns:
+    ========
+        (str): A short hash identifying the combination of source versions
+    """
+    payload = json.dumps(versions, sort_keys = True).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()[:16]
+
+def read_manifest(cache_dir = CACHE_DIR):
+    """Read the cache manifest describing the currently cached dataset
+
+    Args:
+    =====
+        cache_dir (str): The cache directory
+
+    Returns:
+    ========
+        manifest (dict): The manifest, or an empty dictionary if nothing is cached
+    """
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def read_cached(manifest, cache_dir = CACHE_DIR):
+    """Load the cached merged dataframe described by the manifest
+
+    Args:
+    =====
+        manifest (dict): The manifest from read_manifest()
+        cache_dir (str): The cache directory
+
+    Returns:
+    ========
+        df (pd.DataFrame): The cached dataframe, or None if the cache file is missing
+    """
+    if not manifest:
+        return None
+    path = os.path.join(cache_dir, manifest["path"])
+    if not os.path.exists(path):
+        return None
+    import pandas as pd
+    df = pd.read_feather(path)
+    df.attrs["version"] = manifest["version"]
+    return df
+
+def __commit(filename, versions, cache_dir):
+    """Point the manifest to a newly written cache file and remove the older ones
+    """
+    manifest = {"version": dataset_version(versions), "sources": versions, "path": filename}
+    tmp_manifest = os.path.join(cache_dir, MANIFEST_NAME + ".tmp")
+    with open(tmp_manifest, "w") as f:
+        json.dump(manifest, f, indent = 2)
+    os.replace(tmp_manifest, os.path.join(cache_dir, MANIFEST_NAME))
+
+    for name in os.listdir(cache_dir):
+        if name.startswith("merged_") and name.endswith(".feather") and name != filename:
+            os.remove(os.path.join(cache_dir, name))
+
+    return manifest
+
+def write_cached(df, versions, cache_dir = CACHE_DIR):
+    """Store the merged dataframe in the cache as a Feather file and update the manifest
+
+    Older cached datasets are removed so the cache only ever holds the latest version.
+
+    Args:
+    =====
+        df (pd.DataFrame): The merged dataframe from load_data()
+        versions (dict): A dictionary mapping each source to its version
+        cache_dir (str): The cache directory
+
+    Returns:
+    ========
+        manifest (dict): The new manifest
+    """
+    os.makedirs(cache_dir, exist_ok = True)
+
+    filename = "merged_{}.feather".format(dataset_version(versions))
+
+    # Write to a temporary file first so a crash never leaves a half-written cache behind
+    tmp_path = os.path.join(cache_dir, filename + ".tmp")
+    df.reset_index(drop = True).to_feather(tmp_path)
+    os.replace(tmp_path, os.path.join(cache_dir, filename))
+
+    return __commit(filename, versions, cache_dir)
+
+def write_cached_chunks(chunks, versions, cache_dir = CACHE_DIR):
+    """Store the merged dataframe in the cache one chunk at a time, see write_cached()
+
+    Each chunk is appended to the Feather file as it comes, so only one chunk is in memory
+    at a time. The chunks must have the same columns and the same categories, like the
+    ones from data.iter_merged_chunks().
+
+    Args:
+    =====
+        chunks (iterable): The merged dataframe as an iterable of dataframes
+        versions (dict): A dictionary mapping each source to its version
+        cache_dir (str): The cache directory
+
+    Returns:
+    ========
+        manifest (dict): The new manifest
+    """
+    os.makedirs(cache_dir, exist_ok = True)
+
+    import pyarrow as pa
+
+    filename = "merged_{}.feather".format(dataset_version(versions))
+    tmp_path = os.path.join(cache_dir, filename + ".tmp")
+
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk.reset_index(drop = True), preserve_index = False)
+            if writer is None:
+                writer = pa.ipc.new_file(tmp_path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        raise Exception("The NY Times data has no rows matching the geocodes.")
+    os.replace(tmp_path, os.path.join(cache_dir, filename))
+
+    return __commit(filename, versions, cache_dir)
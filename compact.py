@@ -0,0 +1,206 @@
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from data import NUMERIC_COLS, STRING_COLS, load_data
+from utils import add_data_args
+
+# The COVID-19 statistics of every row
+STATISTICS = NUMERIC_COLS[1:]
+
+# Attributes of a county rather than of a row, kept once per county in the dimension table
+GEOCODE_COLS = ["latitude", "longitude", "estimated_population"]
+
+# Single underscore, CompactData would mangle a double one
+def _downcast(values):
+    """The values as uint32 (or int32 when negative), keeping int64 only if they do not fit
+    """
+    if len(values) == 0:
+        return values.astype(np.uint32)
+    low, high = values.min(), values.max()
+    if low >= 0 and high <= np.iinfo(np.uint32).max:
+        return values.astype(np.uint32)
+    if low >= np.iinfo(np.int32).min and high <= np.iinfo(np.int32).max:
+        return values.astype(np.int32)
+    return values
+
+class CompactData:
+    """Compact layout of a dataframe from load_data()
+
+    The merged dataframe repeats the latitude, longitude and population of a county on
+    each of its rows, and stores the FIPS and statistics as int64. Here the rows (facts)
+    only keep the date, county and state as categoricals, the FIPS as int32, the
+    statistics as uint32 and a county_id, the position of the county in a dimension table
+    sorted by FIPS with one row per county and its geocode attributes.
+
+    The numpy arrays of both tables are views, not copies: the spatial index built with
+    build_spatial_index(data) gathers the rows of a radius query with them, and take()
+    expands only those rows back to the merged layout. A CompactData can be passed instead
+    of the merged dataframe to build_lookup(), make_figure() and build_rollups(), see
+    load_data(compact = True).
+
+    Attributes:
+    ===========
+        facts (pd.DataFrame): One row per row of the merged dataframe, in the same order
+        counties (pd.DataFrame): The dimension table, one row per county with its fips, county,
+                                 state, latitude, longitude and estimated_population
+    """
+
+    def __init__(self, df):
+        # The attrs of df (its version, and the dates of a snapshot), like DataFrame.attrs
+        self.attrs = dict(df.attrs)
+        self.version = df.attrs.get("version")
+
+        # A county is a (county, state) pair, some counties have no FIPS (0) in the NY Times data
+        groups = df.groupby(STRING_COLS, sort = False, observed = True)
+        group_ids = groups.ngroup().to_numpy()
+        first_rows = np.unique(group_ids, return_index = True)[1]
+
+        counties = df.iloc[first_rows][STRING_COLS + GEOCODE_COLS].reset_index(drop = True)
+        # The FIPS of a county, when some of its rows have it
+        counties.insert(0, "fips", groups["fips"].max().to_numpy().astype(np.int32))
+        counties["estimated_population"] = _downcast(counties["estimated_population"].to_numpy())
+
+        # Sorted by FIPS for the searchsorted lookups of rows_of_fips()
+        order = np.argsort(counties["fips"].to_numpy(), kind = "stable")
+        self.counties = counties.iloc[order].reset_index(drop = True)
+        positions = np.empty(len(order), dtype = np.int64)
+        positions[order] = np.arange(len(order))
+
+        county_ids = positions[group_ids]
+        id_dtype = np.int16 if len(order) <= np.iinfo(np.int16).max else np.int32
+
+        # There are a few hundred dates at most, their codes take 2 bytes instead of 8
+        facts = {"date": df["date"].astype("category").array}
+        for col in STRING_COLS:
+            facts[col] = df[col].astype("category").array
+        facts["fips"] = df["fips"].to_numpy().astype(np.int32)
+        for col in STATISTICS:
+            facts[col] = _downcast(df[col].to_numpy())
+        facts["county_id"] = county_ids.astype(id_dtype)
+        self.facts = pd.DataFrame(facts)
+        self.facts.attrs["version"] = self.version
+
+    def __len__(self):
+        return len(self.facts)
+
+    def array(self, col):
+        """A column of the facts or, for the geocode attributes, of the dimension table, as a numpy view
+        """
+        if col in GEOCODE_COLS:
+            return self.counties[col].to_numpy()
+        return self.facts[col].to_numpy()
+
+    def rows_of_fips(self, fips):
+        """Row positions of the counties with these FIPS, sorted, to be used with take()
+        """
+        sorted_fips = self.counties["fips"].to_numpy()
+        fips = np.unique(np.asarray(fips, dtype = np.int32))
+        # Counties without a FIPS share the key 0, so a key is a range of the dimension table
+        left = np.searchsorted(sorted_fips, fips, side = "left")
+        right = np.searchsorted(sorted_fips, fips, side = "right")
+        ids = np.concatenate([np.arange(start, stop) for start, stop in zip(left, right)] + [np.empty(0, dtype = np.int64)])
+        return np.flatnonzero(np.isin(self.facts["county_id"].to_numpy(), ids))
+
+    def take(self, rows):
+        """Rows in the merged layout of load_data(), with the geocode attributes gathered from the dimension table
+
+        Args:
+        =====
+            rows (np.ndarray): Row positions, e.g. from CountyGridIndex.query()
+
+        Returns:
+        ========
+            df (pd.DataFrame): The rows, with the columns of the merged dataframe and the compact dtypes
+        """
+        df = self.facts.iloc[rows].reset_index(drop = True)
+        ids = df.pop("county_id").to_numpy()
+        df["date"] = df["date"].to_numpy()
+        for col in GEOCODE_COLS:
+            df[col] = self.counties[col].to_numpy()[ids]
+        df.attrs.update(self.attrs)
+        return df
+
+    def to_frame(self):
+        """The whole dataframe in the merged layout of load_data(), see take()
+        """
+        return self.take(np.arange(len(self.facts)))
+
+def build_compact(df):
+    """Build the compact layout of a dataframe from load_data()
+
+    Args:
+    =====
+        df (pd.DataFrame): A pandas DataFrame from load_data()
+
+    Returns:
+    ========
+        data (CompactData): The facts and the county dimension table
+    """
+    return CompactData(df)
+
+def memory_report(df, data):
+    """Memory of the merged dataframe against its compact layout, column by column
+
+    Args:
+    =====
+        df (pd.DataFrame): A pandas DataFrame from load_data()
+        data (CompactData): Its compact layout from build_compact()
+
+    Returns:
+    ========
+        report (dict): The rows, the bytes of each column in both layouts, and their totals
+    """
+    current = df.memory_usage(index = False, deep = True)
+    facts = data.facts.memory_usage(index = False, deep = True)
+    counties = data.counties.memory_usage(index = False, deep = True)
+
+    columns = []
+    for col in df.columns:
+        compact = int(facts.get(col, 0)) + (int(counties[col]) if col in GEOCODE_COLS else 0)
+        columns.append({"column": col, "dtype": str(df[col].dtype),
+                        "compact_dtype": str((data.counties if col in GEOCODE_COLS else data.facts)[col].dtype),
+                        "current_bytes": int(current[col]), "compact_bytes": compact})
+    columns.append({"column": "county_id", "dtype": None, "compact_dtype": str(data.facts["county_id"].dtype),
+                    "current_bytes": 0, "compact_bytes": int(facts["county_id"])})
+    # The county and state names of the dimension table
+    columns.append({"column": "counties (names, fips)", "dtype": None, "compact_dtype": None, "current_bytes": 0,
+                    "compact_bytes": int(counties[["fips"] + STRING_COLS].sum())})
+
+    current_total = int(current.sum())
+    compact_total = int(facts.sum() + counties.sum())
+    return {"rows": len(df),
+            "counties": len(data.counties),
+            "columns": columns,
+            "current_mb": current_total / 1e6,
+            "compact_mb": compact_total / 1e6,
+            "reduction": 1 - compact_total / current_total if current_total else 0.0}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--json",
+                        action = "store_true",
+                        help = "Print the report as JSON")
+    add_data_args(parser)
+    args = parser.parse_args()
+
+    df = load_data(args.nytimes_url, args.data_gov_url, refresh = args.refresh, offline = args.offline,
+                   chunksize = args.chunksize)
+    report = memory_report(df, build_compact(df))
+
+    if args.json:
+        print(json.dumps(report, indent = 2))
+        return
+
+    print("{:,} rows, {:,} counties\n".format(report["rows"], report["counties"]))
+    print("{:<24}{:>16}{:>12}{:>16}{:>12}".format("column", "current dtype", "MB", "compact dtype", "MB"))
+    for col in report["columns"]:
+        print("{:<24}{:>16}{:>12.2f}{:>16}{:>12.2f}".format(col["column"], col["dtype"] or "-", col["current_bytes"] / 1e6,
+                                                           col["compact_dtype"] or "-", col["compact_bytes"] / 1e6))
+    print("{:<24}{:>16}{:>12.2f}{:>16}{:>12.2f}".format("total", "", report["current_mb"], "", report["compact_mb"]))
+    print("\n{:.0%} less memory".format(report["reduction"]))
+
+if __name__ == "__main__":
+    main()
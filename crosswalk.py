@@ -0,0 +1,282 @@
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from cache import CACHE_DIR, is_url
+from lookup import normalize_name
+from utils import add_data_args
+
+CROSSWALK_NAME = "crosswalk.json"
+
+# Bump when the matching of the names changes, crosswalks of another format are rebuilt
+CROSSWALK_FORMAT = 1
+
+# The columns of the geocodes that are joined to the NY Times rows
+GEOCODE_COLS = ["latitude", "longitude", "estimated_population"]
+
+def repair_text(text):
+    """Undo mojibake, text encoded as UTF-8 and decoded as Windows-1252 one or more times
+
+    Args:
+    =====
+        text (str): A name, e.g. "BayamÃƒÂ³n"
+
+    Returns:
+    ========
+        text (str): The repaired name, e.g. "Bayamón". Text without mojibake is returned as is
+    """
+    for _ in range(3):
+        try:
+            repaired = text.encode("cp1252").decode("utf-8")
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            return text
+        if repaired == text:
+            return text
+        text = repaired
+    return text
+
+class Crosswalk:
+    """FIPS-keyed crosswalk from the NY Times counties to the geocodes counties
+
+    The geocodes have no FIPS, so each FIPS of the NY Times data is matched once to a
+    geocodes county by its normalized (county, state) names, and then kept in a dense
+    array indexed by FIPS. Several FIPS can match the same geocodes county, e.g. a county
+    and an independent city of the same name that the geocodes do not tell apart. Joining
+    rows is then an array lookup of their FIPS, only the rows of a FIPS never seen before
+    (or without a FIPS, e.g. "New York City") go through the names. The FIPS matched so far
+    are persisted with write_crosswalk().
+
+    Attributes:
+    ===========
+        geocodes (pd.DataFrame): The geocodes from load_geocodes(), one row per county
+        fingerprint (str): Hash of the geocodes county names, a persisted crosswalk is only
+                           reused for the same names
+        fips_rows (np.ndarray): The geocodes county of each FIPS, -1 when there is none yet
+        unmatched (dict): (county, state, fips) -> number of NY Times rows joined without a
+                          geocodes county
+    """
+
+    def __init__(self, geocode_df):
+        self.geocodes = geocode_df.reset_index(drop = True)
+        counties = self.geocodes["county"].astype(str).to_numpy()
+        states = self.geocodes["state"].astype(str).to_numpy()
+        self.fingerprint = hashlib.sha256("\n".join(county + "|" + state for county, state
+                                                    in zip(counties, states)).encode()).hexdigest()[:16]
+
+        # The first geocodes county of every normalized name
+        self.keys = {}
+        for row, (county, state) in enumerate(zip(counties, states)):
+            self.keys.setdefault((normalize_name(repair_text(county)), normalize_name(state)), row)
+
+        self.county = pd.Categorical(counties)
+        self.state = pd.Categorical(states)
+        self.fips_rows = np.full(1, -1, dtype = np.int32)
+        self.unmatched = {}
+
+    def __len__(self):
+        return len(self.geocodes)
+
+    def assign(self, fips, row):
+        """Match a FIPS to a geocodes county
+        """
+        if fips >= len(self.fips_rows):
+            self.fips_rows = np.concatenate([self.fips_rows, np.full(fips + 1 - len(self.fips_rows), -1, dtype = np.int32)])
+        self.fips_rows[fips] = row
+
+    def rows_of_fips(self, fips):
+        """Geocodes county of each FIPS, -1 for the FIPS that are not matched (yet)
+        """
+        rows = np.full(len(fips), -1, dtype = np.int64)
+        known = (fips > 0) & (fips < len(self.fips_rows))
+        rows[known] = self.fips_rows[fips[known]]
+        return rows
+
+    def match(self, county, state, fips = 0):
+        """Geocodes county of a NY Times county, matching its FIPS to it the first time
+
+        Returns:
+        ========
+            row (int): Position of the geocodes county, None if there is none
+        """
+        row = self.keys.get((normalize_name(repair_text(str(county))), normalize_name(str(state))))
+        if row is not None and fips > 0:
+            self.assign(fips, row)
+        return row
+
+    def join(self, counties_df):
+        """Inner join of preprocessed NY Times rows with the geocodes, on their FIPS
+
+        Args:
+        =====
+            counties_df (pd.DataFrame): NY Times Counties rows preprocessed by merge_counties()
+
+        Returns:
+        ========
+            merged_df (pd.DataFrame): The matched rows in their order, with the county and state
+                                      names of the geocodes and their latitude, longitude and
+                                      estimated population
+        """
+        fips = counties_df["fips"].to_numpy()
+        rows = self.rows_of_fips(fips)
+
+        # FIPS seen for the first time are matched by the names of their first row
+        new = np.flatnonzero((rows < 0) & (fips > 0))
+        if len(new):
+            new_fips, first_rows = np.unique(fips[new], return_index = True)
+            names = counties_df[["county", "state"]].iloc[new[first_rows]]
+            for county, state, county_fips in zip(names["county"], names["state"], new_fips.tolist()):
+                self.match(county, state, county_fips)
+            rows = self.rows_of_fips(fips)
+
+        # The rows without a FIPS and those still unmatched, by distinct NY Times county
+        missing = np.flatnonzero(rows < 0)
+        if len(missing):
+            codes, firsts = pd.MultiIndex.from_frame(counties_df[["county", "state", "fips"]].iloc[missing]).factorize()
+            matches = np.array([-1 if row is None else row for row in (self.match(*first) for first in firsts)],
+                               dtype = np.int64)
+            rows[missing] = matches[codes]
+
+            counts = np.bincount(codes, minlength = len(matches))
+            for (county, state, county_fips), count, row in zip(firsts, counts, matches):
+                if row < 0:
+                    key = (str(county), str(state), int(county_fips))
+                    self.unmatched[key] = self.unmatched.get(key, 0) + int(count)
+
+        matched = np.flatnonzero(rows >= 0)
+        rows = rows[matched]
+        merged_df = counties_df.iloc[matched].reset_index(drop = True)
+        merged_df["county"] = pd.Categorical.from_codes(self.county.codes[rows],
+                                                        self.county.categories).remove_unused_categories()
+        merged_df["state"] = pd.Categorical.from_codes(self.state.codes[rows],
+                                                       self.state.categories).remove_unused_categories()
+        for col in GEOCODE_COLS:
+            merged_df[col] = self.geocodes[col].to_numpy()[rows]
+        return merged_df
+
+    def report(self):
+        """The NY Times counties without a geocodes county, most rows first
+
+        Returns:
+        ========
+            report (list): One dictionary per county with its county, state, fips and rows
+        """
+        unmatched = sorted(self.unmatched.items(), key = lambda item: (-item[1], item[0]))
+        return [{"county": county, "state": state, "fips": fips, "rows": rows}
+                for (county, state, fips), rows in unmatched]
+
+def build_crosswalk(geocode_df):
+    """Build an empty crosswalk of the geocodes, the FIPS are matched as rows are joined
+
+    Args:
+    =====
+        geocode_df (pd.DataFrame): The geocodes from load_geocodes()
+
+    Returns:
+    ========
+        crosswalk (Crosswalk): The crosswalk
+    """
+    return Crosswalk(geocode_df)
+
+def load_crosswalk(geocode_df, cache_dir = CACHE_DIR):
+    """The crosswalk of the geocodes, with the FIPS persisted by write_crosswalk() for the same geocodes
+
+    Args:
+    =====
+        geocode_df (pd.DataFrame): The geocodes from load_geocodes()
+        cache_dir (str): The directory of the on-disk cache
+
+    Returns:
+    ========
+        crosswalk (Crosswalk): The crosswalk
+    """
+    crosswalk = build_crosswalk(geocode_df)
+    path = os.path.join(cache_dir, CROSSWALK_NAME)
+    if not os.path.exists(path):
+        return crosswalk
+
+    with open(path, "r") as f:
+        saved = json.load(f)
+    if saved.get("format") == CROSSWALK_FORMAT and saved.get("fingerprint") == crosswalk.fingerprint:
+        for fips, row, _, _ in saved["fips"]:
+            crosswalk.assign(fips, row)
+    return crosswalk
+
+def write_crosswalk(crosswalk, cache_dir = CACHE_DIR):
+    """Persist the FIPS of a crosswalk and its report of unmatched NY Times counties
+
+    Args:
+    =====
+        crosswalk (Crosswalk): The crosswalk
+        cache_dir (str): The directory of the on-disk cache
+    """
+    fips = np.flatnonzero(crosswalk.fips_rows >= 0)
+    rows = crosswalk.fips_rows[fips]
+    saved = {"format": CROSSWALK_FORMAT,
+             "fingerprint": crosswalk.fingerprint,
+             "fips": [[int(county_fips), int(row), str(crosswalk.county[row]), str(crosswalk.state[row])]
+                      for county_fips, row in zip(fips, rows)],
+             "unmatched": crosswalk.report()}
+
+    os.makedirs(cache_dir, exist_ok = True)
+    path = os.path.join(cache_dir, CROSSWALK_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(saved, f)
+    os.replace(path + ".tmp", path)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--json",
+                        action = "store_true",
+                        help = "Print the report as JSON")
+    parser.add_argument("--cache_dir",
+                        type = str,
+                        default = CACHE_DIR,
+                        help = "The directory of the on-disk cache, holding the downloads and the crosswalk")
+    add_data_args(parser)
+    args = parser.parse_args()
+
+    from data import COUNTIES_DTYPES, load_geocodes, merge_counties
+    from fetch import download_path, fetch_sources
+
+    # URL sources are downloaded like load_data() does, offline their last downloaded copy is read
+    downloads_dir = os.path.join(args.cache_dir, "downloads")
+    paths = {source: source for source in [args.nytimes_url, args.data_gov_url]}
+    urls = [source for source in paths if is_url(source)]
+    if args.offline:
+        for url in urls:
+            paths[url] = download_path(url, downloads_dir)
+            if not os.path.exists(paths[url]):
+                raise Exception("{} was never downloaded. Please run once without --offline.".format(url))
+    elif urls:
+        for url, result in fetch_sources(urls, downloads_dir).items():
+            paths[url] = result["path"]
+            if result["status"] == "fallback":
+                print("Could not download {} ({}), using the last downloaded copy".format(url, result["error"]))
+
+    crosswalk = load_crosswalk(load_geocodes(paths[args.data_gov_url]), args.cache_dir)
+    num_rows = 0
+    num_merged = 0
+    for chunk in pd.read_csv(paths[args.nytimes_url], dtype = COUNTIES_DTYPES, parse_dates = ["date"],
+                             chunksize = args.chunksize or 500000):
+        num_rows += len(chunk)
+        num_merged += len(merge_counties(chunk, crosswalk.geocodes, crosswalk))
+    write_crosswalk(crosswalk, args.cache_dir)
+
+    report = crosswalk.report()
+    if args.json:
+        print(json.dumps({"rows": num_rows, "merged_rows": num_merged, "matched_fips": int(np.count_nonzero(crosswalk.fips_rows >= 0)),
+                          "unmatched": report}, indent = 2))
+        return
+
+    print("{:,} of {:,} NY Times rows joined, {:,} FIPS matched to {:,} geocodes counties\n".format(
+          num_merged, num_rows, np.count_nonzero(crosswalk.fips_rows >= 0), len(crosswalk)))
+    print("{:<32}{:<24}{:>8}{:>10}".format("county", "state", "fips", "rows"))
+    for county in report:
+        print("{:<32}{:<24}{:>8}{:>10,}".format(county["county"], county["state"], county["fips"] or "-", county["rows"]))
+
+if __name__ == "__main__":
+    main()
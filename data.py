@@ -2,15 +2,60 @@ import pandas as pd
 import numpy as np
 
 from utils import load_state_abbrevs
+from crosswalk import repair_text, build_crosswalk, load_crosswalk, write_crosswalk
+from cache import (CACHE_DIR, source_versions, read_manifest, read_cached, write_cached,
+                   write_cached_chunks)
+from profiling import stage
 
 import warnings
 warnings.filterwarnings("ignore")
 
+# Columns to be converted from type float to type int
+# Converting because Plotly only takes fips as int, and there cannot be 0.5 of a case, death, etc..
+NUMERIC_COLS = ['fips', 'cases', 'deaths', 'confirmed_cases', 
+                'confirmed_deaths', 'probable_cases', 'probable_deaths']
+
+# Columns stored as categoricals, there are only ~3,200 distinct counties and ~55 states
+STRING_COLS = ['county', 'state']
+
+# Data types used when reading the NY Times Counties Data, the numeric columns have
+# missing values so they are read as floats and converted to ints during preprocessing
+COUNTIES_DTYPES = dict({col: "category" for col in STRING_COLS},
+                       **{col: "float64" for col in NUMERIC_COLS})
+
+# Data types used when reading the Geocodes USA Counties data
+GEOCODES_DTYPES = {"latitude": "float64", "longitude": "float64", "estimated_population": "float64"}
+
+def __to_category(column):
+    """Convert a column to a categorical, replacing missing values with "0"
+
+    The original preprocessing filled missing values with 0 and converted every cell to
+    a string, this keeps the same values without any per-cell Python calls.
+
+    Args:
+    =====
+        column (pd.Series): A string or categorical column
+
+    Returns:
+    ========
+        column (pd.Series): The column as a categorical without missing values
+    """
+    if not isinstance(column.dtype, pd.CategoricalDtype):
+        column = column.astype("category")
+    if column.isna().any():
+        if "0" not in column.cat.categories:
+            column = column.cat.add_categories("0")
+        column = column.fillna("0")
+    return column
+
 def __preprocess_counties_data(counties_df):
     """Preprocess the NY Times Counties Data
     
     Essentially: replace missing values with 0's, remove rows with no relevant information, convert some columns
                  to appropriate data types
+
+    Every step works on whole columns. When the data is read with COUNTIES_DTYPES and
+    parse_dates = ["date"] most of the conversions are already done at read time.
                  
     Args:
     =====
@@ -21,20 +66,15 @@ def __preprocess_counties_data(counties_df):
         counties_df (pd.DataFrame): A pandas DataFrame of the cleaned NY Times Counties Data
     """
     # Convert the date column to datetime format
-    counties_df.loc[:, "date"] = pd.to_datetime(counties_df.loc[:, 'date'], format = '%Y-%m-%d')
-    
-    # Replace all missing values in the dataframe with 0's
-    counties_df.fillna(0, inplace = True)
+    if not pd.api.types.is_datetime64_any_dtype(counties_df["date"]):
+        counties_df["date"] = pd.to_datetime(counties_df["date"], format = '%Y-%m-%d')
     
-    # Columns to be converted from type float to type int
-    # Converting because Plotly only takes fips as int, and there cannot be 0.5 of a case, death, etc..
-    numeric_cols = ['fips', 'cases', 'deaths', 'confirmed_cases', 
-                    'confirmed_deaths', 'probable_cases', 'probable_deaths']
-    counties_df.loc[:, numeric_cols] = counties_df.loc[:, numeric_cols].applymap(np.int64)
+    # Replace all missing values in the numeric columns with 0's and convert them to ints
+    counties_df[NUMERIC_COLS] = counties_df[NUMERIC_COLS].fillna(0).astype(np.int64)
     
-    # Columns to be converted to type string
-    string_cols = ['county', 'state']
-    counties_df.loc[:, string_cols] = counties_df.loc[:, string_cols].applymap(str)
+    # County and state names become categoricals
+    for col in STRING_COLS:
+        counties_df[col] = __to_category(counties_df[col])
     
     return counties_df
 
@@ -51,72 +91,265 @@ def __preprocess_geocodes_data(geocode_df):
     ========
         small_geocode (pd.DataFrame): A pandas DataFrame of the cleaned Geocodes USA Counties data
     """
-    # Remove all rows that are related to military bases
-    geocode_df = geocode_df[geocode_df.loc[:, "state"] != "AE"]
-    
-    # Replace all missing values in the dataframe with 0's
-    geocode_df.fillna(0, inplace = True)
-    
     # Load the state abbreviations dictionary
     state_abbrevs = load_state_abbrevs()
+
+    # Remove all rows that are related to military bases or have no county value,
+    # and only keep the columns that are relevant and consistent with counties_df
+    keep = (geocode_df["state"] != "AE") & geocode_df["county"].notna() & (geocode_df["county"] != 0)
+    geocode_df = geocode_df.loc[keep, ["county", "state", "latitude", "longitude", "estimated_population"]]
     
     # Convert each of the state abbreviations in the "state" column
-    # to their full state name to maintain consistency with counties_df
-    geocode_df.loc[:, "state"] = geocode_df.loc[:, "state"].map(state_abbrevs)
-    
-    # After converting the state abbreviations, there are some additional missing values,
-    # drop these missing values as they are not relevant
-    geocode_df.loc[:, "state"].dropna(inplace = True)
+    # to their full state name to maintain consistency with counties_df.
+    # States without a full name become missing values and are dropped by the groupby below
+    geocode_df["state"] = geocode_df["state"].map(state_abbrevs)
+
+    # The accents of some Puerto Rico counties are mangled into mojibake (e.g. "BayamÃƒÂ³n"),
+    # repair them once per distinct name
+    names = geocode_df["county"].unique()
+    geocode_df["county"] = geocode_df["county"].map(dict(zip(names, [repair_text(str(name)) for name in names])))
     
-    # Remove rows that have no county value
-    geocode_df = geocode_df[geocode_df.loc[:, "county"] != 0]
+    # Replace all missing values in the numeric columns with 0's
+    numeric_cols = ["latitude", "longitude", "estimated_population"]
+    geocode_df[numeric_cols] = geocode_df[numeric_cols].fillna(0)
     
     # Since the dataframe has multiple listings of the same county and state but with very
     # similar latitude and longitude values, I decided to group these same counties and states into one by
     # taking the average of their latitude, longitude, and estimated population values
-    # From geocode_df, I keep columns that I deem relevant and consistent with counties_df
-    small_geocode = geocode_df.groupby(["county", "state"], as_index = False)["latitude", "longitude", "estimated_population"].mean()
-    
-    # Additional cleaning
-    # Some Puerto Rico counties have accents, need to remove them to be consistent with
-    # counties_df
-    small_geocode.loc[:, "county"] = small_geocode.loc[:, "county"].replace({"BayamÃƒÂ³n": "Bayamon"})
-    small_geocode.loc[:, "county"] = small_geocode.loc[:, "county"].replace({"CataÃƒÂ±o": "Catano"})
-    small_geocode.loc[:, "county"] = small_geocode.loc[:, "county"].replace({"CanÃƒÂ³vanas": "Canovanas"})
+    small_geocode = geocode_df.groupby(["county", "state"], as_index = False, sort = False)[numeric_cols].mean()
     
     # Round the values in estimated_population to the nearest integer
     # since you cannot have half of a person
-    small_geocode.loc[:, "estimated_population"] = small_geocode.loc[:, "estimated_population"].round(0).astype(int)
+    small_geocode["estimated_population"] = small_geocode["estimated_population"].round(0).astype(np.int64)
     
     return small_geocode
 
+def load_geocodes(data_gov_url):
+    """Load and preprocess the Geocodes USA Counties data
+
+    Args:
+    =====
+        data_gov_url (str): The URL link (or local path) of the US counties geocodes
+
+    Returns:
+    ========
+        geocode_df (pd.DataFrame): One row per county and state with its latitude, longitude
+                                   and estimated population
+    """
+    with stage("read_json") as record:
+        geocode_df = pd.read_json(data_gov_url, dtype = GEOCODES_DTYPES)
+        record["rows"] = len(geocode_df)
+
+    with stage("preprocess_geocodes") as record:
+        geocode_df = __preprocess_geocodes_data(geocode_df)
+        record["rows"] = len(geocode_df)
+
+    return geocode_df
+
+def merge_counties(counties_df, geocode_df, crosswalk = None):
+    """Preprocess NY Times Counties rows and merge them with the preprocessed geocodes
+
+    Works on any subset of the NY Times rows, e.g. one chunk or a few dates of the history.
+    The rows are joined on their FIPS through a crosswalk (see crosswalk.Crosswalk), the
+    rows that match no geocodes county are left out and counted in crosswalk.unmatched.
+
+    Args:
+    =====
+        counties_df (pd.DataFrame): NY Times Counties rows, ideally read with COUNTIES_DTYPES
+        geocode_df (pd.DataFrame): The geocodes from load_geocodes()
+        crosswalk (Crosswalk): The crosswalk of geocode_df, to share between calls
+                               Default is None, which builds one for this call
+
+    Returns:
+    ========
+        merged_df (pd.DataFrame): The merged and cleaned rows
+    """
+    # The historical data only has cases and deaths
+    for col in NUMERIC_COLS:
+        if col not in counties_df.columns:
+            counties_df[col] = 0
+
+    with stage("preprocess_counties", rows = len(counties_df)):
+        counties_df_preprocessed = __preprocess_counties_data(counties_df)
+    
+    if crosswalk is None:
+        crosswalk = build_crosswalk(geocode_df)
+
+    # Finally, join the two dataframes on the FIPS, the names of a county only
+    # matter the first time its FIPS is seen
+    with stage("merge") as record:
+        merged_df = crosswalk.join(counties_df_preprocessed)
+        record["rows"] = len(merged_df)
+
+    return merged_df
+
+def iter_merged_chunks(nytimes_url, geocode_df, chunksize = 500000, crosswalk = None):
+    """Read the NY Times Counties data chunksize rows at a time, and yield each chunk merged with the geocodes
+
+    Only one chunk of the NY Times data is in memory at a time, so memory use is bounded by
+    chunksize instead of the size of the file. Every chunk has the same categories (those
+    of the geocodes, since the merge only keeps the counties in them), so the chunks can
+    be concatenated or written one after the other into a single file.
+
+    Args:
+    =====
+        nytimes_url (str): The URL link (or local path) of the NY Times COVID-19 US County cases data
+        geocode_df (pd.DataFrame): The geocodes from load_geocodes()
+        chunksize (int): Number of CSV rows read at a time
+        crosswalk (Crosswalk): The crosswalk of geocode_df
+                               Default is None, which builds one for all the chunks
+
+    Yields:
+    =======
+        merged_df (pd.DataFrame): The merged and cleaned rows of a chunk
+    """
+    categories = {col: pd.CategoricalDtype(np.sort(geocode_df[col].unique())) for col in STRING_COLS}
+    if crosswalk is None:
+        crosswalk = build_crosswalk(geocode_df)
+
+    for chunk in pd.read_csv(nytimes_url, dtype = COUNTIES_DTYPES, parse_dates = ["date"], chunksize = chunksize):
+        merged_df = merge_counties(chunk, geocode_df, crosswalk)
+        for col in STRING_COLS:
+            merged_df[col] = merged_df[col].cat.set_categories(categories[col].categories)
+        yield merged_df
+
+def __write_crosswalk(crosswalk, cache_dir):
+    """Persist the crosswalk and say how many NY Times rows were left out of the merge
+    """
+    write_crosswalk(crosswalk, cache_dir)
+    report = crosswalk.report()
+    if report:
+        print("{:,} NY Times rows match no geocodes county, e.g. {}. python crosswalk.py lists them".format(
+              sum(county["rows"] for county in report),
+              "; ".join("{} ({})".format(county["county"], county["state"]) for county in report[:3])))
+
+def __fetch_and_merge(nytimes_url, data_gov_url, chunksize = None, cache_dir = None):
+    """Download both datasets, preprocess them and merge them into one dataframe
+
+    Args:
+    =====
+        nytimes_url  (str): The URL link (or local path) of the NY Times COVID-19 US County cases data
+        data_gov_url (str): The URL link (or local path) of the US counties geocodes
+        chunksize (int): Number of CSV rows read at a time
+                         Default is None, which reads the whole file at once
+        cache_dir (str): The directory of the persisted crosswalk
+                         Default is None, which matches the FIPS again without persisting them
+
+    Returns:
+    ========
+        merged_df (pd.DataFrame): The merged and cleaned pandas DataFrame
+    """
+    geocode_df = load_geocodes(data_gov_url)
+    crosswalk = build_crosswalk(geocode_df) if cache_dir is None else load_crosswalk(geocode_df, cache_dir)
+
+    if chunksize is not None:
+        merged_df = pd.concat(list(iter_merged_chunks(nytimes_url, geocode_df, chunksize, crosswalk)),
+                              ignore_index = True)
+    else:
+        with stage("read_csv") as record:
+            counties_df = pd.read_csv(nytimes_url, dtype = COUNTIES_DTYPES, parse_dates = ["date"])
+            record["rows"] = len(counties_df)
+        merged_df = merge_counties(counties_df, geocode_df, crosswalk)
+
+    if cache_dir is not None:
+        __write_crosswalk(crosswalk, cache_dir)
+    return merged_df
+
 def load_data(nytimes_url  = "https://raw.githubusercontent.com/nytimes/covid-19-data/master/live/us-counties.csv",
-              data_gov_url = "https://data.healthcare.gov/resource/geocodes-usa-with-counties.json"):
+              data_gov_url = "https://data.healthcare.gov/resource/geocodes-usa-with-counties.json",
+              cache_dir = CACHE_DIR,
+              refresh = False,
+              offline = False,
+              chunksize = None,
+              compact = False):
 
     """Load in the data from the URL links into pandas DataFrames
 
+    The URL sources are downloaded at the same time with fetch_sources(), into
+    cache_dir/downloads. Unchanged files are not downloaded again, and when a download
+    fails its last good copy is used.
+
+    The merged dataframe is cached on disk as a Feather file keyed by the version of
+    each source (the content hash of the local file or downloaded copy). Subsequent calls
+    load from the cache and only reprocess the sources when one of them has changed.
+
+    With a chunksize, the NY Times data is streamed: each chunk is preprocessed, merged
+    with the geocodes and appended to the cache file before the next one is read, so the
+    peak memory of the ingest is bounded by the chunk size. The merged dataframe is then
+    read back from the cache.
+
     Args:
     =====
-        nytimes_url  (str): The URL link from the NY Times GitHub of the COVID-19 US County cases data
-        data_gov_url (str): The URL link from data.gov of the US counties geocodes
+        nytimes_url  (str): The URL link from the NY Times GitHub of the COVID-19 US County cases data,
+                            or a path to a local copy of it
+        data_gov_url (str): The URL link from data.gov of the US counties geocodes,
+                            or a path to a local copy of it
+        cache_dir (str): The directory of the on-disk cache. None disables caching
+        refresh (bool): Ignore the cache and always refetch and reprocess the sources
+        offline (bool): Never contact the network, URL sources are served from the cache
+        chunksize (int): Number of NY Times rows read at a time
+                         Default is None, which reads the whole file at once
+        compact (bool): Return the compact layout of the merged dataframe, see compact.CompactData
+
+    Raises:
+    =======
+        Exception: Error message will show if offline is requested but nothing is cached
 
     Returns:
     ========
         merged_df (pd.DataFrame): The merged and cleaned pandas DataFrame of the
-                                  NY Times Counties and Geocodes USA Counties data
+                                  NY Times Counties and Geocodes USA Counties data.
+                                  merged_df.attrs["version"] identifies the dataset version.
+                                  A CompactData of it with compact
     """
-    counties_df = pd.read_csv(nytimes_url)
+    merged_df = __load_merged(nytimes_url, data_gov_url, cache_dir, refresh, offline, chunksize)
+    if not compact:
+        return merged_df
 
-    geocode_df = pd.read_json(data_gov_url)
-    
-    # Preprocess the two dataframes
-    counties_df_preprocessed = __preprocess_counties_data(counties_df)
-    geocode_df_preprocessed = __preprocess_geocodes_data(geocode_df)
-    
-    # Finally, merge the two dataframes on the same two columns "county"
-    # and "state"
-    merged_df = pd.merge(counties_df_preprocessed, 
-                         geocode_df_preprocessed, 
-                         on = ["county", "state"])
+    from compact import build_compact
+
+    with stage("build_compact", rows = len(merged_df)):
+        return build_compact(merged_df)
+
+def __load_merged(nytimes_url, data_gov_url, cache_dir, refresh, offline, chunksize):
+    """The merged dataframe of load_data(), from the on-disk cache when it is up to date
+    """
+    if cache_dir is None:
+        return __fetch_and_merge(nytimes_url, data_gov_url, chunksize)
+
+    manifest = read_manifest(cache_dir)
+    cached_sources = manifest.get("sources", {})
+    paths, versions = source_versions([nytimes_url, data_gov_url], cache_dir, offline)
+
+    if offline and None in versions.values():
+        raise Exception("No cached data is available for offline use. Please run once without --offline.")
+
+    # Only trust the cache when the versions of every source match
+    if not refresh and versions == cached_sources:
+        with stage("read_cache") as record:
+            merged_df = read_cached(manifest, cache_dir)
+            record["rows"] = len(merged_df) if merged_df is not None else 0
+        if merged_df is not None:
+            return merged_df
+
+    if offline:
+        raise Exception("The cached data is missing or out of date. Please run once without --offline.")
+
+    if chunksize is not None:
+        geocode_df = load_geocodes(paths[data_gov_url])
+        crosswalk = load_crosswalk(geocode_df, cache_dir)
+        chunks = iter_merged_chunks(paths[nytimes_url], geocode_df, chunksize, crosswalk)
+        with stage("stream_to_cache"):
+            manifest = write_cached_chunks(chunks, versions, cache_dir)
+        __write_crosswalk(crosswalk, cache_dir)
+        with stage("read_cache") as record:
+            merged_df = read_cached(manifest, cache_dir)
+            record["rows"] = len(merged_df)
+        return merged_df
+
+    merged_df = __fetch_and_merge(paths[nytimes_url], paths[data_gov_url], cache_dir = cache_dir)
+    with stage("write_cache", rows = len(merged_df)):
+        manifest = write_cached(merged_df, versions, cache_dir)
+    merged_df.attrs["version"] = manifest["version"]
 
-    return merged_df
\ No newline at end of file
+    return merged_df
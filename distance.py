@@ -0,0 +1,165 @@
+import numpy as np
+
+# Mean radius of the Earth in miles
+EARTH_RADIUS_MILES = 3958.8
+
+METERS_PER_MILE = 1609.344
+
+# WGS-84 ellipsoid, the one used by geopy.distance.geodesic
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+
+def haversine_miles(lat1, lon1, lat2, lon2):
+    """Great-circle distance in miles between coordinates, vectorized over numpy arrays
+
+    Accurate to about 0.5% compared to the ellipsoid, which is enough for radius queries.
+    The arguments broadcast against each other, e.g. one origin against many destinations.
+
+    Args:
+    =====
+        lat1, lon1 (float or np.ndarray): Latitude and longitude of the origin(s) in degrees
+        lat2, lon2 (float or np.ndarray): Latitude and longitude of the destination(s) in degrees
+
+    Returns:
+    ========
+        (np.ndarray): The distances in miles
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def ellipsoid_miles(lat1, lon1, lat2, lon2):
+    """Distance in miles on the WGS-84 ellipsoid using Lambert's formula, vectorized over numpy arrays
+
+    Lambert's formula corrects the great-circle distance for the flattening of the Earth.
+    It stays within a few meters of geopy's geodesic() (Karney's algorithm) at US
+    distances, without Vincenty's iterations.
+
+    Args:
+    =====
+        lat1, lon1 (float or np.ndarray): Latitude and longitude of the origin(s) in degrees
+        lat2, lon2 (float or np.ndarray): Latitude and longitude of the destination(s) in degrees
+
+    Returns:
+    ========
+        (np.ndarray): The distances in miles
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+
+    # Parametric (reduced) latitudes
+    beta1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+    beta2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+
+    a = np.sin((beta2 - beta1) / 2) ** 2 + np.cos(beta1) * np.cos(beta2) * np.sin((lon2 - lon1) / 2) ** 2
+    sigma = 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+    p = (beta1 + beta2) / 2
+    q = (beta2 - beta1) / 2
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        x = (sigma - np.sin(sigma)) * np.sin(p) ** 2 * np.cos(q) ** 2 / np.cos(sigma / 2) ** 2
+        y = (sigma + np.sin(sigma)) * np.cos(p) ** 2 * np.sin(q) ** 2 / np.sin(sigma / 2) ** 2
+        meters = WGS84_A * (sigma - WGS84_F / 2 * (x + y))
+
+    # Identical points give 0 / 0
+    return np.where(sigma == 0, 0.0, meters) / METERS_PER_MILE
+
+def destination(lat, lon, miles, bearing, max_iterations = 100):
+    """Point reached by travelling a distance along a bearing on the WGS-84 ellipsoid, vectorized
+
+    Vincenty's direct formula, iterated on whole arrays at once. Matches geopy's
+    geodesic().destination() to well under a meter.
+
+    Args:
+    =====
+        lat, lon (float or np.ndarray): Latitude and longitude of the start(s) in degrees
+        miles (float or np.ndarray): The distance(s) in miles
+        bearing (float or np.ndarray): The bearing(s) in degrees, clockwise from north
+        max_iterations (int): Maximum number of iterations
+
+    Returns:
+    ========
+        lat2 (np.ndarray): Latitudes of the destinations in degrees
+        lon2 (np.ndarray): Longitudes of the destinations in degrees
+    """
+    lat, lon, miles, bearing = np.broadcast_arrays(*map(np.asarray, (lat, lon, miles, bearing)))
+    phi1 = np.radians(lat)
+    alpha1 = np.radians(bearing)
+    s = miles * METERS_PER_MILE
+
+    sin_alpha1 = np.sin(alpha1)
+    cos_alpha1 = np.cos(alpha1)
+
+    tan_u1 = (1 - WGS84_F) * np.tan(phi1)
+    cos_u1 = 1 / np.sqrt(1 + tan_u1 ** 2)
+    sin_u1 = tan_u1 * cos_u1
+
+    sigma1 = np.arctan2(tan_u1, cos_alpha1)
+    sin_alpha = cos_u1 * sin_alpha1
+    cos_sq_alpha = 1 - sin_alpha ** 2
+    u_sq = cos_sq_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+
+    sigma = s / (WGS84_B * big_a)
+    for _ in range(max_iterations):
+        cos_2sigma_m = np.cos(2 * sigma1 + sigma)
+        sin_sigma = np.sin(sigma)
+        cos_sigma = np.cos(sigma)
+        delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (
+                      cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+                      big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        previous = sigma
+        sigma = s / (WGS84_B * big_a) + delta_sigma
+        if np.all(np.abs(sigma - previous) < 1e-12):
+            break
+
+    cos_2sigma_m = np.cos(2 * sigma1 + sigma)
+    sin_sigma = np.sin(sigma)
+    cos_sigma = np.cos(sigma)
+
+    x = sin_u1 * sin_sigma - cos_u1 * cos_sigma * cos_alpha1
+    phi2 = np.arctan2(sin_u1 * cos_sigma + cos_u1 * sin_sigma * cos_alpha1,
+                      (1 - WGS84_F) * np.sqrt(sin_alpha ** 2 + x ** 2))
+    lam = np.arctan2(sin_sigma * sin_alpha1, cos_u1 * cos_sigma - sin_u1 * sin_sigma * cos_alpha1)
+    c = WGS84_F / 16 * cos_sq_alpha * (4 + WGS84_F * (4 - 3 * cos_sq_alpha))
+    big_l = lam - (1 - c) * WGS84_F * sin_alpha * (
+            sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+
+    lon2 = (lon + np.degrees(big_l) + 180) % 360 - 180
+
+    return np.degrees(phi2), lon2
+
+def distance_matrix(origin_lats, origin_lons, lats, lons, method = "haversine", chunk_size = 1024, dtype = np.float32):
+    """Distances in miles from many origins to many destinations as an N x M matrix
+
+    The matrix is filled chunk_size origins at a time, so the temporary arrays stay
+    bounded by chunk_size x M however many origins there are.
+
+    Args:
+    =====
+        origin_lats, origin_lons (np.ndarray): Coordinates of the N origins in degrees
+        lats, lons (np.ndarray): Coordinates of the M destinations in degrees
+        method (str): "haversine" or "ellipsoid"
+        chunk_size (int): Number of origins computed at a time
+        dtype (np.dtype): Data type of the matrix, float32 halves its memory
+
+    Returns:
+    ========
+        matrix (np.ndarray): The N x M matrix of distances in miles
+    """
+    distance = {"haversine": haversine_miles, "ellipsoid": ellipsoid_miles}[method]
+
+    origin_lats = np.asarray(origin_lats, dtype = np.float64)
+    origin_lons = np.asarray(origin_lons, dtype = np.float64)
+    lats = np.asarray(lats, dtype = np.float64)[np.newaxis, :]
+    lons = np.asarray(lons, dtype = np.float64)[np.newaxis, :]
+
+    matrix = np.empty((len(origin_lats), lats.shape[1]), dtype = dtype)
+    for start in range(0, len(origin_lats), chunk_size):
+        end = start + chunk_size
+        matrix[start:end] = distance(origin_lats[start:end, np.newaxis], origin_lons[start:end, np.newaxis], lats, lons)
+
+    return matrix
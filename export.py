@@ -0,0 +1,56 @@
+import os
+
+# Formats written by the image renderer, anything else is written as HTML
+IMAGE_FORMATS = ("png", "jpg", "jpeg", "webp", "svg", "pdf", "eps")
+
+def start_renderer():
+    """Start the static image renderer once so every later export reuses the same process
+
+    With kaleido the Chromium subprocess is kept alive after the first image, so it is
+    warmed up here with an empty figure instead of on the first real export. With orca
+    the server would otherwise shut down after its idle timeout and be restarted.
+
+    Returns:
+    ========
+        engine (str): The renderer in use, "kaleido" or "orca"
+    """
+    # Imported here, the CLI only needs plotly.io once it renders an image
+    import plotly.io as pio
+
+    scope = getattr(getattr(pio, "kaleido", None), "scope", None)
+    if scope is not None:
+        scope.transform({"data": [], "layout": {}}, format = "png", width = 10, height = 10)
+        return "kaleido"
+
+    pio.orca.config.timeout = None
+    pio.orca.ensure_server()
+    return "orca"
+
+def save_figure(fig, path, width = None, height = None, scale = None):
+    """Write a figure to disk, the format is picked from the file extension
+
+    Call start_renderer() once before exporting many images, e.g. when a batch worker starts.
+
+    HTML files reference a single plotly.min.js written next to them instead of each
+    embedding their own copy of it.
+
+    Args:
+    =====
+        fig (go.Figure): A figure from make_figure()
+        path (str): The output path, ending in .html, .png, .svg, .jpg, .pdf, etc.
+        width (int): Width of images in pixels
+                     Default is None, which uses the figure's layout
+        height (int): Height of images in pixels
+                      Default is None, which uses the figure's layout
+        scale (float): Scale factor of images
+                       Default is None, which is 1
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+
+    fmt = os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt in IMAGE_FORMATS:
+        fig.write_image(path, format = fmt, width = width, height = height, scale = scale)
+    else:
+        fig.write_html(path, include_plotlyjs = "directory")
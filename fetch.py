@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import zlib
+import random
+import hashlib
+import threading
+import http.client
+from urllib.parse import urlsplit, urljoin
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import CACHE_DIR
+
+# Default location of the downloaded copies of the sources, the last good copy of each is kept
+DOWNLOADS_DIR = os.path.join(CACHE_DIR, "downloads")
+
+# Statuses worth retrying, anything else is an error of the request itself
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+
+class RetryableError(Exception):
+    """A failure that may go away by retrying, e.g. a timeout or a 503"""
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections per host, shared by the download threads
+
+    A connection is only handed back to the pool after its response was read completely,
+    and a connection that failed is closed instead, so a pooled connection is always usable.
+    """
+
+    def __init__(self, timeout = 30, max_idle_per_host = 4):
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        """An idle connection to the host, or a new one
+        """
+        with self.lock:
+            connections = self.idle.get((scheme, netloc))
+            if connections:
+                return connections.pop()
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout = self.timeout)
+        return http.client.HTTPConnection(netloc, timeout = self.timeout)
+
+    def put(self, scheme, netloc, connection):
+        """Hand a connection back once its response has been read
+        """
+        with self.lock:
+            connections = self.idle.setdefault((scheme, netloc), [])
+            if len(connections) < self.max_idle_per_host:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+
+def download_path(url, dest_dir = DOWNLOADS_DIR):
+    """Local path of the downloaded copy of a URL, e.g. .cache/downloads/1a2b3c4d5e6f7a8b_us-counties.csv
+    """
+    name = os.path.basename(urlsplit(url).path) or "index"
+    return os.path.join(dest_dir, "{}_{}".format(hashlib.sha256(url.encode()).hexdigest()[:16], name))
+
+def __read_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+def __write_json(path, payload):
+    with open(path + ".tmp", "w") as f:
+        json.dump(payload, f)
+    os.replace(path + ".tmp", path)
+
+def __finish(part_path, path, encoding):
+    """Turn a complete partial download into the good copy, decompressing it if needed
+    """
+    tmp_path = path + ".tmp"
+    if encoding == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        with open(part_path, "rb") as src, open(tmp_path, "wb") as dst:
+            for block in iter(lambda: src.read(1 << 20), b""):
+                dst.write(decompressor.decompress(block))
+            dst.write(decompressor.flush())
+        os.remove(part_path)
+    else:
+        os.replace(part_path, tmp_path)
+    os.replace(tmp_path, path)
+
+def __attempt(url, path, pool, chunk_size):
+    """One GET of a URL into its partial download, resuming it when possible
+
+    Returns:
+    ========
+        status (str): "downloaded" or "not_modified"
+    """
+    part_path = path + ".part"
+    part_meta = __read_json(part_path + ".json")
+    good_meta = __read_json(path + ".json")
+
+    headers = {"Accept-Encoding": "gzip", "User-Agent": "covid-viz"}
+    validator = part_meta and (part_meta.get("etag") or part_meta.get("last_modified"))
+    if validator and os.path.exists(part_path):
+        # Resume the partial download, the server sends the whole file if it changed since
+        headers["Range"] = "bytes={}-".format(os.path.getsize(part_path))
+        headers["If-Range"] = validator
+    else:
+        if good_meta is not None and os.path.exists(path):
+            if good_meta.get("etag"):
+                headers["If-None-Match"] = good_meta["etag"]
+            if good_meta.get("last_modified"):
+                headers["If-Modified-Since"] = good_meta["last_modified"]
+
+    for _ in range(5):
+        url_parts = urlsplit(url)
+        target = url_parts.path or "/"
+        if url_parts.query:
+            target += "?" + url_parts.query
+
+        connection = pool.get(url_parts.scheme, url_parts.netloc)
+        try:
+            connection.request("GET", target, headers = headers)
+            response = connection.getresponse()
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            raise RetryableError("{}: {}".format(type(e).__name__, e))
+
+        if response.status not in REDIRECT_STATUSES:
+            break
+        response.read()
+        pool.put(url_parts.scheme, url_parts.netloc, connection)
+        url = urljoin(url, response.getheader("Location"))
+    else:
+        raise Exception("Too many redirects for {}".format(url))
+
+    try:
+        if response.status == 304:
+            response.read()
+            pool.put(url_parts.scheme, url_parts.netloc, connection)
+            return "not_modified"
+
+        if response.status == 416:
+            # The partial download is not a prefix of the file anymore, start over
+            response.read()
+            pool.put(url_parts.scheme, url_parts.netloc, connection)
+            os.remove(part_path + ".json")
+            raise RetryableError("HTTP 416, restarting the download")
+
+        if response.status in RETRY_STATUSES:
+            response.read()
+            pool.put(url_parts.scheme, url_parts.netloc, connection)
+            raise RetryableError("HTTP {} {}".format(response.status, response.reason))
+
+        if response.status == 206:
+            mode = "ab"
+            encoding = part_meta.get("encoding")
+        elif response.status == 200:
+            mode = "wb"
+            encoding = response.getheader("Content-Encoding")
+            __write_json(part_path + ".json", {"etag": response.getheader("ETag"),
+                                               "last_modified": response.getheader("Last-Modified"),
+                                               "encoding": encoding})
+        else:
+            response.read()
+            pool.put(url_parts.scheme, url_parts.netloc, connection)
+            raise Exception("HTTP {} {} for {}".format(response.status, response.reason, url))
+
+        length = response.getheader("Content-Length")
+        expected = int(length) if length is not None else None
+
+        received = 0
+        with open(part_path, mode) as f:
+            for block in iter(lambda: response.read(chunk_size), b""):
+                f.write(block)
+                received += len(block)
+    except (OSError, http.client.HTTPException) as e:
+        # The bytes received so far stay in the partial download for the next attempt
+        connection.close()
+        raise RetryableError("{}: {}".format(type(e).__name__, e))
+
+    if expected is not None and received < expected:
+        connection.close()
+        raise RetryableError("Connection closed after {:,} of {:,} bytes".format(received, expected))
+    pool.put(url_parts.scheme, url_parts.netloc, connection)
+
+    meta = __read_json(part_path + ".json")
+    __finish(part_path, path, encoding)
+    __write_json(path + ".json", {"etag": meta.get("etag"), "last_modified": meta.get("last_modified"),
+                                  "fetched_at": time.strftime("%Y-%m-%dT%H:%M:%S")})
+    os.remove(part_path + ".json")
+    return "downloaded"
+
+def download(url, path, pool = None, retries = 4, backoff = 0.5, chunk_size = 1 << 20):
+    """Download a URL to a local path, keeping the previous copy if the download fails
+
+    Requests are gzip-compressed when the server supports it. An unchanged file is not
+    downloaded again (If-None-Match / If-Modified-Since), and an interrupted download
+    resumes where it stopped (Range / If-Range) on the next attempt or the next run.
+    Timeouts, dropped connections and 408/429/5xx responses are retried with exponential
+    backoff. When every attempt fails, the last good copy is used if there is one.
+
+    Args:
+    =====
+        url (str): An http(s) URL
+        path (str): Where to keep the downloaded copy
+        pool (ConnectionPool): Connections shared with other downloads
+                               Default is None, which uses a new pool
+        retries (int): Number of retries after the first attempt
+        backoff (float): Seconds before the first retry, doubled for each retry
+        chunk_size (int): Number of bytes read at a time
+
+    Raises:
+    =======
+        Exception: Error message will show if the download fails and there is no previous copy
+
+    Returns:
+    ========
+        result (dict): The "path" of the copy, its "status" ("downloaded", "not_modified"
+                       or "fallback") and the "error" that caused a fallback
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+    pool = pool or ConnectionPool()
+
+    error = None
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1) * random.uniform(1, 1.5))
+        try:
+            return {"path": path, "status": __attempt(url, path, pool, chunk_size), "error": None}
+        except RetryableError as e:
+            error = e
+        except Exception as e:
+            error = e
+            break
+
+    if os.path.exists(path) and os.path.exists(path + ".json"):
+        return {"path": path, "status": "fallback", "error": "{}".format(error)}
+    raise Exception("Could not download {}: {}".format(url, error))
+
+def fetch_sources(urls, dest_dir = DOWNLOADS_DIR, timeout = 30, retries = 4, backoff = 0.5):
+    """Download several URLs at the same time over pooled connections, see download()
+
+    Args:
+    =====
+        urls (list): The http(s) URLs
+        dest_dir (str): The directory of the downloaded copies
+        timeout (int): Seconds to wait for a connection or a read
+        retries (int): Number of retries of each download
+        backoff (float): Seconds before the first retry, doubled for each retry
+
+    Raises:
+    =======
+        Exception: Error message will show if a download fails and there is no previous copy
+
+    Returns:
+    ========
+        results (dict): The result of download() for each URL
+    """
+    urls = list(dict.fromkeys(urls))
+    pool = ConnectionPool(timeout = timeout)
+    try:
+        with ThreadPoolExecutor(max_workers = max(len(urls), 1)) as executor:
+            futures = {url: executor.submit(download, url, download_path(url, dest_dir), pool, retries, backoff)
+                       for url in urls}
+            return {url: future.result() for url, future in futures.items()}
+    finally:
+        pool.close()
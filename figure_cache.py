@@ -0,0 +1,201 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from cache import CACHE_DIR
+from utils import split_county, check_county, check_state
+
+FIGURE_CACHE_DIR = os.path.join(CACHE_DIR, "figures")
+
+class FigureCache:
+    """Cache of rendered figures, keyed by the query and the version of the dataset
+
+    Rendered figures (plotly JSON or image bytes) are kept in an in-memory LRU tier bounded
+    by max_bytes, and optionally in an on-disk tier bounded by max_disk_bytes that is shared
+    between processes and runs. The least recently used figures are evicted first.
+
+    The dataset version is part of every key, so figures of a previous version are never
+    returned. They are dropped from the in-memory tier as soon as a newer version is seen.
+    On disk, each version has its own directory and the figures of every version share
+    max_disk_bytes, so alternating versions (e.g. the live data and a --date snapshot) keep
+    their figures until they are the least recently used.
+    """
+
+    def __init__(self, max_bytes = 256 << 20, disk_dir = None, max_disk_bytes = 2 << 30):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.version = None
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, lookup, version, county, statistic, num_miles, fmt = "json", width = None, height = None, scale = None):
+        """Normalized key of a query
+
+        The county and state are replaced by their names in the data, so "middlesex county, ma"
+        and "Middlesex, Massachusetts" share an entry.
+
+        Args:
+        =====
+            lookup (CountyLookup): The lookup index of the dataframe from build_lookup()
+            version (str): The version of the dataframe, df.attrs["version"]
+            county (str): The county as passed to make_figure(), e.g. 'Barnstable County, MA'
+            statistic (str): COVID-19 statistic of interest
+            num_miles (int): The number of miles
+            fmt (str): "json" or an image format
+            width, height, scale: The image size, as passed to fig.to_image()
+
+        Returns:
+        ========
+            key (str): The key, or None if the query cannot be cached because the dataframe
+                       has no version or the county is not in the data
+        """
+        if version is None:
+            return None
+
+        try:
+            county, state = split_county(county)
+            state = check_state(lookup, state)
+            county = check_county(lookup, county, state)
+        except Exception:
+            return None
+
+        return json.dumps([version, county, state, statistic, int(num_miles), fmt.lower(), width, height, scale])
+
+    def __disk_path(self, key):
+        version = json.loads(key)[0]
+        return os.path.join(self.disk_dir,
+                            hashlib.sha256(version.encode()).hexdigest()[:16],
+                            hashlib.sha256(key.encode()).hexdigest()[:32])
+
+    def __check_version(self, key):
+        """Drop the in-memory entries of previous versions when a key of a new version comes in
+        """
+        version = json.loads(key)[0]
+        if version == self.version:
+            return
+
+        self.entries.clear()
+        self.num_bytes = 0
+        self.version = version
+
+    def get(self, key):
+        """Cached bytes of a key, or None on a miss
+
+        Args:
+        =====
+            key (str): A key from key()
+
+        Returns:
+        ========
+            body (bytes): The rendered figure, or None
+        """
+        with self.lock:
+            self.__check_version(key)
+
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return body
+
+            if self.disk_dir is not None:
+                path = self.__disk_path(key)
+                try:
+                    with open(path, "rb") as f:
+                        body = f.read()
+                    # The modification time orders the on-disk eviction
+                    os.utime(path)
+                except OSError:
+                    body = None
+                if body is not None:
+                    self.disk_hits += 1
+                    self.__put_memory(key, body)
+                    return body
+
+            self.misses += 1
+            return None
+
+    def put(self, key, body):
+        """Store the rendered figure of a key in both tiers
+
+        Args:
+        =====
+            key (str): A key from key()
+            body (bytes): The rendered figure
+        """
+        with self.lock:
+            self.__check_version(key)
+            self.__put_memory(key, body)
+            if self.disk_dir is not None:
+                self.__put_disk(key, body)
+
+    def __put_memory(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.num_bytes -= len(self.entries.pop(key))
+        self.entries[key] = body
+        self.num_bytes += len(body)
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last = False)
+            self.num_bytes -= len(evicted)
+            self.evictions += 1
+
+    def __put_disk(self, key, body):
+        # The disk tier is best effort, e.g. another process may be evicting the same files
+        path = self.__disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+            self.__evict_disk()
+        except OSError:
+            pass
+
+    def __evict_disk(self):
+        """Remove the least recently used figures of any version until the disk tier fits in max_disk_bytes
+        """
+        files = []
+        for version_dir in os.scandir(self.disk_dir):
+            if not version_dir.is_dir():
+                continue
+            for entry in os.scandir(version_dir.path):
+                if not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self.evictions += 1
+            # The directory of a version goes with its last figure
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+
+    def stats(self):
+        """Hit and miss counters and the size of the in-memory tier
+
+        Returns:
+        ========
+            stats (dict): hits (in memory), disk_hits, misses, evictions, entries and bytes
+        """
+        with self.lock:
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "evictions": self.evictions, "entries": len(self.entries), "bytes": self.num_bytes}
@@ -0,0 +1,309 @@
+import os
+import json
+import argparse
+import warnings
+
+import numpy as np
+
+import plotly.graph_objects as go
+from plotly.exceptions import PlotlyError
+
+from cache import CACHE_DIR
+
+# Simplification tolerances (in degrees) precomputed for every county and state shape,
+# 0 keeps the full resolution shapes
+SIMPLIFY_LEVELS = (0, 0.005, 0.02, 0.05)
+
+GEOMETRY_DIR = os.path.join(CACHE_DIR, "geometry")
+
+# Shapes already loaded in this process, keyed by (geometry directory, simplify level, state FIPS)
+__loaded = {}
+
+# State name to state FIPS of each geometry directory
+__state_fips = {}
+
+def simplify_level(num_miles):
+    """Pick the simplification of the shapes from the size of the plotted area
+
+    A single county or a small radius is drawn at full resolution, larger radii span
+    many states where the detail is not visible anyway.
+
+    Args:
+    =====
+        num_miles (int): The number of miles between 0 and 1000
+
+    Returns:
+    ========
+        (float): One of SIMPLIFY_LEVELS
+    """
+    if num_miles <= 25:
+        return 0
+    if num_miles <= 150:
+        return 0.005
+    if num_miles <= 500:
+        return 0.02
+    return 0.05
+
+def __level_dir(level, geometry_dir):
+    return os.path.join(geometry_dir, "simplify_{}".format(level))
+
+def __rings(geometry, tolerance):
+    """Exterior rings of a (multi)polygon, simplified, as x and y arrays separated by NaNs
+    """
+    polygons = [geometry] if geometry.geom_type == "Polygon" else list(geometry.geoms)
+    xs, ys = [], []
+    for polygon in polygons:
+        x, y = polygon.simplify(tolerance).exterior.xy
+        xs.extend([np.asarray(x), [np.nan]])
+        ys.extend([np.asarray(y), [np.nan]])
+    return np.concatenate(xs), np.concatenate(ys)
+
+def build_geometry_cache(geometry_dir = GEOMETRY_DIR, levels = SIMPLIFY_LEVELS):
+    """Precompute the county and state shapes at every simplification level and store them on disk
+
+    The shapes are the ones plotly's create_choropleth() uses (from the plotly-geo package).
+    They are written as one .npz file per state and level, holding every county of the state
+    keyed by FIPS, so a figure only loads the states it needs.
+
+    Args:
+    =====
+        geometry_dir (str): The directory of the geometry cache
+        levels (tuple): The simplification tolerances to precompute
+    """
+    # Only needed to build the cache, so they are imported here
+    from plotly.figure_factory import _county_choropleth
+
+    counties_gdf, states_gdf = _county_choropleth._create_us_counties_df(_county_choropleth.st_to_state_name_dict,
+                                                                         _county_choropleth.state_to_st_dict)
+    counties_gdf = counties_gdf.drop_duplicates("FIPS").sort_values("FIPS")
+
+    for level in levels:
+        os.makedirs(__level_dir(level, geometry_dir), exist_ok = True)
+
+        for statefp, state in states_gdf.groupby("STATEFP"):
+            counties = counties_gdf[counties_gdf["STATEFP"] == statefp]
+
+            state_x, state_y = [], []
+            for geometry in state["geometry"]:
+                outline_x, outline_y = __rings(geometry, level)
+                state_x.append(outline_x)
+                state_y.append(outline_y)
+
+            x, y, offsets = [], [], [0]
+            centroid_x, centroid_y, centroid_offsets = [], [], [0]
+            for geometry in counties["geometry"]:
+                county_x, county_y = __rings(geometry, level)
+                x.append(county_x)
+                y.append(county_y)
+                offsets.append(offsets[-1] + len(county_x))
+
+                polygons = [geometry] if geometry.geom_type == "Polygon" else list(geometry.geoms)
+                centroid_x.extend(polygon.centroid.x for polygon in polygons)
+                centroid_y.extend(polygon.centroid.y for polygon in polygons)
+                centroid_offsets.append(centroid_offsets[-1] + len(polygons))
+
+            np.savez(os.path.join(__level_dir(level, geometry_dir), "{}.npz".format(statefp)),
+                     fips = counties["FIPS"].to_numpy(dtype = np.int64),
+                     county_names = counties["COUNTY_NAME"].to_numpy(dtype = str),
+                     state_name = np.array(state["STATE_NAME"].iloc[0]),
+                     x = np.concatenate(x or [[]]).astype(np.float32),
+                     y = np.concatenate(y or [[]]).astype(np.float32),
+                     offsets = np.array(offsets, dtype = np.int64),
+                     centroid_x = np.array(centroid_x, dtype = np.float32),
+                     centroid_y = np.array(centroid_y, dtype = np.float32),
+                     centroid_offsets = np.array(centroid_offsets, dtype = np.int64),
+                     state_x = np.concatenate(state_x).astype(np.float32),
+                     state_y = np.concatenate(state_y).astype(np.float32))
+
+    state_fips = {name: statefp for statefp, name in zip(states_gdf["STATEFP"], states_gdf["STATE_NAME"])}
+    with open(os.path.join(geometry_dir, "states.json"), "w") as f:
+        json.dump({"levels": list(levels), "states": state_fips}, f, indent = 2)
+
+def load_state_fips(geometry_dir = GEOMETRY_DIR):
+    """Load the state name to state FIPS mapping, building the geometry cache if it does not exist yet
+
+    Args:
+    =====
+        geometry_dir (str): The directory of the geometry cache
+
+    Returns:
+    ========
+        (dict): A dictionary mapping each state name to its two digit FIPS
+    """
+    if geometry_dir not in __state_fips:
+        path = os.path.join(geometry_dir, "states.json")
+        if not os.path.exists(path):
+            build_geometry_cache(geometry_dir)
+        with open(path, "r") as f:
+            __state_fips[geometry_dir] = json.load(f)["states"]
+    return __state_fips[geometry_dir]
+
+def load_state_geometry(statefp, level, geometry_dir = GEOMETRY_DIR):
+    """Load the precomputed shapes of one state, the result is kept in memory for later figures
+
+    Args:
+    =====
+        statefp (str): The two digit state FIPS, e.g. '25'
+        level (float): One of SIMPLIFY_LEVELS
+        geometry_dir (str): The directory of the geometry cache
+
+    Returns:
+    ========
+        shapes (dict): The arrays of the state, or None if there are no shapes for the state
+    """
+    key = (geometry_dir, level, statefp)
+    if key not in __loaded:
+        path = os.path.join(__level_dir(level, geometry_dir), "{}.npz".format(statefp))
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as npz:
+            shapes = {name: npz[name] for name in npz.files}
+        shapes["state_name"] = str(shapes["state_name"])
+        shapes["position"] = {f: i for i, f in enumerate(shapes["fips"].tolist())}
+        __loaded[key] = shapes
+    return __loaded[key]
+
+def create_choropleth(fips, values, scope, colorscale, level = 0,
+                      show_state_data = True, show_hover = True, asp = 2.9,
+                      state_outline = None, county_outline = None, centroid_marker = None,
+                      legend_title = "", geometry_dir = GEOMETRY_DIR, **layout_options):
+    """Drop-in replacement of plotly's figure_factory.create_choropleth() using the geometry cache
+
+    Produces the same traces and layout, but the shapes are read from the precomputed
+    simplification level instead of reloading and simplifying the full resolution shapefiles,
+    and only the states of the plotted counties and of the scope are loaded.
+
+    Args:
+    =====
+        fips (list): FIPS of the counties
+        values (list): Value of each county
+        scope (list): Names of the states whose outline is drawn
+        colorscale (list): One color per distinct value
+        level (float): One of SIMPLIFY_LEVELS, see simplify_level()
+        geometry_dir (str): The directory of the geometry cache
+        The remaining arguments are the ones of plotly's create_choropleth()
+
+    Raises:
+    =======
+        PlotlyError: Error message will show if there are fewer colors than distinct values
+
+    Returns:
+    ========
+        fig (go.Figure): The choropleth figure
+    """
+    if level not in SIMPLIFY_LEVELS:
+        raise Exception("The simplification level must be one of {}".format(SIMPLIFY_LEVELS))
+
+    state_outline = state_outline or {"color": "rgb(240, 240, 240)", "width": 1}
+    county_outline = county_outline or {"color": "rgb(0, 0, 0)", "width": 0}
+    centroid_marker = dict(centroid_marker or {"size": 3, "color": "white"})
+    centroid_marker.setdefault("opacity", 1)
+
+    fips = [int(f) for f in fips]
+    values = list(values)
+
+    levels = sorted(set(values))
+    if len(colorscale) < len(levels):
+        raise PlotlyError("You have {} LEVELS. Your number of colors in 'colorscale' must "
+                          "be at least the number of LEVELS: {}.".format(len(levels), levels[:20]))
+    color_lookup = dict(zip(levels, colorscale))
+
+    state_fips = load_state_fips(geometry_dir)
+
+    x_traces = {value: [] for value in levels}
+    y_traces = {value: [] for value in levels}
+    x_centroids, y_centroids, centroid_text = [], [], []
+    fips_not_in_shapefile = []
+
+    for f, value in zip(fips, values):
+        shapes = load_state_geometry(str(f // 1000).zfill(2), level, geometry_dir)
+        i = shapes["position"].get(f) if shapes is not None else None
+        if i is None:
+            fips_not_in_shapefile.append(f)
+            continue
+
+        start, end = shapes["offsets"][i], shapes["offsets"][i + 1]
+        x_traces[value].append(shapes["x"][start:end])
+        y_traces[value].append(shapes["y"][start:end])
+
+        start, end = shapes["centroid_offsets"][i], shapes["centroid_offsets"][i + 1]
+        text = "County: {}<br>State: {}<br>FIPS: {}<br>Value: {}".format(shapes["county_names"][i], shapes["state_name"],
+                                                                          str(f).zfill(5), value)
+        x_centroids.extend(shapes["centroid_x"][start:end].tolist())
+        y_centroids.extend(shapes["centroid_y"][start:end].tolist())
+        centroid_text.extend([text] * (end - start))
+
+    if fips_not_in_shapefile:
+        warnings.warn("Unrecognized FIPS Values, these counties cannot be shown: {}".format(fips_not_in_shapefile))
+
+    plot_data = []
+    for value in levels:
+        plot_data.append(dict(type = "scatter", mode = "lines",
+                              x = np.concatenate(x_traces[value] or [[]]),
+                              y = np.concatenate(y_traces[value] or [[]]),
+                              line = county_outline, fill = "toself", fillcolor = color_lookup[value],
+                              name = value, hoverinfo = "none"))
+
+    if show_hover:
+        plot_data.append(dict(type = "scatter", showlegend = False, legendgroup = "centroids",
+                              x = x_centroids, y = y_centroids, text = centroid_text,
+                              name = "US Counties", mode = "markers",
+                              marker = {"color": "white", "opacity": 0}, hoverinfo = "text",
+                              selected = dict(marker = centroid_marker),
+                              unselected = dict(marker = dict(opacity = 0))))
+
+    if show_state_data:
+        state_x, state_y = [], []
+        for name in scope:
+            if name not in state_fips:
+                continue
+            shapes = load_state_geometry(state_fips[name], level, geometry_dir)
+            if shapes is not None:
+                state_x.extend([shapes["state_x"], [np.nan]])
+                state_y.extend([shapes["state_y"], [np.nan]])
+        plot_data.append(dict(type = "scatter", legendgroup = "States", line = state_outline,
+                              x = np.concatenate(state_x or [[]]), y = np.concatenate(state_y or [[]]),
+                              hoverinfo = "text", showlegend = False, mode = "lines"))
+
+    layout = dict(hovermode = "closest",
+                  xaxis = dict(autorange = False, showgrid = False, zeroline = False, fixedrange = True, showticklabels = False),
+                  yaxis = dict(autorange = False, showgrid = False, zeroline = False, fixedrange = True, showticklabels = False),
+                  margin = dict(t = 40, b = 20, r = 20, l = 20),
+                  width = 900,
+                  height = 450,
+                  dragmode = "select",
+                  legend = dict(traceorder = "reversed", xanchor = "right", yanchor = "top", x = 1, y = 1),
+                  annotations = [dict(x = 1, y = 1.05, xref = "paper", yref = "paper", xanchor = "right",
+                                      showarrow = False, text = "<b>" + legend_title + "</b>")])
+    layout.update(layout_options)
+
+    # Zoom on everything that is drawn, keeping the aspect ratio
+    xs = [np.asarray(trace["x"], dtype = np.float64) for trace in plot_data if len(trace["x"])]
+    ys = [np.asarray(trace["y"], dtype = np.float64) for trace in plot_data if len(trace["y"])]
+    if xs:
+        x_range = [float(np.nanmin(np.concatenate(xs))), float(np.nanmax(np.concatenate(xs)))]
+        y_range = [float(np.nanmin(np.concatenate(ys))), float(np.nanmax(np.concatenate(ys)))]
+        center = (sum(x_range) / 2.0, sum(y_range) / 2.0)
+        width = x_range[1] - x_range[0]
+        height = y_range[1] - y_range[0]
+        if width == 0 or height / width > 1 / asp:
+            x_range = [center[0] - asp * height * 0.5, center[0] + asp * height * 0.5]
+        else:
+            y_range = [center[1] - width / asp * 0.5, center[1] + width / asp * 0.5]
+        layout["xaxis"]["range"] = x_range
+        layout["yaxis"]["range"] = y_range
+
+    return go.Figure(dict(data = plot_data, layout = layout))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--geometry_dir",
+                        type = str,
+                        default = GEOMETRY_DIR,
+                        help = "The directory of the geometry cache")
+    args = parser.parse_args()
+
+    build_geometry_cache(args.geometry_dir)
+
+if __name__ == "__main__":
+    main()
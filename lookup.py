@@ -0,0 +1,157 @@
+import re
+import bisect
+import unicodedata
+
+import numpy as np
+
+# Words dropped from the end of county names, the NY Times data uses the bare name
+# (e.g. "Barnstable" for "Barnstable County", "Orleans" for "Orleans Parish")
+COUNTY_SUFFIXES = ("county", "parish", "borough", "census area", "municipality", "city and borough")
+
+def normalize_name(name):
+    """Normalize a county or state name for lookups
+
+    Lowercases, removes accents and extra whitespace, and drops suffixes like "County".
+
+    Args:
+    =====
+        name (str): A county or state name
+
+    Returns:
+    ========
+        (str): The normalized name, e.g. "Bayamón County" becomes "bayamon"
+    """
+    name = unicodedata.normalize("NFKD", str(name))
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    name = re.sub(r"\s+", " ", name).strip().lower()
+    for suffix in COUNTY_SUFFIXES:
+        if name.endswith(" " + suffix):
+            return name[:-len(suffix) - 1]
+    return name
+
+def trigrams(name):
+    """The set of character trigrams of a normalized name, padded so short names still have some
+    """
+    padded = "  {} ".format(name)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class CountyLookup:
+    """Lookup index of the counties and states of a dataframe from load_data()
+
+    Built once per dataset load with build_lookup(). It maps each normalized (county, state)
+    to its canonical names, FIPS and row positions, and each state to its counties, so
+    validating and selecting a county are exact dictionary lookups. Suggestions for misspelled
+    counties come from a prefix index and a trigram index over the county names.
+    """
+
+    def __init__(self, df):
+        groups = df.groupby(["county", "state"], sort = False, observed = True).indices
+        fips = df["fips"].to_numpy()
+
+        # (normalized county, normalized state) -> canonical (county, state), fips and rows
+        self.counties = {}
+        self.rows = {}
+        self.fips = {}
+        # normalized state -> canonical state and its canonical counties
+        self.states = {}
+        self.state_counties = {}
+
+        for (county, state), rows in groups.items():
+            key = (normalize_name(county), normalize_name(state))
+            self.counties[key] = (county, state)
+            self.rows[key] = np.sort(rows)
+            self.fips[key] = int(fips[rows[0]])
+            self.states[key[1]] = state
+            self.state_counties.setdefault(state, []).append(county)
+
+        # Every distinct normalized county name, sorted for the prefix index
+        self.names = sorted({county for county, _ in self.counties})
+        self.name_states = {}
+        for county, state in self.counties:
+            self.name_states.setdefault(county, []).append(state)
+
+        self.trigram_index = {}
+        for i, name in enumerate(self.names):
+            for trigram in trigrams(name):
+                self.trigram_index.setdefault(trigram, []).append(i)
+        self.trigram_index = {trigram: np.array(ids) for trigram, ids in self.trigram_index.items()}
+        self.name_trigram_counts = np.array([len(trigrams(name)) for name in self.names])
+
+    def find_state(self, state):
+        """Canonical name of a state, or None if it is not in the data
+        """
+        return self.states.get(normalize_name(state))
+
+    def find_county(self, county, state):
+        """Canonical (county, state) names, or None if the county is not in the data
+        """
+        return self.counties.get((normalize_name(county), normalize_name(state)))
+
+    def county_rows(self, county, state):
+        """Sorted row positions of a county in the dataframe, to be used with df.iloc
+        """
+        return self.rows[(normalize_name(county), normalize_name(state))]
+
+    def county_fips(self, county, state):
+        """FIPS of a county
+        """
+        return self.fips[(normalize_name(county), normalize_name(state))]
+
+    def suggest(self, county, state = None, limit = 5):
+        """Suggest the counties closest to a misspelled county name
+
+        Names starting with the input come first, followed by the names sharing the most
+        trigrams with it. Counties in the given state are preferred.
+
+        Args:
+        =====
+            county (str): The misspelled county
+            state (str): The state of the county, if known
+            limit (int): Maximum number of suggestions
+
+        Returns:
+        ========
+            suggestions (list): A list of canonical (county, state) tuples
+        """
+        name = normalize_name(county)
+        state = normalize_name(state) if state is not None else None
+
+        start = bisect.bisect_left(self.names, name)
+        prefix_matches = []
+        for candidate in self.names[start:start + limit]:
+            if not candidate.startswith(name):
+                break
+            prefix_matches.append(candidate)
+
+        query = trigrams(name)
+        ids = [self.trigram_index[trigram] for trigram in query if trigram in self.trigram_index]
+        if ids:
+            hits = np.bincount(np.concatenate(ids), minlength = len(self.names))
+            scores = hits / (len(query) + self.name_trigram_counts - hits)
+            best = np.argsort(-scores, kind = "stable")[:limit * 2]
+            trigram_matches = [self.names[i] for i in best if hits[i] > 0]
+        else:
+            trigram_matches = []
+
+        suggestions = []
+        for candidate in dict.fromkeys(prefix_matches + trigram_matches):
+            suggestions.extend(self.counties[(candidate, s)] for s in self.name_states[candidate])
+
+        # Stable sort, so the ranking is kept within and outside the state
+        if state is not None:
+            suggestions.sort(key = lambda pair: normalize_name(pair[1]) != state)
+        return suggestions[:limit]
+
+def build_lookup(df):
+    """Build the county and state lookup index of a dataframe from load_data()
+
+    Args:
+    =====
+        df (pd.DataFrame): A pandas DataFrame from load_data(), or a CompactData
+
+    Returns:
+    ========
+        lookup (CountyLookup): The lookup index
+    """
+    # The facts of a CompactData have the county, state and fips of every row
+    return CountyLookup(getattr(df, "facts", df))
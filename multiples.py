@@ -0,0 +1,511 @@
+import os
+import argparse
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import plotly.io as pio
+
+from data import NUMERIC_COLS, load_data
+from export import IMAGE_FORMATS, start_renderer
+from geometry import GEOMETRY_DIR, SIMPLIFY_LEVELS, load_state_fips, load_state_geometry, simplify_level
+from lookup import build_lookup
+from spatial import build_spatial_index
+from timeseries import TIMESERIES_DIR, read_dates, read_manifest, load_snapshot, store_from_args
+from utils import add_data_args, add_store_args, resolve_query
+
+# Colors of the value bins, shared by every panel and frame so they can be compared
+PALETTE = ["#ffffcc", "#ffeda0", "#fed976", "#feb24c", "#fd8d3c",
+           "#fc4e2a", "#e31a1c", "#bd0026", "#800026"]
+
+# Counties of the map without a value in a panel or frame
+MISSING_COLOR = "rgb(235, 235, 235)"
+
+class BaseMap:
+    """The shapes and layout of a set of counties, built once and recolored for every panel or frame
+
+    create_choropleth() groups the counties by value, one trace per distinct value, so the
+    shapes are regrouped for every new set of values. Here every county is its own trace,
+    and a panel or frame only sets the fill color of each county from the bin of its value.
+    The shapes are loaded, and the bins and layout computed, once for all of them.
+
+    Figures are plain dictionaries, written with plotly.io and validate = False, so
+    building them does not validate thousands of traces.
+
+    Attributes:
+    ===========
+        fips (np.ndarray): FIPS of the counties of the map, sorted
+        edges (np.ndarray): Edges of the value bins, one color of PALETTE per bin
+    """
+
+    def __init__(self, fips, scope = (), level = 0, values = None, legend_title = "", asp = 2.9,
+                 geometry_dir = GEOMETRY_DIR):
+        if level not in SIMPLIFY_LEVELS:
+            raise Exception("The simplification level must be one of {}".format(SIMPLIFY_LEVELS))
+        self.legend_title = legend_title
+
+        self.fips = []
+        self.shapes_x, self.shapes_y = [], []
+        self.names = []
+        centroid_x, centroid_y, centroid_counts = [], [], []
+        not_in_shapefile = []
+        for f in sorted({int(f) for f in fips}):
+            shapes = load_state_geometry(str(f // 1000).zfill(2), level, geometry_dir)
+            i = shapes["position"].get(f) if shapes is not None else None
+            if i is None:
+                not_in_shapefile.append(f)
+                continue
+            self.fips.append(f)
+            start, end = shapes["offsets"][i], shapes["offsets"][i + 1]
+            self.shapes_x.append(shapes["x"][start:end])
+            self.shapes_y.append(shapes["y"][start:end])
+            start, end = shapes["centroid_offsets"][i], shapes["centroid_offsets"][i + 1]
+            centroid_x.append(shapes["centroid_x"][start:end])
+            centroid_y.append(shapes["centroid_y"][start:end])
+            centroid_counts.append(end - start)
+            self.names.append("County: {}<br>State: {}<br>FIPS: {}".format(shapes["county_names"][i], shapes["state_name"],
+                                                                            str(f).zfill(5)))
+        if not_in_shapefile:
+            warnings.warn("Unrecognized FIPS Values, these counties cannot be shown: {}".format(not_in_shapefile))
+
+        self.fips = np.array(self.fips, dtype = np.int64)
+        self.names = np.array(self.names, dtype = object)
+        self.centroid_x = np.concatenate(centroid_x or [[]])
+        self.centroid_y = np.concatenate(centroid_y or [[]])
+        self.centroid_counts = np.array(centroid_counts, dtype = np.int64)
+
+        state_fips = load_state_fips(geometry_dir)
+        state_x, state_y = [], []
+        for name in scope:
+            shapes = load_state_geometry(state_fips[name], level, geometry_dir) if name in state_fips else None
+            if shapes is not None:
+                state_x.extend([shapes["state_x"], [np.nan]])
+                state_y.extend([shapes["state_y"], [np.nan]])
+        self.state_x = np.concatenate(state_x or [[]])
+        self.state_y = np.concatenate(state_y or [[]])
+
+        # Zoom on everything that is drawn, keeping the aspect ratio, like create_choropleth()
+        xs = np.concatenate(self.shapes_x + [self.state_x]).astype(np.float64)
+        ys = np.concatenate(self.shapes_y + [self.state_y]).astype(np.float64)
+        self.x_range, self.y_range = None, None
+        if np.isfinite(xs).any():
+            x_range = [float(np.nanmin(xs)), float(np.nanmax(xs))]
+            y_range = [float(np.nanmin(ys)), float(np.nanmax(ys))]
+            center = (sum(x_range) / 2.0, sum(y_range) / 2.0)
+            width = x_range[1] - x_range[0]
+            height = y_range[1] - y_range[0]
+            if width == 0 or height / width > 1 / asp:
+                x_range = [center[0] - asp * height * 0.5, center[0] + asp * height * 0.5]
+            else:
+                y_range = [center[1] - width / asp * 0.5, center[1] + width / asp * 0.5]
+            self.x_range, self.y_range = x_range, y_range
+
+        self.set_bins(values if values is not None else [])
+
+    def __len__(self):
+        return len(self.fips)
+
+    def set_bins(self, values):
+        """Set the value bins from every value that will be shown, quantiles of the finite values
+
+        Args:
+        =====
+            values (np.ndarray): The values of every panel or frame, of any shape
+        """
+        values = np.asarray(values, dtype = np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            self.edges = np.array([0.0, 1.0])
+            return
+        edges = np.unique(np.quantile(values, np.linspace(0, 1, len(PALETTE) + 1)))
+        self.edges = edges if len(edges) > 1 else np.array([edges[0], edges[0] + 1])
+
+    def align(self, fips, values):
+        """Values in the order of the counties of the map, NaN for the counties without one
+
+        Args:
+        =====
+            fips (list): FIPS of the counties with a value
+            values (list): Their values
+
+        Returns:
+        ========
+            (np.ndarray): One value per county of the map
+        """
+        fips = np.asarray(fips, dtype = np.int64)
+        values = np.asarray(values, dtype = np.float64)
+        aligned = np.full(len(self.fips), np.nan)
+        positions = np.minimum(np.searchsorted(self.fips, fips), max(len(self.fips) - 1, 0))
+        found = self.fips[positions] == fips if len(self.fips) else np.zeros(len(fips), dtype = bool)
+        aligned[positions[found]] = values[found]
+        return aligned
+
+    def colors(self, values):
+        """Fill color of every county for values from align()
+        """
+        values = np.asarray(values, dtype = np.float64)
+        bins = np.clip(np.searchsorted(self.edges, values, side = "right") - 1, 0, len(self.edges) - 2)
+        colors = np.array(PALETTE, dtype = object)[bins]
+        colors[~np.isfinite(values)] = MISSING_COLOR
+        return colors
+
+    def __hover_text(self, values):
+        text = [name if np.isnan(value) else "{}<br>Value: {:,.0f}".format(name, value)
+                for name, value in zip(self.names, values)]
+        return np.repeat(np.array(text, dtype = object), self.centroid_counts)
+
+    def __traces(self, colors, values, axis = ""):
+        """The traces of one panel: a trace per county, then the hover markers and the state outlines
+        """
+        axes = {"xaxis": "x" + axis, "yaxis": "y" + axis}
+        traces = [dict(type = "scatter", mode = "lines", x = x, y = y, fill = "toself", fillcolor = color,
+                       line = {"color": "rgb(15, 15, 55)", "width": 0.5}, hoverinfo = "none", showlegend = False, **axes)
+                  for x, y, color in zip(self.shapes_x, self.shapes_y, colors)]
+        traces.append(dict(type = "scatter", mode = "markers", x = self.centroid_x, y = self.centroid_y,
+                           text = self.__hover_text(values), hoverinfo = "text", showlegend = False,
+                           marker = {"color": "white", "opacity": 0}, **axes))
+        traces.append(dict(type = "scatter", mode = "lines", x = self.state_x, y = self.state_y, hoverinfo = "none",
+                           line = {"width": 1, "color": "rgb(120, 120, 120)"}, showlegend = False, **axes))
+        return traces
+
+    def __legend(self):
+        """One empty trace per bin, only shown in the legend
+        """
+        return [dict(type = "scatter", mode = "lines", x = [None], y = [None], fill = "toself", fillcolor = color,
+                     line = {"width": 0}, name = "{:,.0f} - {:,.0f}".format(low, high), hoverinfo = "none")
+                for color, low, high in zip(PALETTE, self.edges[:-1], self.edges[1:])]
+
+    def __axes(self, domain_x = (0, 1), domain_y = (0, 1), anchor = ""):
+        axis = dict(showgrid = False, zeroline = False, fixedrange = True, showticklabels = False, autorange = False)
+        x = dict(axis, domain = list(domain_x), range = self.x_range, anchor = "y" + anchor)
+        y = dict(axis, domain = list(domain_y), range = self.y_range, anchor = "x" + anchor)
+        return x, y
+
+    def __layout(self, title, width, height):
+        return dict(title = title, hovermode = "closest", width = width, height = height, dragmode = "select",
+                    plot_bgcolor = "white", margin = dict(t = 60, b = 20, r = 20, l = 20),
+                    # Outside of the panels, on the right
+                    legend = dict(traceorder = "reversed", xanchor = "left", yanchor = "top", x = 1.01, y = 1,
+                                  title = {"text": "<b>{}</b>".format(self.legend_title)}))
+
+    def figure(self, values, title = "", width = 900, height = 450):
+        """A single map, see small_multiples() for the arguments
+
+        Returns:
+        ========
+            fig (dict): The figure, written with plotly.io (e.g. pio.write_html(fig, path, validate = False))
+        """
+        return self.small_multiples([("", values)], cols = 1, title = title, width = width, height = height)
+
+    def small_multiples(self, panels, cols = 3, title = "", width = None, height = None):
+        """A grid of maps sharing the shapes, the bins and the legend
+
+        Args:
+        =====
+            panels (list): A (title, values) pair per panel, the values from align()
+            cols (int): Number of panels per row
+            title (str): Title of the figure
+            width, height (int): Size of the figure in pixels
+                                 Default is None, 400 x 250 pixels per panel
+
+        Returns:
+        ========
+            fig (dict): The figure, see figure()
+        """
+        cols = max(min(cols, len(panels)), 1)
+        rows = -(-len(panels) // cols)
+        width = width or max(400 * cols, 600)
+        height = height or 250 * rows + 80
+
+        data = []
+        layout = self.__layout(title, width, height)
+        annotations = []
+        gap = 0.02
+        for i, (panel_title, values) in enumerate(panels):
+            row, col = divmod(i, cols)
+            domain_x = (col / cols + gap, (col + 1) / cols - gap)
+            domain_y = (1 - (row + 1) / rows + gap, 1 - row / rows - gap * 3)
+            axis = "" if i == 0 else str(i + 1)
+            layout["xaxis" + axis], layout["yaxis" + axis] = self.__axes(domain_x, domain_y, axis)
+            data.extend(self.__traces(self.colors(values), values, axis))
+            annotations.append(dict(x = sum(domain_x) / 2, y = domain_y[1], xref = "paper", yref = "paper",
+                                    xanchor = "center", yanchor = "bottom", showarrow = False, text = panel_title))
+        layout["annotations"] = annotations
+        return dict(data = data + self.__legend(), layout = layout)
+
+    def animation(self, frames, title = "", width = 900, height = 500, duration = 200):
+        """An animated map with a frame per set of values, a slider and a play button
+
+        Every frame only carries the fill colors of the counties whose color changes at some
+        point of the animation, and the hover text, so a frame is proportional to the number
+        of changing values rather than to the size of the shapes. Frames stay correct when
+        the slider jumps between them.
+
+        Args:
+        =====
+            frames (list): A (name, values) pair per frame, e.g. the date and the values from align()
+            title (str): Title of the figure
+            width, height (int): Size of the figure in pixels
+            duration (int): Milliseconds per frame
+
+        Returns:
+        ========
+            fig (dict): The figure, see figure()
+        """
+        colors = [self.colors(values) for _, values in frames]
+        changing = np.flatnonzero(np.any(np.array(colors) != colors[0], axis = 0)) if colors else np.empty(0, dtype = np.int64)
+        hover = len(self)
+
+        fig = self.figure(frames[0][1], title, width, height)
+        fig["frames"] = [dict(name = str(name),
+                              data = [dict(fillcolor = color) for color in frame_colors[changing]] +
+                                     [dict(text = self.__hover_text(values))],
+                              traces = changing.tolist() + [hover])
+                         for (name, values), frame_colors in zip(frames, colors)]
+
+        play = dict(frame = dict(duration = duration, redraw = False), transition = dict(duration = 0), fromcurrent = True)
+        fig["layout"]["updatemenus"] = [dict(type = "buttons", direction = "left", x = 0, y = 0, xanchor = "left",
+                                             yanchor = "top", pad = dict(t = 30),
+                                             buttons = [dict(label = "Play", method = "animate", args = [None, play]),
+                                                        dict(label = "Pause", method = "animate",
+                                                             args = [[None], dict(frame = dict(duration = 0),
+                                                                                  mode = "immediate")])])]
+        fig["layout"]["sliders"] = [dict(x = 0.15, len = 0.85, y = 0, pad = dict(t = 30),
+                                         steps = [dict(label = str(name), method = "animate",
+                                                       args = [[str(name)], dict(frame = dict(duration = 0, redraw = False),
+                                                                                 mode = "immediate")])
+                                                  for name, _ in frames])]
+        return fig
+
+    def render_frames(self, frames, path, title = "", width = 900, height = 450, scale = None):
+        """Write one image per frame, e.g. results/middlesex_2020-08-01.png for path results/middlesex.png
+
+        A single figure is kept and only the fill colors that changed since the previous frame
+        are updated before each image is rendered.
+
+        Args:
+        =====
+            frames (list): A (name, values) pair per frame, see animation()
+            path (str): Path of the images, the frame name is added before the extension
+            title (str): Title of every image, the frame name is added to it
+            width, height, scale: The image size, see save_figure()
+
+        Returns:
+        ========
+            paths (list): The images written
+        """
+        start_renderer()
+
+        base, fmt = os.path.splitext(path)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+
+        fig = self.figure(frames[0][1], title, width, height)
+        previous = None
+        paths = []
+        for name, values in frames:
+            colors = self.colors(values)
+            changed = np.arange(len(self)) if previous is None else np.flatnonzero(colors != previous)
+            for i in changed:
+                fig["data"][i]["fillcolor"] = colors[i]
+            fig["data"][len(self)]["text"] = self.__hover_text(values)
+            fig["layout"]["title"] = "{} ({})".format(title, name) if title else str(name)
+            previous = colors
+
+            paths.append("{}_{}{}".format(base, name, fmt))
+            pio.write_image(fig, paths[-1], format = fmt.lstrip("."), width = width, height = height, scale = scale,
+                            validate = False)
+        return paths
+
+def __radius_fips(df, index, lookup, county, num_miles):
+    """FIPS and rows of the counties within num_miles of a county, like make_figure()
+    """
+    county, state = resolve_query(lookup, county, num_miles)
+
+    origin = lookup.county_rows(county, state)
+    if num_miles == 0:
+        rows = origin
+    else:
+        rows = index.query(df["latitude"].values[origin[0]], df["longitude"].values[origin[0]], num_miles)
+    return "{} County, {}".format(county, state), rows
+
+def compare_counties(df, counties, statistic = "cases", num_miles = 0, cols = 3, geometry_dir = GEOMETRY_DIR):
+    """Small multiples of several counties and their radius, on one base map of all of them
+
+    Args:
+    =====
+        df (pd.DataFrame): A pandas DataFrame from load_data() or load_snapshot(), one row per county
+        counties (list): The counties, e.g. ['Barnstable County, MA', 'Suffolk County, NY']
+        statistic (str): COVID-19 statistic of interest
+        num_miles (int): The number of miles between 0 and 1000
+        cols (int): Number of panels per row
+
+    Returns:
+    ========
+        fig (dict): The figure, see BaseMap.figure()
+    """
+    lookup = build_lookup(df)
+    index = build_spatial_index(df)
+    fips = df["fips"].to_numpy()
+    values = df[statistic].to_numpy()
+
+    selections = [__radius_fips(df, index, lookup, county, num_miles) for county in counties]
+    union = np.unique(np.concatenate([fips[rows] for _, rows in selections]))
+    scope = df["state"].iloc[np.concatenate([rows for _, rows in selections])].unique().tolist()
+
+    base = BaseMap(union, scope, simplify_level(num_miles), legend_title = "# of {}".format(statistic),
+                   geometry_dir = geometry_dir)
+    panels = [(name, base.align(fips[rows], values[rows])) for name, rows in selections]
+    base.set_bins(np.concatenate([values for _, values in panels]))
+
+    title = "COVID-19 {}".format(statistic) if num_miles == 0 else "COVID-19 {} within {} miles".format(statistic, num_miles)
+    return base.small_multiples(panels, cols, title)
+
+def history_frames(county, statistic = "cases", num_miles = 0, start = None, end = None, store_dir = TIMESERIES_DIR,
+                   geometry_dir = GEOMETRY_DIR):
+    """The base map of a county and its radius, and its values on every date of the time-series store
+
+    Args:
+    =====
+        county (str): A US county, e.g. 'Barnstable County, MA'
+        statistic (str): COVID-19 statistic of interest
+        num_miles (int): The number of miles between 0 and 1000
+        start, end (str): The first and last dates, e.g. '2020-08-01'
+                          Default is None, which is the last 30 days of the store
+        store_dir (str): The directory of the time-series store
+
+    Raises:
+    =======
+        Exception: Error message will show if the store has no data for the dates
+
+    Returns:
+    ========
+        base (BaseMap): The base map
+        frames (list): A (date, values) pair per date
+        name (str): The canonical name of the county
+    """
+    last_date = read_manifest(store_dir).get("last_date")
+    if last_date is None:
+        raise Exception("The time-series store is empty. Please run timeseries.py to update the data.")
+    end = end or last_date
+    start = start or (pd.Timestamp(end) - pd.Timedelta(days = 29)).strftime("%Y-%m-%d")
+
+    history = read_dates(start, end, columns = ["county", "state", "fips", "latitude", "longitude", statistic],
+                         store_dir = store_dir)
+    if history.empty:
+        raise Exception("There is no data from {} to {}. Please run timeseries.py to update the data.".format(start, end))
+
+    # The counties of the radius come from the last date
+    latest = history[history["date"] == history["date"].max()].reset_index(drop = True)
+    name, rows = __radius_fips(latest, build_spatial_index(latest), build_lookup(latest), county, num_miles)
+    fips = latest["fips"].to_numpy()[rows]
+
+    history = history[history["fips"].isin(fips)]
+    table = history.pivot_table(index = "date", columns = "fips", values = statistic, aggfunc = "sum")
+
+    base = BaseMap(fips, latest["state"].iloc[rows].unique().tolist(), simplify_level(num_miles),
+                   legend_title = "# of {}".format(statistic), geometry_dir = geometry_dir)
+    frames = [(date.strftime("%Y-%m-%d"), base.align(table.columns, row)) for date, row in zip(table.index, table.to_numpy())]
+    base.set_bins(np.concatenate([values for _, values in frames]))
+    return base, frames, name
+
+def load_multiples_args():
+    """Utility function to load the command line arguments of the small multiples and animations
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--counties",
+                        type = str,
+                        nargs = "+",
+                        required = True,
+                        help = """
+                        The counties, e.g. 'Barnstable County, MA' 'Suffolk County, NY'.
+                        Several counties are drawn as small multiples, a single county
+                        with --animate is animated over the dates of the time-series store
+                        """)
+
+    parser.add_argument("--statistic",
+                        type = str,
+                        default = "cases",
+                        choices = NUMERIC_COLS[1:],
+                        help = "The COVID-19 statistic of interest")
+
+    parser.add_argument("--num_miles",
+                        type = int,
+                        default = 0,
+                        help = "A number between 0 and 1000")
+
+    parser.add_argument("--cols",
+                        type = int,
+                        default = 3,
+                        help = "Number of small multiples per row")
+
+    parser.add_argument("--animate",
+                        action = "store_true",
+                        help = "Animate the county over the dates of the time-series store")
+
+    parser.add_argument("--start_date",
+                        type = str,
+                        default = None,
+                        help = "With --animate, the first date (default is 30 days before --end_date)")
+
+    parser.add_argument("--end_date",
+                        type = str,
+                        default = None,
+                        help = "With --animate, the last date (default is the last date of the store)")
+
+    parser.add_argument("--date",
+                        type = str,
+                        default = None,
+                        help = "Compare the totals on this date from the time-series store instead of the live data")
+
+    parser.add_argument("--output",
+                        type = str,
+                        required = True,
+                        help = """
+                        Path of the figure (.html, .png, .svg, ...). With --animate, an .html
+                        file is animated and an image format writes one image per date
+                        """)
+
+    add_data_args(parser)
+    add_store_args(parser)
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+    args = load_multiples_args()
+    fmt = os.path.splitext(args.output)[1].lstrip(".").lower()
+    directory = os.path.dirname(args.output)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+
+    if args.animate:
+        base, frames, name = history_frames(args.counties[0], args.statistic, args.num_miles, args.start_date, args.end_date,
+                                            store_from_args(args))
+        title = "{} COVID-19 {}".format(name, args.statistic)
+        if args.num_miles > 0:
+            title = "{} (within {} miles)".format(title, args.num_miles)
+        if fmt in IMAGE_FORMATS:
+            paths = base.render_frames(frames, args.output, title)
+            print("Wrote {} images, {} to {}".format(len(paths), paths[0], paths[-1]))
+            return
+        fig = base.animation(frames, title)
+    else:
+        if args.date is None:
+            df = load_data(args.nytimes_url, args.data_gov_url, refresh = args.refresh, offline = args.offline,
+                           chunksize = args.chunksize)
+        else:
+            df = load_snapshot(args.date, store_dir = store_from_args(args))
+        fig = compare_counties(df, args.counties, args.statistic, args.num_miles, args.cols)
+
+    if fmt in IMAGE_FORMATS:
+        pio.write_image(fig, args.output, format = fmt, validate = False)
+    else:
+        pio.write_html(fig, args.output, include_plotlyjs = "directory", validate = False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from cache import CACHE_DIR, is_url, source_version
+from distance import haversine_miles
+
+NEIGHBORS_DIR = os.path.join(CACHE_DIR, "neighbors")
+
+# Largest radius served by plot.py, the table holds every pair of counties up to it
+MAX_MILES = 1000
+
+# Bump when the layout of the table changes, tables of another format are ignored
+NEIGHBORS_FORMAT = 1
+
+ARRAYS = ["offsets", "neighbors", "distances", "latitude", "longitude"]
+
+# Centroids and their grid index in a build worker, set once by __init_worker()
+__worker = {}
+
+def __init_worker(geocode_df):
+    import pandas as pd
+
+    from spatial import build_spatial_index
+
+    # One county per row, even if two rows share a county name
+    positions = pd.DataFrame({"county_id": np.arange(len(geocode_df))})
+    __worker["index"] = build_spatial_index(positions, counties = geocode_df)
+
+def __build_chunk(origins, max_miles):
+    """Neighbors of some counties, each sorted by distance (then by position for ties)
+
+    Returns:
+    ========
+        counts (np.ndarray): Number of neighbors of each origin
+        neighbors (np.ndarray): Positions of the neighbors, origin after origin
+        distances (np.ndarray): Their distances in miles
+    """
+    index = __worker["index"]
+    counts, neighbors, distances = [], [], []
+    for origin in origins:
+        lat, lon = index.latitude[origin], index.longitude[origin]
+        found = index.query_counties(lat, lon, max_miles)
+        found_distances = haversine_miles(lat, lon, index.latitude[found], index.longitude[found])
+        order = np.lexsort((found, found_distances))
+        counts.append(len(found))
+        neighbors.append(found[order])
+        distances.append(found_distances[order])
+    return (np.array(counts, dtype = np.int64), np.concatenate(neighbors + [np.empty(0, dtype = np.int64)]),
+            np.concatenate(distances + [np.empty(0)]).astype(np.float32))
+
+def build_neighbor_table(geocode_df, neighbors_dir = NEIGHBORS_DIR, max_miles = MAX_MILES, workers = None,
+                         geocodes_version = None):
+    """Precompute the neighbors of every county within max_miles, sorted by great-circle distance
+
+    The table is stored in CSR form, as .npy files: the neighbors of county i are
+    neighbors[offsets[i]:offsets[i + 1]], nearest first (the county itself at 0 miles),
+    and distances holds their distances as float32. Positions are int16 when there are
+    fewer than 32,768 counties. The counties are split between worker processes, each
+    finding the neighbors of its counties through a grid index over the centroids.
+
+    Args:
+    =====
+        geocode_df (pd.DataFrame): The geocodes from load_geocodes(), one row per county
+        neighbors_dir (str): The directory of the table, replaced as a whole
+        max_miles (float): The largest radius the table answers
+        workers (int): Number of worker processes
+                       Default is None, which uses one per CPU core
+        geocodes_version (str): The version of the geocodes source, kept in the header
+
+    Returns:
+    ========
+        header (dict): The header of the table, with its counties and number of pairs
+    """
+    geocode_df = geocode_df.reset_index(drop = True)
+    workers = workers or os.cpu_count()
+    chunks = np.array_split(np.arange(len(geocode_df)), max(workers * 4, 1))
+
+    with ProcessPoolExecutor(max_workers = workers, initializer = __init_worker, initargs = (geocode_df,)) as executor:
+        results = list(executor.map(__build_chunk, chunks, [max_miles] * len(chunks)))
+
+    counts = np.concatenate([result[0] for result in results])
+    id_dtype = np.int16 if len(geocode_df) <= np.iinfo(np.int16).max else np.int32
+    arrays = {"offsets": np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+              "neighbors": np.concatenate([result[1] for result in results]).astype(id_dtype),
+              "distances": np.concatenate([result[2] for result in results]),
+              "latitude": geocode_df["latitude"].to_numpy(dtype = np.float64),
+              "longitude": geocode_df["longitude"].to_numpy(dtype = np.float64)}
+
+    header = {"format": NEIGHBORS_FORMAT,
+              "geocodes_version": geocodes_version,
+              "max_miles": max_miles,
+              "pairs": int(counts.sum()),
+              "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "counties": geocode_df[["county", "state"]].astype(str).values.tolist()}
+
+    # Written next to the old table and swapped in once complete
+    tmp_dir = neighbors_dir.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors = True)
+    os.makedirs(tmp_dir)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), values)
+    with open(os.path.join(tmp_dir, "header.json"), "w") as f:
+        json.dump(header, f)
+    shutil.rmtree(neighbors_dir, ignore_errors = True)
+    os.replace(tmp_dir, neighbors_dir)
+
+    return header
+
+class NeighborTable:
+    """The precomputed neighbor table of build_neighbor_table(), memory-mapped
+
+    Nothing is read until a county is queried, and a query only touches the pages of that
+    county's slice: the counties within a radius are the prefix of the slice up to the
+    radius, found by a binary search on its sorted distances.
+
+    Attributes:
+    ===========
+        max_miles (float): The largest radius the table answers
+        counties (list): The (county, state) pair of every position
+        latitude, longitude (np.ndarray): The centroid of every position
+    """
+
+    def __init__(self, neighbors_dir, header):
+        self.neighbors_dir = neighbors_dir
+        self.header = header
+        self.max_miles = header["max_miles"]
+        self.counties = [tuple(county) for county in header["counties"]]
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(neighbors_dir, name + ".npy"), mmap_mode = "r"))
+
+    def __len__(self):
+        return len(self.counties)
+
+    def position(self, county, state):
+        """Position of a county in the table, None if it is not in it
+        """
+        if not hasattr(self, "positions"):
+            self.positions = {key: i for i, key in enumerate(self.counties)}
+        return self.positions.get((county, state))
+
+    def within(self, position, num_miles):
+        """Counties within num_miles of a county, nearest first
+
+        Args:
+        =====
+            position (int): Position of the origin county in the table
+            num_miles (float): The radius in miles, at most max_miles
+
+        Raises:
+        =======
+            Exception: Error message will show if the radius is over the radius of the table
+
+        Returns:
+        ========
+            neighbors (np.ndarray): Positions of the counties inside the circle, the origin included
+            distances (np.ndarray): Their distances in miles
+        """
+        if num_miles > self.max_miles:
+            raise Exception("The neighbor table only holds the counties within {} miles".format(self.max_miles))
+        start, end = int(self.offsets[position]), int(self.offsets[position + 1])
+        distances = self.distances[start:end]
+        stop = int(np.searchsorted(distances, num_miles, side = "right"))
+        return np.asarray(self.neighbors[start:start + stop], dtype = np.int64), np.asarray(distances[:stop])
+
+def open_neighbor_table(neighbors_dir = NEIGHBORS_DIR):
+    """Open the neighbor table, only its header is read
+
+    Args:
+    =====
+        neighbors_dir (str): The directory of the table
+
+    Returns:
+    ========
+        table (NeighborTable): The table, or None if it is missing or has another format
+    """
+    path = os.path.join(neighbors_dir, "header.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        header = json.load(f)
+    if header.get("format") != NEIGHBORS_FORMAT:
+        return None
+    return NeighborTable(neighbors_dir, header)
+
+class NeighborIndex:
+    """A spatial index answering radius queries from the neighbor table
+
+    Same interface as CountyGridIndex (query(), query_counties(), rows_of_counties(),
+    latitude and longitude), which it wraps: a query whose origin is a county centroid and
+    whose radius is within the table is a slice of the table, any other query goes to the
+    grid index. The counties of the grid index are matched to the table by their centroid.
+    Distances are stored as float32, so a county within about 0.0001 miles of the edge of
+    the circle may land on the other side of it than with the grid index.
+    """
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+        self.latitude = index.latitude
+        self.longitude = index.longitude
+
+        positions = {(lat, lon): i for i, (lat, lon) in enumerate(zip(table.latitude.tolist(), table.longitude.tolist()))}
+        # Grid index position of every table position, -1 for the counties without rows
+        self.to_index = np.full(len(table), -1, dtype = np.int64)
+        self.origins = {}
+        for i, key in enumerate(zip(index.latitude.tolist(), index.longitude.tolist())):
+            position = positions.get(key)
+            if position is not None:
+                self.to_index[position] = i
+                self.origins[key] = position
+        self.complete = len(self.origins) == len(index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def query_counties(self, lat, lon, num_miles):
+        """Counties whose centroid is within num_miles of the origin, see CountyGridIndex.query_counties()
+        """
+        position = self.origins.get((float(lat), float(lon)))
+        if position is None or num_miles > self.table.max_miles:
+            return self.index.query_counties(lat, lon, num_miles)
+        counties = self.to_index[self.table.within(position, num_miles)[0]]
+        return counties[counties >= 0]
+
+    def query(self, lat, lon, num_miles):
+        """Rows of the dataframe whose county centroid is within num_miles of the origin, see CountyGridIndex.query()
+        """
+        return self.index.rows_of_counties(self.query_counties(lat, lon, num_miles))
+
+    def rows_of_counties(self, counties):
+        return self.index.rows_of_counties(counties)
+
+def attach_neighbor_table(index, neighbors_dir = NEIGHBORS_DIR):
+    """Answer the radius queries of a spatial index from the neighbor table, when there is an up to date one
+
+    Args:
+    =====
+        index (CountyGridIndex): A spatial index from build_spatial_index()
+        neighbors_dir (str): The directory of the table
+
+    Returns:
+    ========
+        index (NeighborIndex or CountyGridIndex): The index wrapped around the table, or index
+                                                  itself without a table or when some of its
+                                                  counties are not in the table
+    """
+    table = open_neighbor_table(neighbors_dir)
+    if table is None:
+        return index
+    neighbor_index = NeighborIndex(table, index)
+    if not neighbor_index.complete:
+        print("The neighbor table in {} is out of date, please rebuild it with python neighbors.py".format(neighbors_dir))
+        return index
+    return neighbor_index
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_gov_url",
+                        type = str,
+                        default = "https://data.healthcare.gov/resource/geocodes-usa-with-counties.json",
+                        help = "URL or local path of the US counties geocodes data")
+    parser.add_argument("--neighbors_dir",
+                        type = str,
+                        default = NEIGHBORS_DIR,
+                        help = "The directory of the neighbor table")
+    parser.add_argument("--max_miles",
+                        type = int,
+                        default = MAX_MILES,
+                        help = "The largest radius the table answers")
+    parser.add_argument("--workers",
+                        type = int,
+                        default = None,
+                        help = "Number of worker processes, one per CPU core by default")
+    args = parser.parse_args()
+
+    from data import load_geocodes
+    from fetch import fetch_sources
+
+    path = args.data_gov_url
+    if is_url(path):
+        path = fetch_sources([path], os.path.join(CACHE_DIR, "downloads"))[path]["path"]
+
+    start = time.perf_counter()
+    header = build_neighbor_table(load_geocodes(path), args.neighbors_dir, args.max_miles, args.workers,
+                                  source_version(path))
+    size = sum(os.path.getsize(os.path.join(args.neighbors_dir, name + ".npy")) for name in ARRAYS)
+    print("Wrote {} ({:,} counties, {:,} pairs within {} miles, {:.1f} MB) in {:.1f} s".format(
+          args.neighbors_dir, len(header["counties"]), header["pairs"], args.max_miles, size / 1e6,
+          time.perf_counter() - start))
+
+if __name__ == "__main__":
+    main()
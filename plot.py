@@ -1,17 +1,43 @@
+import os
+import json
 import warnings
 warnings.filterwarnings("ignore")
 
-import pandas as pd
-import numpy as np
-
-import plotly.figure_factory as ff
-import plotly.graph_objects as go
-
-from data import load_data
-from utils import load_state_abbrevs, load_args, calculate_surrounding_coords, check_county, check_state
-
-def plot(df, county = "Barnstable County, MA", statistic = "cases", num_miles = 0):
-    """Plot the user-specified county visualizing the user-specified statistic
+# pandas, numpy, plotly and the data pipeline are imported by the functions using them,
+# so --help, a bad county or a figure from the cache answer without loading them
+from cache import read_manifest, source_versions
+from export import IMAGE_FORMATS, start_renderer, save_figure
+from figure_cache import FigureCache, FIGURE_CACHE_DIR
+from prebuilt import PREBUILT_PATH, open_prebuilt, write_prebuilt
+from profiling import Profiler, stage
+from utils import load_args, split_county, resolve_query
+
+# Counties that share their name with a county in another state
+SAME_NAME_COUNTIES = {("Suffolk", "Massachusetts"), ("Bristol", "Massachusetts"),
+                      ("Suffolk", "New York"), ("Bristol", "Rhode Island")}
+
+# The figure template, built once and shared by every figure
+COLORSCALE = ["#8dd3c7", "#ffffb3", "#bebada", "#fb8072",
+              "#80b1d3", "#fdb462", "#b3de69", "#fccde5",
+              "#d9d9d9", "#bc80bd", "#ccebc5", "#ffed6f"] * 3
+
+CHOROPLETH_STYLE = dict(colorscale = COLORSCALE, 
+                        show_state_data = True,
+                        show_hover = True,
+                        asp = 2.9,
+                        county_outline = {'color': 'rgb(15, 15, 55)', 'width': 0.5},
+                        state_outline = {'width': 1})
+
+# Radius plots of other counties hide the centroid markers
+RADIUS_CHOROPLETH_STYLE = dict(colorscale = COLORSCALE, 
+                               show_state_data = True,
+                               show_hover = True,
+                               centroid_marker = {"opacity": 0},
+                               asp = 2.9,
+                               state_outline = {'width': 1})
+
+def make_figure(df, county = "Barnstable County, MA", statistic = "cases", num_miles = 0, index = None, lookup = None):
+    """Build the figure of the user-specified county visualizing the user-specified statistic
 
     If the number of miles specified is 0, plot the entire county of the user-specified
     statistic, else plot the area of the county based on the specified number of miles (> 0).
@@ -31,213 +57,304 @@ def plot(df, county = "Barnstable County, MA", statistic = "cases", num_miles =
     merged_df[merged_df.county.isin(v.index[v.gt(1)])]
     ```
 
-    To deal with this (since there weren't that many), my approach was if any of these 
-    special case counties and states are specified, implement another if-else conditional
-    under the specified number of miles. See below.
+    The county is always selected by its exact (county, state) pair through the lookup index,
+    so these counties only differ in the scope, title and style of their figure. See below.
+
+    The rows of the figure are selected with df.take(), so df can also be a CompactData
+    (see load_data(compact = True)), of which only these rows are expanded.
 
     Args:
     =====
-        df (pd.DataFrame): A pandas DataFrame from load_data()
+        df (pd.DataFrame): A pandas DataFrame from load_data(), or a CompactData
         county (str): A US county
                       Default is 'Barnstable County, MA'
         statistic (str): COVID-19 statistic of interest
                          Default is 'cases'
         num_miles (int): The number of miles between 0 and 1000
                          Default is 0
+        index (CountyGridIndex): The spatial index of df from build_spatial_index()
+                                 Default is None, which builds it on the fly
+        lookup (CountyLookup): The county and state lookup index of df from build_lookup()
+                               Default is None, which builds it on the fly
+
+    Returns:
+    ========
+        fig (go.Figure): The choropleth figure
     """
-    # Split the user-specified county string and extract only the county
-    # For example, the user specified county is "Barnstable County, MA",
-    # extract the county "Barnstable" and the state "MA"
-    split_county = county.split(" County, ")
-    county = split_county[0]
-    state = split_county[1]
+    from geometry import create_choropleth, simplify_level
+    from lookup import build_lookup
+    from spatial import build_spatial_index
 
-    state_abbrevs = load_state_abbrevs()
+    if lookup is None:
+        with stage("build_lookup", rows = len(df)):
+            lookup = build_lookup(df)
 
-    # Check if user inputted county and state exists in the dataframe
-    county = check_county(df, county)
+    # The user-specified county string, e.g. "Barnstable County, MA", as it is named in the
+    # dataframe, and a radius between 0 and 1000
+    county, state = resolve_query(lookup, county, num_miles)
 
-    state = state_abbrevs[state]
-    
-    state = check_state(df, state)
+    if num_miles > 0 and index is None:
+        with stage("build_spatial_index", rows = len(df)):
+            index = build_spatial_index(df)
+
+    special_case = (county, state) in SAME_NAME_COUNTIES
 
-    # Check to make sure num_miles is within the range of 0 and 1000
-    if num_miles < 0 or num_miles > 1000:
-        raise Exception("Please input a number between 0 and 1000")
-    
     # If the user specifies no miles, then plot the entire county
     # with the specified statistic
     if num_miles == 0:
-        if (county == "Suffolk" and state == "Massachusetts") \
-            or (county == "Bristol" and state == "Massachusetts") \
-            or (county == "Suffolk" and state == "New York") \
-            or (county == "Bristol" and state == "Rhode Island"):
-            
+        if special_case:
             scope = [county, state]
-
-            sample = df[(df["county"].isin(scope)) & (df["state"].isin(scope))]
-
-            values = sample[statistic].tolist()
-            fips = sample["fips"].tolist()
-
-            colorscale = ["#8dd3c7", "#ffffb3", "#bebada", "#fb8072",
-                         "#80b1d3", "#fdb462", "#b3de69", "#fccde5",
-                         "#d9d9d9", "#bc80bd", "#ccebc5", "#ffed6f",
-                         "#8dd3c7", "#ffffb3", "#bebada", "#fb8072",
-                         "#80b1d3", "#fdb462", "#b3de69", "#fccde5",
-                         "#d9d9d9", "#bc80bd", "#ccebc5", "#ffed6f",
-                         "#8dd3c7", "#ffffb3", "#bebada", "#fb8072",
-                         "#80b1d3", "#fdb462", "#b3de69", "#fccde5",
-                         "#d9d9d9", "#bc80bd", "#ccebc5", "#ffed6f"]
-
-            fig = ff.create_choropleth(
-                fips = fips, 
-                values = values, 
-                scope = scope,
-                colorscale = colorscale, 
-                show_state_data = True,
-                show_hover = True,
-                asp = 2.9,
-                county_outline={'color': 'rgb(15, 15, 55)', 'width': 0.5},
-                simplify_county = 0,
-                simplify_state = 0, 
-                state_outline = {'width': 1},
-                legend_title = '# of {}'.format(statistic),
-                title = '{} County, {} COVID-19 {}'.format(county, state, statistic)
-            )
-
-            fig.layout.template = None
-            fig.update_geos(fitbounds = "locations")
-            fig.show()
-        
         else:
             scope = [county]
 
-            sample = df[df["county"].isin(scope)]
-
-            values = sample[statistic].tolist()
-            fips = sample["fips"].tolist()
-
-            colorscale = ["#8dd3c7", "#ffffb3", "#bebada", "#fb8072",
-                         "#80b1d3", "#fdb462", "#b3de69", "#fccde5",
-                         "#d9d9d9", "#bc80bd", "#ccebc5", "#ffed6f",
-                         "#8dd3c7", "#ffffb3", "#bebada", "#fb8072",
-                         "#80b1d3", "#fdb462", "#b3de69", "#fccde5",
-                         "#d9d9d9", "#bc80bd", "#ccebc5", "#ffed6f",
-                         "#8dd3c7", "#ffffb3", "#bebada", "#fb8072",
-                         "#80b1d3", "#fdb462", "#b3de69", "#fccde5",
-                         "#d9d9d9", "#bc80bd", "#ccebc5", "#ffed6f"]
-
-            fig = ff.create_choropleth(
-                fips = fips, 
-                values = values, 
-                scope = scope,
-                colorscale = colorscale, 
-                show_state_data = True,
-                show_hover = True,
-                asp = 2.9,
-                county_outline={'color': 'rgb(15, 15, 55)', 'width': 0.5},
-                simplify_county = 0,
-                simplify_state = 0, 
-                state_outline = {'width': 1},
-                legend_title = '# of {}'.format(statistic),
-                title = '{} County, {} COVID-19 {}'.format(county, state, statistic)
-            )
-
-            fig.layout.template = None
-            fig.update_geos(fitbounds = "locations")
-            fig.show()
+        sample = df.take(lookup.county_rows(county, state))
+
+        title = '{} County, {} COVID-19 {}'.format(county, state, statistic)
+        style = CHOROPLETH_STYLE
     
     # Else plot the area based on the number of miles specified
     else:
-        if (county == "Suffolk" and state == "Massachusetts") \
-            or (county == "Bristol" and state == "Massachusetts") \
-            or (county == "Suffolk" and state == "New York") \
-            or (county == "Bristol" and state == "Rhode Island"):
-
-            sample = df[(df["county"].isin([county])) & (df["state"].isin([state]))]
-            lat, lon = calculate_surrounding_coords(sample, num_miles)
-
-            # Here, I filtered out the counties and states that do not meet the specified radius
-            # Remember:
-            # lat = [north, east, south, west]
-            # long = [north, east, south, west]
-            new_df = df[(df.latitude < lat[0]) & (df.latitude > lat[2]) & (df.longitude > lon[3]) & (df.longitude < lon[1])]
-
-            values = new_df[statistic].tolist()
-            fips = new_df["fips"].tolist()
-
-            colorscale = ["#8dd3c7", "#ffffb3", "#bebada", "#fb8072",
-                         "#80b1d3", "#fdb462", "#b3de69", "#fccde5",
-                         "#d9d9d9", "#bc80bd", "#ccebc5", "#ffed6f",
-                         "#8dd3c7", "#ffffb3", "#bebada", "#fb8072",
-                         "#80b1d3", "#fdb462", "#b3de69", "#fccde5",
-                         "#d9d9d9", "#bc80bd", "#ccebc5", "#ffed6f",
-                         "#8dd3c7", "#ffffb3", "#bebada", "#fb8072",
-                         "#80b1d3", "#fdb462", "#b3de69", "#fccde5",
-                         "#d9d9d9", "#bc80bd", "#ccebc5", "#ffed6f"]
-
-            fig = ff.create_choropleth(
-                fips = fips, 
-                values = values, 
-                scope = list(set(new_df["state"].tolist())),
-                colorscale = colorscale, 
-                show_state_data = True,
-                show_hover = True,
-                asp = 2.9,
-                county_outline={'color': 'rgb(15, 15, 55)', 'width': 0.5},
-                simplify_county = 0,
-                simplify_state = 0, 
-                state_outline = {'width': 1},
-                legend_title = '# of {}'.format(statistic),
-                title = '{} County, {} <br> (within {} miles) COVID-19 {}'.format(county, state, num_miles, statistic)
-            )
-
-            fig.layout.template = None
-            fig.update_geos(fitbounds = "locations")
-            fig.show()
-            
+        origin = df.take(lookup.county_rows(county, state))
+        if special_case:
+            title = '{} County, {} <br> (within {} miles) COVID-19 {}'.format(county, state, num_miles, statistic)
+            style = CHOROPLETH_STYLE
         else:
-            sample = df[df["county"].isin([county])]
-            lat, lon = calculate_surrounding_coords(sample, num_miles)
-            new_df = df[(df.latitude < lat[0]) & (df.latitude > lat[2]) & (df.longitude > lon[3]) & (df.longitude < lon[1])]
-
-            values = new_df[statistic].tolist()
-            fips = new_df["fips"].tolist()
-
-            colorscale = ["#8dd3c7", "#ffffb3", "#bebada", "#fb8072",
-                         "#80b1d3", "#fdb462", "#b3de69", "#fccde5",
-                         "#d9d9d9", "#bc80bd", "#ccebc5", "#ffed6f",
-                         "#8dd3c7", "#ffffb3", "#bebada", "#fb8072",
-                         "#80b1d3", "#fdb462", "#b3de69", "#fccde5",
-                         "#d9d9d9", "#bc80bd", "#ccebc5", "#ffed6f",
-                         "#8dd3c7", "#ffffb3", "#bebada", "#fb8072",
-                         "#80b1d3", "#fdb462", "#b3de69", "#fccde5",
-                         "#d9d9d9", "#bc80bd", "#ccebc5", "#ffed6f"]
-
-            fig = ff.create_choropleth(
-                fips = fips, 
-                values = values, 
-                scope = list(set(new_df["state"].tolist())),
-                colorscale = colorscale, 
-                show_state_data = True,
-                show_hover = True,
-                centroid_marker = {"opacity": 0},
-                asp = 2.9,
-                state_outline = {'width': 1},
-                legend_title = '# of {}'.format(statistic),
-                title = '{} County, {} (within {} miles) COVID-19 {}'.format(county, state, num_miles, statistic)
-            )
-
-            fig.layout.template = None
-            fig.update_geos(fitbounds = "locations")
-            fig.show()
+            title = '{} County, {} (within {} miles) COVID-19 {}'.format(county, state, num_miles, statistic)
+            style = RADIUS_CHOROPLETH_STYLE
+
+        # Here, I filtered out the counties and states that are further than the specified
+        # number of miles from the county, using the spatial index
+        with stage("radius_filter") as record:
+            rows = index.query(origin["latitude"].values[0], origin["longitude"].values[0], num_miles)
+            sample = df.take(rows)
+            record["rows"] = len(sample)
+        scope = list(set(sample["state"].tolist()))
+
+    # Snapshots of the time-series store say which dates they show
+    if "dates" in df.attrs:
+        title = '{} <br> ({})'.format(title, df.attrs["dates"])
+
+    # The shapes come from the precomputed geometry cache, simplified according to the radius
+    with stage("create_choropleth", rows = len(sample)):
+        fig = create_choropleth(
+            fips = sample["fips"].tolist(), 
+            values = sample[statistic].tolist(), 
+            scope = scope,
+            level = simplify_level(num_miles),
+            legend_title = '# of {}'.format(statistic),
+            title = title,
+            **style
+        )
+
+        fig.layout.template = None
+        fig.update_geos(fitbounds = "locations")
+
+    return fig
+
+def render_figure(df, county = "Barnstable County, MA", statistic = "cases", num_miles = 0, fmt = "json",
+                  index = None, lookup = None, cache = None, width = None, height = None, scale = None):
+    """Build the figure from make_figure() and serialize it, through the figure cache if one is given
+
+    Args:
+    =====
+        df, county, statistic, num_miles, index, lookup: See make_figure()
+        fmt (str): "json" for the plotly figure JSON, or an image format, e.g. "png" or "svg"
+        cache (FigureCache): The figure cache
+                             Default is None, which always builds the figure
+        width, height, scale: The image size, see save_figure()
+
+    Returns:
+    ========
+        body (bytes): The figure JSON or the image
+    """
+    if lookup is None:
+        from lookup import build_lookup
+        lookup = build_lookup(df)
+
+    key = None
+    if cache is not None:
+        key = cache.key(lookup, df.attrs.get("version"), county, statistic, num_miles, fmt, width, height, scale)
+    if key is not None:
+        body = cache.get(key)
+        if body is not None:
+            return body
+
+    fig = make_figure(df, county, statistic, num_miles, index, lookup)
+    if fmt == "json":
+        body = fig.to_json().encode()
+    else:
+        body = fig.to_image(format = fmt, width = width, height = height, scale = scale)
+
+    if key is not None:
+        cache.put(key, body)
+    return body
+
+def plot(df, county = "Barnstable County, MA", statistic = "cases", num_miles = 0, index = None, lookup = None, cache = None,
+         date = None, end_date = None, store_dir = None):
+    """Plot the user-specified county visualizing the user-specified statistic
+
+    Opens the figure from make_figure() in the web browser, see make_figure() for the arguments.
+    With a FigureCache, repeated queries on the same data reuse the figure JSON of the first one.
+
+    With a date, df is not used: the figure shows the totals on that date, or the increase
+    from date to end_date, read from the time-series store (see timeseries.load_snapshot()).
+
+    Args:
+    =====
+        date (str): The date, or the first date of the range, e.g. '2020-09-01'
+                    Default is None, which plots df
+        end_date (str): The last date of the range
+        store_dir (str): The directory of the time-series store
+                         Default is None, which is .cache/timeseries
+    """
+    if date is not None:
+        from timeseries import TIMESERIES_DIR, load_snapshot
+
+        # The indexes of df do not apply to the snapshot, they are built on its rows
+        df = load_snapshot(date, end_date, store_dir or TIMESERIES_DIR)
+        index = lookup = None
+
+    if cache is None:
+        fig = make_figure(df, county, statistic, num_miles, index, lookup)
+        fig.show()
+    else:
+        body = render_figure(df, county, statistic, num_miles, "json", index, lookup, cache)
+        __show_or_save(body)
+
+def __show_or_save(body, output = None):
+    """Open the figure JSON from render_figure() in the web browser, or write a rendered figure to output
+    """
+    if output is None:
+        import plotly.io as pio
+        pio.show(json.loads(body), validate = False)
+        return
+    os.makedirs(os.path.dirname(output) or ".", exist_ok = True)
+    with open(output, "wb") as f:
+        f.write(body)
+
+def __load(args, prebuilt):
+    """The dataframe, spatial index and lookup index of a run, from the prebuilt snapshot if there is one
+    """
+    from neighbors import attach_neighbor_table
+
+    if prebuilt is not None:
+        with stage("load_prebuilt") as record:
+            merged_df = prebuilt.df
+            index = prebuilt.index
+            lookup = prebuilt.lookup
+            record["rows"] = len(merged_df)
+        if args.compact:
+            from compact import build_compact
+
+            # The facts keep the rows in order, so the indexes of the snapshot still apply
+            with stage("build_compact", rows = len(merged_df)):
+                merged_df = build_compact(merged_df)
+        with stage("open_neighbor_table"):
+            index = attach_neighbor_table(index)
+        return merged_df, index, lookup
+
+    from compact import build_compact
+    from data import load_data
+    from lookup import build_lookup
+    from spatial import build_spatial_index
+    from timeseries import load_snapshot, store_from_args
+
+    with stage("load_data") as record:
+        if args.date is None:
+            merged_df = load_data(args.nytimes_url, args.data_gov_url,
+                                  refresh = args.refresh, offline = args.offline,
+                                  chunksize = args.chunksize, compact = args.compact)
+        else:
+            merged_df = load_snapshot(args.date, args.end_date, store_from_args(args))
+            if args.compact:
+                merged_df = build_compact(merged_df)
+        record["rows"] = len(merged_df)
+
+    with stage("build_spatial_index", rows = len(merged_df)):
+        index = build_spatial_index(merged_df)
+    with stage("build_lookup", rows = len(merged_df)):
+        lookup = build_lookup(merged_df)
+
+    # The snapshot holds the merged layout, it is written by the runs without --compact
+    if args.prebuilt is not None and args.date is None and not args.compact:
+        with stage("write_prebuilt"):
+            write_prebuilt(merged_df, index, lookup, args.prebuilt or PREBUILT_PATH, read_manifest().get("sources"))
+
+    # Radius queries are answered from the precomputed neighbor table when there is one
+    with stage("open_neighbor_table"):
+        index = attach_neighbor_table(index)
+
+    return merged_df, index, lookup
 
 def main():
-    merged_df = load_data()
     args = load_args()
 
-    plot(merged_df, args.county, args.statistic, args.num_miles)
+    profiler = None
+    if args.profile is not None:
+        dump_dir = os.path.dirname(os.path.abspath(args.profile))
+        profiler = Profiler(args.profile_stage, dump_dir, args.profile_tool).start()
+
+    # A failing run is profiled too, its report has the error and the stages up to the failure
+    version = None
+    error = None
+    try:
+        # A malformed county fails before anything is loaded
+        split_county(args.county)
+
+        # Every run is a new process, so only the on-disk tier of the figure cache is useful here
+        cache = FigureCache(disk_dir = args.figure_cache or FIGURE_CACHE_DIR) if args.figure_cache is not None else None
+        fmt = "json" if args.output is None else os.path.splitext(args.output)[1].lstrip(".").lower()
+
+        prebuilt = None
+        if args.prebuilt is not None and args.date is None and not args.refresh:
+            # The snapshot is only used for the versions of the sources load_data() would load
+            sources = source_versions([args.nytimes_url, args.data_gov_url], offline = args.offline)[1]
+            with stage("open_prebuilt"):
+                prebuilt = open_prebuilt(args.prebuilt or PREBUILT_PATH, sources)
+
+        body = None
+        if prebuilt is not None:
+            version = prebuilt.version
+            # Only the lookup is read to check the county and look up the figure cache,
+            # the dataframe is read when the figure has to be built
+            with stage("load_lookup"):
+                lookup = prebuilt.lookup
+            resolve_query(lookup, args.county, args.num_miles)
+
+            if cache is not None and (args.output is None or fmt in IMAGE_FORMATS):
+                key = cache.key(lookup, version, args.county, args.statistic, args.num_miles, fmt)
+                body = cache.get(key) if key is not None else None
+
+        if body is not None:
+            with stage("figure_cache_hit"):
+                __show_or_save(body, args.output)
+        else:
+            merged_df, index, lookup = __load(args, prebuilt)
+            version = merged_df.attrs.get("version")
+
+            if args.output is None:
+                with stage("plot"):
+                    plot(merged_df, args.county, args.statistic, args.num_miles, index, lookup, cache)
+            elif cache is not None and fmt in IMAGE_FORMATS:
+                with stage("render_figure"):
+                    body = render_figure(merged_df, args.county, args.statistic, args.num_miles, fmt, index, lookup, cache)
+                __show_or_save(body, args.output)
+            else:
+                if fmt in IMAGE_FORMATS:
+                    with stage("start_renderer"):
+                        start_renderer()
+                with stage("make_figure"):
+                    fig = make_figure(merged_df, args.county, args.statistic, args.num_miles, index, lookup)
+                with stage("save_figure"):
+                    save_figure(fig, args.output)
+    except Exception as e:
+        error = "{}: {}".format(type(e).__name__, e)
+        raise
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(args.profile, dataset_version = version, error = error,
+                           query = {"county": args.county, "statistic": args.statistic, "num_miles": args.num_miles})
 
 if __name__ == "__main__":
     main()
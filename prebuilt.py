@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import pickle
+import struct
+import argparse
+
+from cache import CACHE_DIR, read_manifest
+from utils import add_data_args
+
+# Default location of the prebuilt snapshot
+PREBUILT_PATH = os.path.join(CACHE_DIR, "prebuilt.bin")
+
+# Bump when the layout of the file or of the pickled classes (CountyLookup, CountyGridIndex) changes,
+# snapshots of another format are ignored and rebuilt
+PREBUILT_FORMAT = 2
+
+MAGIC = b"COVID-VIZ PREBUILT\n"
+
+class Prebuilt:
+    """A prebuilt binary snapshot of the merged data and its indexes
+
+    The file is a small JSON header followed by one pickled section each for the lookup
+    index, the spatial index and the dataframe. Sections are only read when they are first
+    used, so a run that only validates the county or answers from the figure cache reads
+    the lookup alone and never imports pandas. The header keeps the versions of the sources
+    the snapshot was built from, the same ones load_data() keys its cache on.
+
+    Attributes:
+    ===========
+        path (str): The snapshot file
+        version (str): The version of the merged data, df.attrs["version"]
+        rows (int): Number of rows of the dataframe
+    """
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.version = header["version"]
+        self.rows = header["rows"]
+        self.sections = {}
+
+    def load(self, name):
+        """Unpickle a section, "lookup", "index" or "df", once
+        """
+        if name not in self.sections:
+            offset, length = self.header["sections"][name]
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                self.sections[name] = pickle.loads(f.read(length))
+        return self.sections[name]
+
+    @property
+    def lookup(self):
+        return self.load("lookup")
+
+    @property
+    def index(self):
+        return self.load("index")
+
+    @property
+    def df(self):
+        df = self.load("df")
+        df.attrs["version"] = self.version
+        return df
+
+def write_prebuilt(df, index, lookup, path = PREBUILT_PATH, sources = None):
+    """Write the prebuilt snapshot of a dataframe from load_data() and its indexes
+
+    Args:
+    =====
+        df (pd.DataFrame): A pandas DataFrame from load_data()
+        index (CountyGridIndex): The spatial index of df from build_spatial_index()
+        lookup (CountyLookup): The lookup index of df from build_lookup()
+        path (str): Where to write the snapshot
+        sources (dict): The versions of the sources of df, from cache.source_versions()
+                        (the "sources" of the cache manifest), checked by open_prebuilt()
+    """
+    sections = [("lookup", pickle.dumps(lookup, protocol = pickle.HIGHEST_PROTOCOL)),
+                ("index", pickle.dumps(index, protocol = pickle.HIGHEST_PROTOCOL)),
+                ("df", pickle.dumps(df, protocol = pickle.HIGHEST_PROTOCOL))]
+
+    header = {"format": PREBUILT_FORMAT,
+              "version": df.attrs.get("version"),
+              "rows": len(df),
+              "sources": sources,
+              "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "sections": {}}
+    # The offsets depend on the header size, which depends on the offsets: pad the header
+    offset = 0
+    for name, payload in sections:
+        header["sections"][name] = [offset, len(payload)]
+        offset += len(payload)
+    start = len(MAGIC) + 8 + len(json.dumps(header)) + 256
+    for name in header["sections"]:
+        header["sections"][name][0] += start
+    encoded = json.dumps(header).encode().ljust(start - len(MAGIC) - 8)
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(encoded)))
+        f.write(encoded)
+        for _, payload in sections:
+            f.write(payload)
+    os.replace(path + ".tmp", path)
+
+def open_prebuilt(path = PREBUILT_PATH, sources = None):
+    """Open a prebuilt snapshot, only its header is read
+
+    Args:
+    =====
+        path (str): The snapshot file
+        sources (dict): The current versions of the sources, from cache.source_versions()
+                        Default is None, which does not check them
+
+    Returns:
+    ========
+        prebuilt (Prebuilt): The snapshot, or None if it is missing, has another format or no version,
+                             or was built from other versions of the sources
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+        length, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length).decode())
+    if header.get("format") != PREBUILT_FORMAT or header.get("version") is None:
+        return None
+    if sources is not None and header.get("sources") != sources:
+        return None
+    return Prebuilt(path, header)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path",
+                        type = str,
+                        default = PREBUILT_PATH,
+                        help = "Where to write the prebuilt snapshot")
+    add_data_args(parser)
+    args = parser.parse_args()
+
+    # Only building the snapshot needs pandas, reading its header does not
+    from data import load_data
+    from lookup import build_lookup
+    from spatial import build_spatial_index
+
+    df = load_data(args.nytimes_url, args.data_gov_url, refresh = args.refresh, offline = args.offline,
+                   chunksize = args.chunksize)
+    write_prebuilt(df, build_spatial_index(df), build_lookup(df), args.path, read_manifest().get("sources"))
+    print("Wrote {} ({:,} rows, {:.1f} MB, version {})".format(args.path, len(df), os.path.getsize(args.path) / 1e6,
+                                                                df.attrs.get("version")))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+
+# The profiler recording the stages, set by Profiler.start(), empty when profiling is off
+# Single underscores, the methods of Profiler would mangle double ones
+_active = {}
+
+def _peak_rss_mb():
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+class Profiler:
+    """Records the wall time, CPU time, memory and row count of each stage of a run
+
+    Stages are marked in the code with profiling.stage() and nest, e.g. "load_data > merge".
+    Each stage records:
+
+        wall_seconds, cpu_seconds    time spent in the stage
+        alloc_peak_mb                peak memory allocated during the stage, above what was
+                                     allocated when it started (traced with tracemalloc,
+                                     Python 3.9+)
+        rss_peak_mb                  peak RSS of the process when the stage ended
+        rows                         number of rows the stage produced, when it sets one
+        error                        the exception the stage raised, when it failed
+
+    One stage (hot_stage) can also be profiled function by function with cProfile, or with
+    pyinstrument if it is installed, and dumped to dump_dir.
+
+    Usage:
+        with Profiler(hot_stage = "merge") as profiler:
+            df = load_data()
+        profiler.write("profile.json")
+    """
+
+    def __init__(self, hot_stage = None, dump_dir = ".", tool = "cprofile", callback = None, trace_memory = True):
+        self.hot_stage = hot_stage
+        self.dump_dir = dump_dir
+        self.tool = tool
+        self.callback = callback
+        self.trace_memory = trace_memory and hasattr(tracemalloc, "reset_peak")
+
+        self.records = []
+        # Stage -> position of its first start, stages are recorded when they end
+        self.order = {}
+        self.stack = []
+        self.dumps = []
+        self.started = None
+        self.wall_seconds = None
+
+    def start(self):
+        """Make this the active profiler, stages run from now on are recorded
+        """
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.started = time.perf_counter()
+        _active["profiler"] = self
+        return self
+
+    def stop(self):
+        """Stop recording stages
+        """
+        self.wall_seconds = time.perf_counter() - self.started
+        _active.pop("profiler", None)
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def __start_hot(self, name):
+        if name != self.hot_stage:
+            return None
+        if self.tool == "pyinstrument":
+            # Optional, only needed for tool = "pyinstrument"
+            import pyinstrument
+            hot = pyinstrument.Profiler()
+            hot.start()
+        else:
+            hot = cProfile.Profile()
+            hot.enable()
+        return hot
+
+    def __stop_hot(self, name, hot):
+        os.makedirs(self.dump_dir, exist_ok = True)
+        base = os.path.join(self.dump_dir, "{}_{}".format(name.replace(" ", "_"), len(self.dumps)))
+        if self.tool == "pyinstrument":
+            hot.stop()
+            path = base + ".html"
+            with open(path, "w") as f:
+                f.write(hot.output_html())
+        else:
+            hot.disable()
+            path = base + ".prof"
+            hot.dump_stats(path)
+        self.dumps.append(path)
+
+    @contextmanager
+    def stage(self, name, rows = None):
+        """Record a stage, see profiling.stage()
+        """
+        path = name if not self.stack else "{} > {}".format(self.stack[-1]["record"]["stage"], name)
+        record = {"stage": path, "rows": rows}
+        frame = {"record": record}
+        self.order.setdefault(path, len(self.order))
+
+        if self.trace_memory:
+            allocated, peak = tracemalloc.get_traced_memory()
+            # reset_peak() loses the peak of the enclosing stage so far, it is carried in its frame
+            if self.stack:
+                self.stack[-1]["carried_peak"] = max(self.stack[-1].get("carried_peak", 0), peak)
+            frame["allocated"] = allocated
+            tracemalloc.reset_peak()
+
+        self.stack.append(frame)
+        hot = self.__start_hot(name)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        except Exception as e:
+            # The stage that failed, and those enclosing it, keep the error in their record
+            record["error"] = "{}: {}".format(type(e).__name__, e)
+            raise
+        finally:
+            record["wall_seconds"] = time.perf_counter() - wall
+            record["cpu_seconds"] = time.process_time() - cpu
+            if hot is not None:
+                self.__stop_hot(name, hot)
+            self.stack.pop()
+
+            if self.trace_memory:
+                peak = max(tracemalloc.get_traced_memory()[1], frame.get("carried_peak", 0))
+                record["alloc_peak_mb"] = max(peak - frame["allocated"], 0) / (1 << 20)
+                if self.stack:
+                    self.stack[-1]["carried_peak"] = max(self.stack[-1].get("carried_peak", 0), peak)
+            record["rss_peak_mb"] = _peak_rss_mb()
+
+            self.records.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    def summary(self):
+        """Stages aggregated by name, in the order they first started
+
+        Returns:
+        ========
+            stages (list): One dictionary per stage with the number of calls and the totals
+                           (maxima for the memory) of its records
+        """
+        stages = {}
+        for record in self.records:
+            stage = stages.setdefault(record["stage"], {"stage": record["stage"], "calls": 0, "rows": None,
+                                                        "wall_seconds": 0.0, "cpu_seconds": 0.0})
+            stage["calls"] += 1
+            stage["wall_seconds"] += record["wall_seconds"]
+            stage["cpu_seconds"] += record["cpu_seconds"]
+            if record["rows"] is not None:
+                stage["rows"] = (stage["rows"] or 0) + int(record["rows"])
+            for key in ["alloc_peak_mb", "rss_peak_mb"]:
+                if key in record:
+                    stage[key] = max(stage.get(key, 0), record[key])
+
+        return sorted(stages.values(), key = lambda stage: self.order[stage["stage"]])
+
+    def report(self, **extra):
+        """The structured report of the run
+
+        Args:
+        =====
+            extra: Other fields of the report, e.g. the query or the dataset version
+
+        Returns:
+        ========
+            report (dict): The environment, the total wall time, the stages and the profile dumps
+        """
+        import numpy
+        import pandas
+        import plotly
+
+        report = {"created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "argv": sys.argv,
+                  "python": platform.python_version(),
+                  "platform": platform.platform(),
+                  "versions": {"numpy": numpy.__version__, "pandas": pandas.__version__, "plotly": plotly.__version__},
+                  "wall_seconds": self.wall_seconds,
+                  "rss_peak_mb": _peak_rss_mb(),
+                  "stages": self.summary(),
+                  "records": self.records,
+                  "dumps": self.dumps}
+        report.update(extra)
+        return report
+
+    def write(self, path, **extra):
+        """Write the report to a JSON file, see report()
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        with open(path, "w") as f:
+            json.dump(self.report(**extra), f, indent = 2, default = str)
+
+@contextmanager
+def stage(name, rows = None):
+    """Mark a stage of the pipeline for the active Profiler, does nothing when profiling is off
+
+    The row count can be given up front or set on the yielded record once it is known:
+
+        with stage("read_csv") as record:
+            df = pd.read_csv(path)
+            record["rows"] = len(df)
+
+    Args:
+    =====
+        name (str): The name of the stage
+        rows (int): Number of rows the stage works on
+    """
+    profiler = _active.get("profiler")
+    if profiler is None:
+        yield {}
+        return
+    with profiler.stage(name, rows) as record:
+        yield record
@@ -0,0 +1,384 @@
+import os
+import json
+import time
+import hmac
+import asyncio
+import argparse
+import ipaddress
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ProcessPoolExecutor
+
+from data import NUMERIC_COLS, load_data
+from export import IMAGE_FORMATS, start_renderer
+from aggregate import build_rollups
+from figure_cache import FigureCache
+from lookup import build_lookup
+from neighbors import attach_neighbor_table
+from plot import render_figure
+from spatial import build_spatial_index
+from utils import add_compact_arg, add_data_args
+
+CONTENT_TYPES = {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg", "webp": "image/webp",
+                 "svg": "image/svg+xml", "pdf": "application/pdf", "eps": "application/postscript"}
+
+# Seconds an idle keep-alive connection is kept open
+KEEP_ALIVE_TIMEOUT = 60
+
+# Data shared by every request in a worker process, set once by _init_worker()
+# The worker functions have a single underscore, QueryServer's methods would mangle double ones
+_worker = {}
+
+def _is_loopback(host):
+    """Whether host only accepts connections from this machine, e.g. '127.0.0.1', '::1' or 'localhost'
+    """
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def _init_worker(df):
+    """Keep the dataframe and its indexes in the worker for all of its requests
+    """
+    _worker["df"] = df
+    _worker["index"] = attach_neighbor_table(build_spatial_index(df))
+    _worker["lookup"] = build_lookup(df)
+
+def _ping():
+    return os.getpid()
+
+def _render(query, fmt = "json", width = None, height = None, scale = None):
+    """Build a figure in a worker, errors of the query are returned instead of raised
+    """
+    try:
+        # The image renderer is only started by the first image, the figure JSON and the
+        # aggregates do not need it (or kaleido to be installed)
+        if fmt != "json" and not _worker.get("renderer"):
+            start_renderer()
+            _worker["renderer"] = True
+        body = render_figure(_worker["df"], query["county"], query["statistic"], query["num_miles"], fmt,
+                             _worker["index"], _worker["lookup"], None, width, height, scale)
+        return body, None
+    except Exception as e:
+        return None, str(e)
+
+class Dataset:
+    """A loaded dataset, its lookup index and rollups, and the worker pool holding it
+
+    The server swaps the whole Dataset at once on reload, so a request always uses the
+    dataframe and the workers of one version.
+    """
+
+    def __init__(self, df, pool, workers):
+        self.df = df
+        self.lookup = build_lookup(df)
+        self.rollups = build_rollups(df)
+        self.version = df.attrs.get("version")
+        self.loaded_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.pool = pool
+        self.workers = workers
+
+class QueryServer:
+    """HTTP server answering plot queries from a dataset kept in memory
+
+    Endpoints:
+        GET /figure?county=...&statistic=...&num_miles=...   the plotly figure as JSON
+        GET /image?county=...&statistic=...&num_miles=...&format=png&width=...&height=...&scale=...
+        GET /aggregate?county=...&num_miles=... or ?state=... or ?fips=25001,25017   totals and per-100k rates
+        GET /health                                           the version of the loaded dataset
+        POST /reload                                          reload the data now, with the X-Reload-Token
+                                                              header when there is a reload_token
+
+    Without a reload_token, /reload is only answered when the server listens on a loopback
+    address, since anything that can reach the port could otherwise force a refetch.
+
+    The data is loaded once and every figure is built in a pool of worker processes that
+    each hold the dataframe and its indexes, so the event loop only parses requests.
+    Rendered figures are kept in a FigureCache keyed by the dataset version, so repeated
+    queries are answered by the event loop without going through a worker.
+    """
+
+    def __init__(self, nytimes_url, data_gov_url, workers = None, reload_interval = 3600, offline = False, cache = None,
+                 chunksize = None, compact = False, reload_token = None):
+        self.nytimes_url = nytimes_url
+        self.data_gov_url = data_gov_url
+        self.workers = workers or os.cpu_count()
+        self.reload_interval = reload_interval
+        self.offline = offline
+        self.chunksize = chunksize
+        self.compact = compact
+        self.reload_token = reload_token
+        self.host = None
+        self.cache = cache if cache is not None else FigureCache()
+        self.dataset = None
+        self.reload_lock = None
+
+    async def __start_dataset(self, df):
+        """Start a worker pool holding df, and wait for every worker to be ready
+        """
+        loop = asyncio.get_event_loop()
+        pool = ProcessPoolExecutor(max_workers = self.workers, initializer = _init_worker, initargs = (df,))
+        await asyncio.gather(*[loop.run_in_executor(pool, _ping) for _ in range(self.workers)])
+        return Dataset(df, pool, self.workers)
+
+    async def reload(self, refresh = False):
+        """Load the data and swap it in if its version changed
+
+        The new dataframe is loaded in a thread and its workers are started before the swap,
+        so requests keep being answered from the previous dataset in the meantime. Requests
+        already running in the previous pool finish before it shuts down.
+
+        Args:
+        =====
+            refresh (bool): Ignore the on-disk cache and refetch the data
+
+        Returns:
+        ========
+            swapped (bool): Whether a new version was loaded
+        """
+        async with self.reload_lock:
+            loop = asyncio.get_event_loop()
+            df = await loop.run_in_executor(None, lambda: load_data(self.nytimes_url, self.data_gov_url,
+                                                                    refresh = refresh, offline = self.offline,
+                                                                    chunksize = self.chunksize, compact = self.compact))
+            if self.dataset is not None and df.attrs.get("version") == self.dataset.version:
+                return False
+
+            previous = self.dataset
+            self.dataset = await self.__start_dataset(df)
+            if previous is not None:
+                previous.pool.shutdown(wait = False)
+            return True
+
+    async def __reload_periodically(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                if await self.reload():
+                    print("Reloaded the data, version {}".format(self.dataset.version), flush = True)
+            except Exception as e:
+                # Keep serving the loaded data when the sources cannot be reached
+                print("Reload failed, keeping version {}: {}".format(self.dataset.version, e), flush = True)
+
+    async def __query(self, params, fmt):
+        try:
+            query = {"county": params["county"],
+                     "statistic": params.get("statistic", "cases"),
+                     "num_miles": int(params.get("num_miles", 0))}
+            size = {key: float(params[key]) if key == "scale" else int(params[key])
+                    for key in ("width", "height", "scale") if key in params}
+        except KeyError:
+            return HTTPStatus.BAD_REQUEST, "text/plain", b"Please specify a county, e.g. county=Barnstable County, MA"
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST, "text/plain", b"num_miles, width, height and scale must be numbers"
+
+        if query["statistic"] not in NUMERIC_COLS[1:]:
+            message = "The statistic must be one of: {}".format(", ".join(NUMERIC_COLS[1:]))
+            return HTTPStatus.BAD_REQUEST, "text/plain", message.encode()
+
+        content_type = "application/json" if fmt == "json" else CONTENT_TYPES[fmt]
+
+        # Submitting happens in the same step as reading self.dataset, so a reload cannot
+        # shut the pool down in between
+        dataset = self.dataset
+        key = self.cache.key(dataset.lookup, dataset.version, query["county"], query["statistic"], query["num_miles"],
+                             fmt, size.get("width"), size.get("height"), size.get("scale"))
+        body = self.cache.get(key) if key is not None else None
+        if body is not None:
+            return HTTPStatus.OK, content_type, body
+
+        loop = asyncio.get_event_loop()
+        body, error = await loop.run_in_executor(dataset.pool, _render, query, fmt,
+                                                 size.get("width"), size.get("height"), size.get("scale"))
+        if error is not None:
+            return HTTPStatus.BAD_REQUEST, "text/plain", error.encode()
+
+        if key is not None:
+            self.cache.put(key, body)
+        return HTTPStatus.OK, content_type, body
+
+    def __aggregate(self, params):
+        """Aggregates are answered from the rollups in the event loop, they take microseconds
+        """
+        rollups = self.dataset.rollups
+        try:
+            if "county" in params:
+                summary = rollups.radius(params["county"], int(params.get("num_miles", 0)))
+            elif "state" in params:
+                summary = rollups.state(params["state"])
+            elif "fips" in params:
+                summary = rollups.fips([int(fips) for fips in params["fips"].split(",")])
+            else:
+                raise Exception("Please specify a county, a state or fips")
+        except Exception as e:
+            return HTTPStatus.BAD_REQUEST, "text/plain", str(e).encode()
+
+        summary["version"] = self.dataset.version
+        return HTTPStatus.OK, "application/json", json.dumps(summary).encode()
+
+    def __may_reload(self, headers):
+        """Whether a POST /reload with these headers is allowed
+        """
+        if self.reload_token is not None:
+            return hmac.compare_digest(headers.get("x-reload-token", ""), self.reload_token)
+        return _is_loopback(self.host)
+
+    async def __route(self, method, target, headers):
+        url = urlsplit(target)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        if url.path == "/figure" and method == "GET":
+            return await self.__query(params, "json")
+
+        if url.path == "/image" and method == "GET":
+            fmt = params.get("format", "png").lower()
+            if fmt not in IMAGE_FORMATS:
+                message = "The format must be one of: {}".format(", ".join(IMAGE_FORMATS))
+                return HTTPStatus.BAD_REQUEST, "text/plain", message.encode()
+            return await self.__query(params, fmt)
+
+        if url.path == "/aggregate" and method == "GET":
+            return self.__aggregate(params)
+
+        if url.path == "/health" and method == "GET":
+            dataset = self.dataset
+            body = {"version": dataset.version, "rows": len(dataset.df),
+                    "loaded_at": dataset.loaded_at, "workers": dataset.workers, "cache": self.cache.stats()}
+            return HTTPStatus.OK, "application/json", json.dumps(body).encode()
+
+        if url.path == "/reload" and method == "POST":
+            if not self.__may_reload(headers):
+                message = "Reloading needs the X-Reload-Token header, or a server listening on a loopback address"
+                return HTTPStatus.FORBIDDEN, "text/plain", message.encode()
+            swapped = await self.reload(refresh = params.get("refresh") == "1")
+            body = {"reloaded": swapped, "version": self.dataset.version}
+            return HTTPStatus.OK, "application/json", json.dumps(body).encode()
+
+        return HTTPStatus.NOT_FOUND, "text/plain", b"Not found"
+
+    async def handle(self, reader, writer):
+        """Answer the HTTP/1.1 requests of a connection, keeping it open between requests
+        """
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+                if not request_line:
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if "content-length" in headers:
+                    await reader.readexactly(int(headers["content-length"]))
+
+                try:
+                    status, content_type, body = await self.__route(method, target, headers)
+                except Exception as e:
+                    status, content_type, body = HTTPStatus.INTERNAL_SERVER_ERROR, "text/plain", str(e).encode()
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+                             status.value, status.phrase, content_type, len(body),
+                             "keep-alive" if keep_alive else "close").encode("latin-1") + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host = "127.0.0.1", port = 8050):
+        """Load the data, start the workers and serve until interrupted
+
+        Args:
+        =====
+            host (str): The interface to listen on
+            port (int): The port to listen on
+        """
+        self.host = host
+        self.reload_lock = asyncio.Lock()
+
+        start = time.perf_counter()
+        await self.reload()
+        print("Loaded {:,} rows (version {}) into {} workers in {:.2f} s".format(
+              len(self.dataset.df), self.dataset.version, self.workers, time.perf_counter() - start), flush = True)
+
+        if self.reload_interval > 0:
+            asyncio.ensure_future(self.__reload_periodically())
+
+        server = await asyncio.start_server(self.handle, host, port)
+        print("Serving on http://{}:{}".format(host, port), flush = True)
+        async with server:
+            await server.serve_forever()
+
+def load_server_args():
+    """Utility function to load the command line arguments of the server
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--host",
+                        type = str,
+                        default = "127.0.0.1",
+                        help = "The interface to listen on")
+
+    parser.add_argument("--port",
+                        type = int,
+                        default = 8050,
+                        help = "The port to listen on")
+
+    parser.add_argument("--workers",
+                        type = int,
+                        default = None,
+                        help = "Number of worker processes building the figures, defaults to the number of CPU cores")
+
+    parser.add_argument("--reload_interval",
+                        type = int,
+                        default = 3600,
+                        help = "Seconds between checks for new data, 0 disables the reloads")
+
+    parser.add_argument("--reload_token",
+                        type = str,
+                        default = None,
+                        help = """
+                        Require this token in the X-Reload-Token header of POST /reload. Without it,
+                        /reload is refused unless --host is a loopback address
+                        """)
+
+    parser.add_argument("--cache_mb",
+                        type = int,
+                        default = 256,
+                        help = "Size of the in-memory figure cache in MB")
+
+    parser.add_argument("--cache_dir",
+                        type = str,
+                        default = None,
+                        help = "Also cache the figures on disk in this directory, e.g. .cache/figures")
+
+    add_compact_arg(parser)
+    add_data_args(parser)
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+    args = load_server_args()
+
+    cache = FigureCache(max_bytes = args.cache_mb << 20, disk_dir = args.cache_dir)
+    server = QueryServer(args.nytimes_url, args.data_gov_url, args.workers, args.reload_interval, args.offline, cache,
+                         args.chunksize, args.compact, args.reload_token)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import numpy as np
+
+from distance import EARTH_RADIUS_MILES, haversine_miles
+
+# Length of one degree of latitude in miles
+MILES_PER_DEGREE = 2 * np.pi * EARTH_RADIUS_MILES / 360
+
+class CountyGridIndex:
+    """Grid index over the unique county centroids of a dataframe from load_data()
+
+    Counties are bucketed into cells of cell_degrees x cell_degrees. A radius query only
+    looks at the cells overlapping the circle's bounding box and then keeps the counties
+    whose great-circle distance to the origin is within the radius, so it returns a true
+    circle instead of a square and does not scan the whole dataframe.
+
+    Build it once per dataset load with build_spatial_index() and reuse it across queries.
+    """
+
+    def __init__(self, df, cell_degrees = 1.0, counties = None):
+        self.cell_degrees = cell_degrees
+        self.num_lon_cells = int(np.ceil(360 / cell_degrees))
+
+        # One entry per unique county, with the positions of its rows in df
+        if counties is None:
+            county_ids = df.groupby(["county", "state"], sort = False, observed = True).ngroup().to_numpy()
+            first_rows = np.unique(county_ids, return_index = True)[1]
+
+            self.latitude = df["latitude"].to_numpy(dtype = np.float64)[first_rows]
+            self.longitude = df["longitude"].to_numpy(dtype = np.float64)[first_rows]
+        else:
+            # The facts of a CompactData, the counties are the rows of its dimension table
+            county_ids = df["county_id"].to_numpy()
+            self.latitude = counties["latitude"].to_numpy(dtype = np.float64)
+            self.longitude = counties["longitude"].to_numpy(dtype = np.float64)
+
+        self.row_order = np.argsort(county_ids, kind = "stable")
+        self.row_offsets = np.concatenate([[0], np.cumsum(np.bincount(county_ids, minlength = len(self.latitude)))])
+
+        # Sort the counties by cell so each row of cells is a contiguous slice
+        keys = self.cell_keys(self.latitude, self.longitude)
+        self.county_order = np.argsort(keys, kind = "stable")
+        self.sorted_keys = keys[self.county_order]
+
+    def __len__(self):
+        return len(self.latitude)
+
+    def cell_keys(self, lat, lon):
+        """Integer cell key of each coordinate, ordered by latitude row then longitude column
+        """
+        lat_cells = np.floor((np.asarray(lat) + 90) / self.cell_degrees).astype(np.int64)
+        lon_cells = np.floor((np.asarray(lon) + 180) / self.cell_degrees).astype(np.int64) % self.num_lon_cells
+        return lat_cells * self.num_lon_cells + lon_cells
+
+    def candidates(self, lat, lon, num_miles):
+        """Counties in the grid cells overlapping the bounding box of the circle
+
+        Args:
+        =====
+            lat, lon (float): Coordinates of the origin in degrees
+            num_miles (float): The radius in miles
+
+        Returns:
+        ========
+            (np.ndarray): Positions of the candidate counties
+        """
+        dlat = num_miles / MILES_PER_DEGREE
+        lat_min = max(lat - dlat, -90.0)
+        lat_max = min(lat + dlat, 90.0)
+
+        # A degree of longitude is shortest at the latitude furthest from the equator
+        widest = max(abs(lat_min), abs(lat_max))
+        cos_lat = np.cos(np.radians(widest))
+        if widest >= 90 or num_miles / (MILES_PER_DEGREE * cos_lat) >= 180:
+            lon_ranges = [(0, self.num_lon_cells - 1)]
+        else:
+            dlon = num_miles / (MILES_PER_DEGREE * cos_lat)
+            first = int(np.floor((lon - dlon + 180) / self.cell_degrees)) % self.num_lon_cells
+            last = int(np.floor((lon + dlon + 180) / self.cell_degrees)) % self.num_lon_cells
+            # The box wraps around the antimeridian (e.g. the Aleutian Islands)
+            if first <= last:
+                lon_ranges = [(first, last)]
+            else:
+                lon_ranges = [(first, self.num_lon_cells - 1), (0, last)]
+
+        first_lat_cell = int(np.floor((lat_min + 90) / self.cell_degrees))
+        last_lat_cell = int(np.floor((lat_max + 90) / self.cell_degrees))
+
+        lat_cells = np.arange(first_lat_cell, last_lat_cell + 1) * self.num_lon_cells
+        slices = []
+        for first, last in lon_ranges:
+            starts = np.searchsorted(self.sorted_keys, lat_cells + first, side = "left")
+            ends = np.searchsorted(self.sorted_keys, lat_cells + last, side = "right")
+            slices.extend(self.county_order[start:end] for start, end in zip(starts, ends) if end > start)
+
+        if not slices:
+            return np.empty(0, dtype = np.int64)
+        return np.concatenate(slices)
+
+    def query_counties(self, lat, lon, num_miles):
+        """Counties whose centroid is within num_miles of the origin
+
+        Args:
+        =====
+            lat, lon (float): Coordinates of the origin in degrees
+            num_miles (float): The radius in miles
+
+        Returns:
+        ========
+            (np.ndarray): Positions of the counties inside the circle
+        """
+        candidates = self.candidates(lat, lon, num_miles)
+        distances = haversine_miles(lat, lon, self.latitude[candidates], self.longitude[candidates])
+        return candidates[distances <= num_miles]
+
+    def query(self, lat, lon, num_miles):
+        """Rows of the dataframe whose county centroid is within num_miles of the origin
+
+        Args:
+        =====
+            lat, lon (float): Coordinates of the origin in degrees
+            num_miles (float): The radius in miles
+
+        Returns:
+        ========
+            rows (np.ndarray): Sorted row positions, to be used with df.iloc
+        """
+        return self.rows_of_counties(self.query_counties(lat, lon, num_miles))
+
+    def rows_of_counties(self, counties):
+        """Rows of the dataframe of some counties
+
+        Args:
+        =====
+            counties (np.ndarray): Positions of counties, e.g. from query_counties()
+
+        Returns:
+        ========
+            rows (np.ndarray): Sorted row positions, to be used with df.iloc
+        """
+        if len(counties) == 0:
+            return np.empty(0, dtype = np.int64)
+        # Gather the rows of every county in one go, without looping over the counties
+        starts = self.row_offsets[counties]
+        lengths = self.row_offsets[counties + 1] - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        rows = np.sort(self.row_order[positions])
+        return rows
+
+def build_spatial_index(df, cell_degrees = 1.0, counties = None):
+    """Build the spatial index of a dataframe from load_data()
+
+    Args:
+    =====
+        df (pd.DataFrame): A pandas DataFrame from load_data(), a CompactData, or the facts of a CompactData
+        cell_degrees (float): Size of the grid cells in degrees
+        counties (pd.DataFrame): With the facts of a CompactData, its county dimension table
+                                 Default is None, which takes the counties from df
+
+    Returns:
+    ========
+        index (CountyGridIndex): The spatial index over the unique county centroids
+    """
+    # A CompactData, its rows are the facts and its counties the dimension table
+    if hasattr(df, "facts"):
+        df, counties = df.facts, df.counties
+    return CountyGridIndex(df, cell_degrees = cell_degrees, counties = counties)
@@ -0,0 +1,276 @@
+import os
+import json
+import argparse
+
+import pandas as pd
+
+from cache import CACHE_DIR, is_url
+from crosswalk import load_crosswalk, write_crosswalk
+from data import COUNTIES_DTYPES, NUMERIC_COLS, STRING_COLS, load_geocodes, merge_counties
+from fetch import fetch_sources
+
+HISTORY_URL = "https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv"
+
+LIVE_URL = "https://raw.githubusercontent.com/nytimes/covid-19-data/master/live/us-counties.csv"
+
+DATA_GOV_URL = "https://data.healthcare.gov/resource/geocodes-usa-with-counties.json"
+
+TIMESERIES_DIR = os.path.join(CACHE_DIR, "timeseries")
+
+MANIFEST_NAME = "manifest.json"
+
+def read_manifest(store_dir = TIMESERIES_DIR):
+    """Read the manifest of the time-series store
+
+    Args:
+    =====
+        store_dir (str): The directory of the time-series store
+
+    Returns:
+    ========
+        manifest (dict): The last ingested date and the date range of every monthly partition
+    """
+    path = os.path.join(store_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"last_date": None, "partitions": {}}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def __write_manifest(manifest, store_dir):
+    tmp_path = os.path.join(store_dir, MANIFEST_NAME + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent = 2, sort_keys = True)
+    os.replace(tmp_path, os.path.join(store_dir, MANIFEST_NAME))
+
+def __partition_path(month, store_dir):
+    return os.path.join(store_dir, "{}.feather".format(month))
+
+def __restore_categories(df):
+    """Concatenating categoricals with different categories gives back strings, restore them
+    """
+    for col in STRING_COLS:
+        df[col] = df[col].astype("category")
+    return df
+
+def __county_keys(df):
+    """One key per county: its FIPS, or its names for the counties without one (e.g. New York City)
+    """
+    names = df["county"].astype(str) + "|" + df["state"].astype(str)
+    return df["fips"].astype(str).where(df["fips"] > 0, names)
+
+def __write_partition(month, frames, manifest, store_dir):
+    """Append rows to a monthly partition, only that partition is read and rewritten
+    """
+    path = __partition_path(month, store_dir)
+    if os.path.exists(path):
+        frames = [pd.read_feather(path)] + frames
+
+    partition = pd.concat(frames, ignore_index = True)
+    # Keyed on the FIPS, several FIPS can share the names of one geocodes county
+    keys = pd.DataFrame({"date": partition["date"], "county": __county_keys(partition)})
+    partition = partition[~keys.duplicated(keep = "last").to_numpy()]
+    partition = __restore_categories(partition.sort_values(["date", "state", "county"], ignore_index = True))
+
+    tmp_path = path + ".tmp"
+    partition.to_feather(tmp_path)
+    os.replace(tmp_path, path)
+
+    manifest["partitions"][month] = [partition["date"].min().strftime("%Y-%m-%d"),
+                                     partition["date"].max().strftime("%Y-%m-%d")]
+
+def update_store(source = None, data_gov_url = DATA_GOV_URL, store_dir = TIMESERIES_DIR, chunksize = 500000):
+    """Ingest the NY Times county history into the date-partitioned store, or append the new dates
+
+    The first run ingests the full history file. Later runs (by default from the live file)
+    only keep the dates after the last ingested date, so a daily update only rewrites the
+    partition of the current month. The source is read in chunks and at most one month of
+    rows is held in memory, so memory use does not grow with the length of the history.
+    URL sources are downloaded with fetch_sources() first, so an interrupted download of
+    the history file resumes where it stopped.
+
+    Args:
+    =====
+        source (str): URL or local path of a NY Times counties CSV
+                      Default is None, which uses the history file for the first run and
+                      the live file afterwards
+        data_gov_url (str): URL or local path of the US counties geocodes
+        store_dir (str): The directory of the time-series store
+        chunksize (int): Number of CSV rows read at a time
+
+    Returns:
+    ========
+        num_rows (int): Number of new rows written to the store
+    """
+    os.makedirs(store_dir, exist_ok = True)
+
+    manifest = read_manifest(store_dir)
+    last_date = manifest["last_date"]
+    if source is None:
+        source = HISTORY_URL if last_date is None else LIVE_URL
+
+    # The history file is large, so it is downloaded first (resumably) and then read locally
+    urls = [url for url in [source, data_gov_url] if is_url(url)]
+    paths = {url: result["path"] for url, result in fetch_sources(urls).items()}
+    source = paths.get(source, source)
+
+    geocode_df = load_geocodes(paths.get(data_gov_url, data_gov_url))
+    # The FIPS matched so far are kept with the store they were ingested into
+    crosswalk = load_crosswalk(geocode_df, store_dir)
+
+    num_rows = 0
+    buffers = {}
+    for chunk in pd.read_csv(source, dtype = COUNTIES_DTYPES, parse_dates = ["date"], chunksize = chunksize):
+        if last_date is not None:
+            chunk = chunk[chunk["date"] > pd.Timestamp(last_date)]
+        if chunk.empty:
+            continue
+
+        merged_df = merge_counties(chunk, geocode_df, crosswalk)
+        num_rows += len(merged_df)
+        for month, rows in merged_df.groupby(merged_df["date"].dt.strftime("%Y-%m"), sort = False):
+            buffers.setdefault(month, []).append(rows)
+
+        # The NY Times files are sorted by date, so every month before the newest one is complete
+        newest = max(buffers)
+        for month in sorted(buffers):
+            if month < newest:
+                __write_partition(month, buffers.pop(month), manifest, store_dir)
+
+    for month in sorted(buffers):
+        __write_partition(month, buffers.pop(month), manifest, store_dir)
+    write_crosswalk(crosswalk, store_dir)
+
+    if manifest["partitions"]:
+        manifest["last_date"] = max(end for _, end in manifest["partitions"].values())
+    __write_manifest(manifest, store_dir)
+
+    return num_rows
+
+def read_dates(start, end = None, columns = None, store_dir = TIMESERIES_DIR):
+    """Read the rows of a date range, only the partitions overlapping the range are read
+
+    Args:
+    =====
+        start (str): First date, e.g. '2020-09-01'
+        end (str): Last date
+                   Default is None, which reads the single start date
+        columns (list): Columns to read
+                        Default is None, which reads every column
+        store_dir (str): The directory of the time-series store
+
+    Returns:
+    ========
+        df (pd.DataFrame): The rows of the date range
+    """
+    start = pd.Timestamp(start)
+    end = pd.Timestamp(end) if end is not None else start
+    if columns is not None and "date" not in columns:
+        columns = ["date"] + list(columns)
+
+    frames = []
+    for month, (first, last) in sorted(read_manifest(store_dir)["partitions"].items()):
+        if pd.Timestamp(last) < start or pd.Timestamp(first) > end:
+            continue
+        partition = pd.read_feather(__partition_path(month, store_dir), columns = columns)
+        frames.append(partition[(partition["date"] >= start) & (partition["date"] <= end)])
+
+    if not frames:
+        return pd.DataFrame(columns = columns)
+    return __restore_categories(pd.concat(frames, ignore_index = True))
+
+def load_snapshot(date, end_date = None, store_dir = TIMESERIES_DIR):
+    """Load one row per county for plotting a date or a date range
+
+    For a single date, the values are the NY Times cumulative totals on that date. For a
+    range, they are the increase over the range: the totals on the end date minus the totals
+    on the day before the start date. Only the partitions of those two days are read, so
+    memory use does not depend on the length of the range.
+
+    Args:
+    =====
+        date (str): The date, or the first date of the range, e.g. '2020-09-01'
+        end_date (str): The last date of the range
+                        Default is None, which plots the single date
+        store_dir (str): The directory of the time-series store
+
+    Raises:
+    =======
+        Exception: Error message will show if the store has no data for the date
+
+    Returns:
+    ========
+        df (pd.DataFrame): A dataframe shaped like the output of load_data(), which can be passed to plot()
+    """
+    end = end_date if end_date is not None else date
+    df = read_dates(end, store_dir = store_dir)
+    if df.empty:
+        raise Exception("There is no data for {}. Please run timeseries.py to update the data.".format(end))
+
+    if end_date is not None:
+        day_before = pd.Timestamp(date) - pd.Timedelta(days = 1)
+        before = read_dates(day_before, columns = ["county", "state"] + NUMERIC_COLS, store_dir = store_dir)
+        before = before.set_index(__county_keys(before))[NUMERIC_COLS[1:]]
+
+        totals = df.set_index(__county_keys(df))
+        # Counties without data on the day before the range had no cases yet
+        increase = totals[NUMERIC_COLS[1:]].sub(before.reindex(totals.index).fillna(0)).astype("int64")
+        df[NUMERIC_COLS[1:]] = increase.to_numpy()
+
+    label = date if end_date is None else "{} to {}".format(date, end_date)
+    df.attrs["dates"] = label
+    df.attrs["version"] = "timeseries:{}:{}".format(read_manifest(store_dir)["last_date"], label)
+    return df
+
+def store_from_args(args):
+    """The time-series store of the command line arguments from utils.add_store_args()
+
+    With --update_store, the new dates are appended to the store first, with the geocodes
+    and the chunk size of utils.add_data_args().
+
+    Args:
+    =====
+        args (argparse.Namespace): The parsed command line arguments
+
+    Raises:
+    =======
+        Exception: Error message will show if --update_store is given with --offline
+
+    Returns:
+    ========
+        store_dir (str): The directory of the time-series store
+    """
+    store_dir = args.store_dir or TIMESERIES_DIR
+    if args.update_store:
+        if args.offline:
+            raise Exception("--update_store downloads the new dates, it cannot be used with --offline")
+        update_store(data_gov_url = args.data_gov_url, store_dir = store_dir, chunksize = args.chunksize or 500000)
+    return store_dir
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source",
+                        type = str,
+                        default = None,
+                        help = """
+                        URL or local path of a NY Times counties CSV. Defaults to the full history
+                        for the first run and to the live file afterwards
+                        """)
+    parser.add_argument("--data_gov_url",
+                        type = str,
+                        default = DATA_GOV_URL,
+                        help = "URL or local path of the US counties geocodes data")
+    parser.add_argument("--store_dir",
+                        type = str,
+                        default = TIMESERIES_DIR,
+                        help = "The directory of the time-series store")
+    parser.add_argument("--chunksize",
+                        type = int,
+                        default = 500000,
+                        help = "Number of CSV rows read at a time")
+    args = parser.parse_args()
+
+    num_rows = update_store(args.source, args.data_gov_url, args.store_dir, args.chunksize)
+    print("Added {:,} rows, the store now ends on {}".format(num_rows, read_manifest(args.store_dir)["last_date"]))
+
+if __name__ == "__main__":
+    main()
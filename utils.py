@@ -1,9 +1,5 @@
 import argparse
 
-from geopy.point import Point
-from geopy.units import kilometers
-import geopy.distance
-
 def load_state_abbrevs():
     """Utility function of each state's abbreviations
     
@@ -15,12 +11,14 @@ def load_state_abbrevs():
                      "AK": "Alaska",
                      "AZ": "Arizona",
                      "AR": "Arkansas",
-                     "CA": "Calfornia",
+                     "CA": "California",
                      "CO": "Colorado",
                      "CT": "Connecticut",
                      "DE": "Delaware",
+                     "DC": "District of Columbia",
                      "FL": "Florida",
                      "GA": "Georgia",
+                     "GU": "Guam",
                      "HI": "Hawaii",
                      "ID": "Idaho",
                      "IL": "Illinois",
@@ -45,6 +43,7 @@ def load_state_abbrevs():
                      "NY": "New York",
                      "NC": "North Carolina",
                      "ND": "North Dakota",
+                     "MP": "Northern Mariana Islands",
                      "OH": "Ohio",
                      "OK": "Oklahoma",
                      "OR": "Oregon",
@@ -58,6 +57,7 @@ def load_state_abbrevs():
                      "UT": "Utah",
                      "VT": "Vermont",
                      "VA": "Virginia",
+                     "VI": "Virgin Islands",
                      "WA": "Washington",
                      "WV": "West Virginia",
                      "WI": "Wisconsin",
@@ -72,6 +72,9 @@ def calculate_surrounding_coords(sample, num_miles):
     My approach was to calculate the surrounding coordinates from the base coordinate within
     the user specified num_miles radius and zoom in on that area in Plotly.
 
+    The four destinations are computed in a single vectorized call (see distance.destination()),
+    which matches geopy's geodesic().destination().
+
     Args:
     =====
         sample (pd.DataFrame): The pandas DataFrame filtered by user-specified county
@@ -82,63 +85,184 @@ def calculate_surrounding_coords(sample, num_miles):
         lat (list): A list that contains the latitude values from NSEW
         lon (list): A list that contains the longitude values from NSEW
     """
-    miles_to_km = kilometers(miles = num_miles)
+    # Imported here so that parsing the command line does not import numpy
+    import numpy as np
+    from distance import destination
 
-    start = Point(sample["latitude"].values[0], sample["longitude"].values[0])
+    lat, lon = destination(sample["latitude"].values[0], sample["longitude"].values[0],
+                           num_miles, np.array([0, 90, 180, 270]))
+    
+    return lat.tolist(), lon.tolist()
 
-    d = geopy.distance.geodesic()
+def split_county(county):
+    """Split the user-specified county string into the county and the state
 
-    dest_north = d.destination(start, distance = miles_to_km, bearing = 0)
-    dest_east = d.destination(start, distance = miles_to_km, bearing = 90)
-    dest_south = d.destination(start, distance = miles_to_km, bearing = 180)
-    dest_west = d.destination(start, distance = miles_to_km, bearing = 270)
-    
-    lat = [dest_north.latitude, dest_east.latitude, dest_south.latitude, dest_west.latitude]
-    
-    lon = [dest_north.longitude, dest_east.longitude, dest_south.longitude, dest_west.longitude]
-    
-    return lat, lon
+    For example, the user specified county is "Barnstable County, MA",
+    extract the county "Barnstable County" and the state "MA"
+
+    Args:
+    =====
+        county (str): User-specified county and state, e.g. 'Barnstable County, MA'
+
+    Raises:
+    =======
+        Exception: Error message will show if the county is not followed by a state
+
+    Returns:
+        county (str): The county part
+        state (str): The state part
+    """
+    split = county.rsplit(",", 1)
+    if len(split) != 2:
+        raise Exception("Please specify the county as so: 'Barnstable County, MA'")
+    return split[0], split[1]
 
-def check_county(df, county):
+def check_county(lookup, county, state):
     """Check to make sure user-specified county is in the dataframe
 
     Args:
     =====
-        df (pd.DataFrame): A pandas DataFrame from load_data()
+        lookup (CountyLookup): The lookup index of the dataframe from build_lookup()
         county (str): User-specified county of interest
+        state (str): The state of the county, as returned by check_state()
 
     Raises:
     =======
-        Exception: Error message will show if user-specified county is not in dataframe
+        Exception: Error message will show if user-specified county is not in dataframe,
+                   with suggestions of similarly spelled counties
 
     Returns:
-        county (str): User-specified county that is in the dataframe
+        county (str): User-specified county as it is named in the dataframe
     """
-    for counties in df["county"]:
-        if county in counties:
-            return county
-    raise Exception("The inputted county does not have any COVID-19 related information. Please try another county.")
+    match = lookup.find_county(county, state)
+    if match is not None:
+        return match[0]
+
+    state_abbrevs = {name: abbrev for abbrev, name in load_state_abbrevs().items()}
+    suggestions = ["'{} County, {}'".format(c, state_abbrevs.get(s, s)) for c, s in lookup.suggest(county, state)]
+    message = "The inputted county does not have any COVID-19 related information. Please try another county."
+    if suggestions:
+        message += " Did you mean: {}?".format(", ".join(suggestions))
+    raise Exception(message)
 
-def check_state(df, state):
+def check_state(lookup, state):
     """Check to make sure user-specified state is in the dataframe
 
     Args:
     =====
-        df (pd.DataFrame): A pandas DataFrame from load_data()
-        state (str): User-specified state of interest
+        lookup (CountyLookup): The lookup index of the dataframe from build_lookup()
+        state (str): User-specified state of interest, its name or its abbreviation
 
     Raises:
     =======
         Exception: Error message will show if user-specified state is not in dataframe
 
     Returns:
-        state (str): User-specified state that is in the dataframe
+        state (str): User-specified state as it is named in the dataframe
     """
-    for states in df["state"]:
-        if state in states:
-            return state
+    match = lookup.find_state(load_state_abbrevs().get(state.strip().upper(), state))
+    if match is not None:
+        return match
     raise Exception("The inputted state does not exist. Please input a valid state.")
 
+def resolve_query(lookup, county, num_miles):
+    """Validate the county and the radius of a query, shared by make_figure() and the aggregates
+
+    Args:
+    =====
+        lookup (CountyLookup): The lookup index of the dataframe from build_lookup()
+        county (str): User-specified county and state, e.g. 'Barnstable County, MA'
+        num_miles (int): The number of miles between 0 and 1000
+
+    Raises:
+    =======
+        Exception: Error message will show if the county is malformed or not in the dataframe,
+                   or if the radius is out of range
+
+    Returns:
+    ========
+        county (str): The county as it is named in the dataframe
+        state (str): Its state as it is named in the dataframe
+    """
+    county, state = split_county(county)
+
+    # Check if user inputted county and state exists in the dataframe
+    state = check_state(lookup, state)
+    county = check_county(lookup, county, state)
+
+    # Check to make sure num_miles is within the range of 0 and 1000
+    if num_miles < 0 or num_miles > 1000:
+        raise Exception("Please input a number between 0 and 1000")
+
+    return county, state
+
+def add_data_args(parser):
+    """Add the command line arguments that control where and how the data is loaded
+
+    Shared by every entry point that calls load_data()
+
+    Args:
+    =====
+        parser (argparse.ArgumentParser): The parser to add the arguments to
+    """
+    parser.add_argument("--nytimes_url",
+                        type = str,
+                        default = "https://raw.githubusercontent.com/nytimes/covid-19-data/master/live/us-counties.csv",
+                        help = "URL or local path of the NY Times COVID-19 US County cases data")
+
+    parser.add_argument("--data_gov_url",
+                        type = str,
+                        default = "https://data.healthcare.gov/resource/geocodes-usa-with-counties.json",
+                        help = "URL or local path of the US counties geocodes data")
+
+    parser.add_argument("--refresh",
+                        action = "store_true",
+                        help = "Ignore the on-disk cache and refetch the data")
+
+    parser.add_argument("--offline",
+                        action = "store_true",
+                        help = "Never contact the network, load URL sources from the on-disk cache")
+
+    parser.add_argument("--chunksize",
+                        type = int,
+                        default = None,
+                        help = """
+                        Stream the NY Times data this many rows at a time into the cache,
+                        bounding the memory used while loading large files
+                        """)
+
+def add_compact_arg(parser):
+    """Add the --compact command line argument of the entry points that can query a CompactData
+
+    Args:
+    =====
+        parser (argparse.ArgumentParser): The parser to add the argument to
+    """
+    parser.add_argument("--compact",
+                        action = "store_true",
+                        help = """
+                        Keep the data in memory in the compact layout of compact.py,
+                        only the rows of a query are expanded to the merged layout
+                        """)
+
+def add_store_args(parser):
+    """Add the command line arguments of the time-series store read by the --date entry points
+
+    Used by timeseries.store_from_args()
+
+    Args:
+    =====
+        parser (argparse.ArgumentParser): The parser to add the arguments to
+    """
+    parser.add_argument("--store_dir",
+                        type = str,
+                        default = None,
+                        help = "The directory of the time-series store (default .cache/timeseries)")
+
+    parser.add_argument("--update_store",
+                        action = "store_true",
+                        help = "Append the new dates of the NY Times data to the time-series store before reading it")
+
 def load_args():
     """Utility function to load the command line arguments
     """
@@ -157,6 +281,8 @@ def load_args():
                         type = str, 
                         default = "cases",
                         required = True, 
+                        choices = ["cases", "deaths", "confirmed_cases", "confirmed_deaths",
+                                   "probable_cases", "probable_deaths"],
                         help = """
                         The COVID-19 statistic of interest.
                         Options are: 'cases', 'deaths', 'confirmed_cases',
@@ -170,6 +296,72 @@ def load_args():
                         required = True,
                         help = "A number between 0 and 1000")
 
+    parser.add_argument("--date",
+                        type = str,
+                        default = None,
+                        help = """
+                        Plot the totals on this date (e.g. '2020-09-01') from the
+                        time-series store instead of the live data
+                        """)
+
+    parser.add_argument("--end_date",
+                        type = str,
+                        default = None,
+                        help = "With --date, plot the increase from --date to this date")
+
+    parser.add_argument("--output",
+                        type = str,
+                        default = None,
+                        help = """
+                        Write the figure to this path (.png, .svg, .html, ...)
+                        instead of opening it in the web browser
+                        """)
+
+    parser.add_argument("--profile",
+                        type = str,
+                        default = None,
+                        help = """
+                        Write the wall time, CPU time, peak memory and row count of
+                        every stage of the run to this JSON file
+                        """)
+
+    parser.add_argument("--profile_stage",
+                        type = str,
+                        default = None,
+                        help = """
+                        With --profile, also profile this stage function by function
+                        (e.g. 'merge' or 'create_choropleth'), dumped next to the report
+                        """)
+
+    parser.add_argument("--profile_tool",
+                        type = str,
+                        default = "cprofile",
+                        help = "The profiler of --profile_stage, 'cprofile' or 'pyinstrument' (if installed)")
+
+    parser.add_argument("--prebuilt",
+                        type = str,
+                        nargs = "?",
+                        const = "",
+                        default = None,
+                        help = """
+                        Start from the prebuilt binary snapshot of the merged data and
+                        its indexes (default path .cache/prebuilt.bin), building it
+                        on the first run and on --refresh
+                        """)
+
+    parser.add_argument("--figure_cache",
+                        type = str,
+                        nargs = "?",
+                        const = "",
+                        default = None,
+                        help = """
+                        Reuse the figures of previous runs on the same data,
+                        cached on disk in this directory (default .cache/figures)
+                        """)
+    add_compact_arg(parser)
+    add_data_args(parser)
+    add_store_args(parser)
+
     args = parser.parse_args()
 
     return args